@@ -50,6 +50,7 @@ def build_stacks():
         app,
         'image-reader-lambda-stack',
         s3_stack.s3_bucket,
+        s3_stack.ingestion_queue,
         api_gateway_ws_stack.conversion_api,
         sns_stack.textract_topic,
         sns_stack.polly_topic,
@@ -65,6 +66,8 @@ def build_stacks():
         'image-reader-main-stack',
         api_gateway_ws_stack.conversion_api,
         lambda_stack.convert_images_to_text_func,
+        lambda_stack.submit_batch_func,
+        lambda_stack.file_session_func,
     )
     amplify_stack = AmplifyStack(
         app,
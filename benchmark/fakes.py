@@ -0,0 +1,793 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# In-memory stand-ins for the AWS services the Lambda handlers talk to.  They implement just the
+# calls (and response shapes) the handlers use, so the whole pipeline can run in one process.
+
+import collections
+import copy
+import decimal
+import io
+import itertools
+import json
+import random
+import re
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+
+def client_error(code, operation_name, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation_name)
+
+
+class FakeStreamingBody:
+
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self._stream.read(amt)
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self._stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def iter_lines(self, chunk_size=1024, keepends=False):
+        pending = b''
+        for chunk in self.iter_chunks(chunk_size):
+            lines = (pending + chunk).splitlines(True)
+            for line in lines[:-1]:
+                yield line if keepends else line.splitlines()[0]
+            pending = lines[-1]
+        if pending:
+            yield pending if keepends else pending.splitlines()[0]
+
+    def close(self):
+        pass
+
+
+class FakePaginator:
+
+    def __init__(self, method):
+        self._method = method
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self._method(**kwargs)
+            yield page
+            if not page.get('NextContinuationToken'):
+                break
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+
+class FakeS3:
+
+    def __init__(self):
+        self.objects = {}
+        self._multipart_uploads = {}
+        self._presigned_requests = {}
+
+    def _get(self, bucket_name, key, operation_name):
+        try:
+            return self.objects[(bucket_name, key)]
+        except KeyError:
+            raise client_error('NoSuchKey', operation_name, f's3://{bucket_name}/{key}') from None
+
+    def _put(self, bucket_name, key, data, content_type=None, metadata=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        elif hasattr(data, 'read'):
+            data = data.read()
+        self.objects[(bucket_name, key)] = {
+            'Body': bytes(data),
+            'ContentType': content_type or 'binary/octet-stream',
+            'Metadata': dict(metadata or {}),
+            'ETag': f'"{uuid.uuid4().hex}"',
+        }
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        s3_object = self._get(Bucket, Key, 'GetObject')
+        if IfNoneMatch is not None and IfNoneMatch == s3_object['ETag']:
+            raise client_error('304', 'GetObject', 'Not Modified')
+        return {
+            'Body': FakeStreamingBody(s3_object['Body']),
+            'ContentLength': len(s3_object['Body']),
+            'ContentType': s3_object['ContentType'],
+            'ETag': s3_object['ETag'],
+            'Metadata': dict(s3_object['Metadata']),
+        }
+
+    def head_object(self, Bucket, Key, **kwargs):
+        s3_object = self._get(Bucket, Key, 'HeadObject')
+        return {
+            'ContentLength': len(s3_object['Body']),
+            'ContentType': s3_object['ContentType'],
+            'ETag': s3_object['ETag'],
+            'Metadata': dict(s3_object['Metadata']),
+        }
+
+    def put_object(self, Bucket, Key, Body=b'', ContentType=None, Metadata=None, **kwargs):
+        self._put(Bucket, Key, Body, ContentType, Metadata)
+        return {'ETag': self.objects[(Bucket, Key)]['ETag']}
+
+    def copy_object(self, CopySource, Bucket, Key, **kwargs):
+        s3_object = self._get(CopySource['Bucket'], CopySource['Key'], 'CopyObject')
+        self._put(Bucket, Key, s3_object['Body'], s3_object['ContentType'], s3_object['Metadata'])
+        return {}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for s3_object in Delete['Objects']:
+            self.objects.pop((Bucket, s3_object['Key']), None)
+        return {'Errors': []} if Delete.get('Quiet') else {'Deleted': Delete['Objects'], 'Errors': []}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        extra_args = ExtraArgs or {}
+        self._put(Bucket, Key, Fileobj, extra_args.get('ContentType'), extra_args.get('Metadata'))
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000, **kwargs):
+        keys = sorted(key for bucket_name, key in self.objects if bucket_name == Bucket and key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = {
+            'Contents': [{'Key': key, 'Size': len(self.objects[(Bucket, key)]['Body'])} for key in keys[start:start + MaxKeys]],
+            'KeyCount': len(keys[start:start + MaxKeys]),
+        }
+        if start + MaxKeys < len(keys):
+            page['NextContinuationToken'] = str(start + MaxKeys)
+        return page
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(getattr(self, operation_name))
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None, **kwargs):
+        upload_id = uuid.uuid4().hex
+        self._multipart_uploads[upload_id] = {'Bucket': Bucket, 'Key': Key, 'ContentType': ContentType, 'Parts': {}}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Body, Bucket, Key, PartNumber, UploadId, **kwargs):
+        etag = f'"{uuid.uuid4().hex}"'
+        self._multipart_uploads[UploadId]['Parts'][PartNumber] = (etag, Body.read() if hasattr(Body, 'read') else bytes(Body))
+        return {'ETag': etag}
+
+    def complete_multipart_upload(self, Bucket, Key, MultipartUpload, UploadId, **kwargs):
+        upload = self._multipart_uploads.pop(UploadId)
+        parts = upload['Parts']
+        data = b''.join(parts[part['PartNumber']][1] for part in MultipartUpload['Parts'])
+        self._put(Bucket, Key, data, upload['ContentType'])
+        return {'Location': f's3://{Bucket}/{Key}'}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._multipart_uploads.pop(UploadId, None)
+        return {}
+
+    def list_parts(self, Bucket, Key, UploadId, **kwargs):
+        parts = self._multipart_uploads[UploadId]['Parts']
+        return {
+            'Parts': [{'PartNumber': number, 'ETag': parts[number][0], 'Size': len(parts[number][1])} for number in sorted(parts)],
+        }
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600, HttpMethod=None):
+        url = f'https://{Params["Bucket"]}.s3.amazonaws.com/{Params["Key"]}?X-Amz-Signature={uuid.uuid4().hex}'
+        self._presigned_requests[url] = (ClientMethod, dict(Params))
+        return url
+
+    def generate_presigned_post(self, Bucket, Key, Fields=None, Conditions=None, ExpiresIn=3600):
+        signature = uuid.uuid4().hex
+        self._presigned_requests[signature] = (Bucket, Key, list(Conditions or []))
+        return {
+            'url': f'https://{Bucket}.s3.amazonaws.com/',
+            'fields': dict(Fields or {}, key=Key, policy='benchmark', **{'x-amz-signature': signature}),
+        }
+
+    def send_presigned_post(self, fields, body):
+        # what a browser does with a presigned POST form, S3 checks the file against the policy's conditions
+        bucket_name, key, conditions = self._presigned_requests[fields['x-amz-signature']]
+        for condition in conditions:
+            if isinstance(condition, dict):
+                if any(fields.get(name) != value for name, value in condition.items()):
+                    raise client_error('AccessDenied', 'PostObject', f'Policy condition failed: {condition}')
+            elif condition[0] == 'content-length-range' and not condition[1] <= len(body) <= condition[2]:
+                raise client_error('EntityTooLarge', 'PostObject', 'Your proposed upload exceeds the maximum allowed size')
+        return self.put_object(Bucket=bucket_name, Key=fields['key'], Body=body, ContentType=fields.get('Content-Type'))
+
+    def send_presigned(self, url, body=None):
+        # what a browser does with a presigned URL, straight to the bucket
+        client_method, params = self._presigned_requests[url]
+        if body is not None:
+            params['Body'] = body
+        return getattr(self, client_method)(**params)
+
+
+def to_dynamodb(value):
+    # boto3 refuses floats and hands numbers back as Decimal, the fake does the same
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, float):
+        raise TypeError('Float types are not supported. Use Decimal types instead.')
+    if isinstance(value, int):
+        return decimal.Decimal(value)
+    if isinstance(value, dict):
+        return {k: to_dynamodb(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamodb(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return {to_dynamodb(v) for v in value}
+    return value
+
+
+class ExpressionEvaluator:
+
+    TOKEN_RE = re.compile(r'\s*(<>|<=|>=|[=<>(),+\-\[\]]|[#:]?[A-Za-z0-9_\.#]+|\S)')
+
+    def __init__(self, names=None, values=None):
+        self._names = names or {}
+        self._values = {k: to_dynamodb(v) for k, v in (values or {}).items()}
+
+    def _path(self, text):
+        path = []
+        for part in re.findall(r'[^.\[\]]+|\[\d+\]', text):
+            if part.startswith('['):
+                path.append(int(part[1:-1]))
+            else:
+                path.append(self._names.get(part, part))
+        return path
+
+    @staticmethod
+    def _lookup(item, path):
+        value = item
+        for part in path:
+            try:
+                value = value[part]
+            except (KeyError, IndexError, TypeError):
+                raise KeyError(path) from None
+        return value
+
+    @staticmethod
+    def _assign(item, path, value):
+        target = item
+        for part in path[:-1]:
+            try:
+                target = target[part]
+            except (KeyError, IndexError, TypeError):
+                raise client_error('ValidationException', 'UpdateItem', f'The document path provided in the update expression is invalid for update: {path}') from None
+        target[path[-1]] = value
+
+    def _tokens(self, expression):
+        return [token for token in self.TOKEN_RE.findall(expression) if token.strip()]
+
+    # update expressions
+
+    def update(self, item, expression):
+        clauses = re.split(r'\b(SET|ADD|REMOVE|DELETE)\b', expression, flags=re.IGNORECASE)
+        for keyword, body in zip(clauses[1::2], clauses[2::2]):
+            for action in self._split_top_level(body):
+                getattr(self, f'_{keyword.lower()}')(item, action)
+
+    @staticmethod
+    def _split_top_level(body):
+        actions, depth, current = [], 0, ''
+        for char in body:
+            depth += char == '('
+            depth -= char == ')'
+            if char == ',' and depth == 0:
+                actions.append(current.strip())
+                current = ''
+            else:
+                current += char
+        if current.strip():
+            actions.append(current.strip())
+        return actions
+
+    def _set(self, item, action):
+        path, _, value_expression = action.partition('=')
+        self._assign(item, self._path(path.strip()), self._value(item, self._tokens(value_expression)))
+
+    def _value(self, item, tokens):
+        value, rest = self._operand(item, tokens)
+        while rest:
+            operator, (operand, rest) = rest[0], self._operand(item, rest[1:])
+            value = value + operand if operator == '+' else value - operand
+        return value
+
+    def _operand(self, item, tokens):
+        token = tokens[0]
+        if token in ('if_not_exists', 'list_append'):
+            depth, end = 0, 1
+            for end in range(1, len(tokens)):
+                depth += tokens[end] == '('
+                depth -= tokens[end] == ')'
+                if depth == 0:
+                    break
+            arguments = self._split_top_level(' '.join(tokens[2:end]))
+            if token == 'if_not_exists':
+                try:
+                    value = self._lookup(item, self._path(arguments[0].replace(' ', '')))
+                except KeyError:
+                    value = self._value(item, self._tokens(arguments[1]))
+            else:
+                value = self._value(item, self._tokens(arguments[0])) + self._value(item, self._tokens(arguments[1]))
+            return value, tokens[end + 1:]
+        if token.startswith(':'):
+            return copy.deepcopy(self._values[token]), tokens[1:]
+        return copy.deepcopy(self._lookup(item, self._path(token))), tokens[1:]
+
+    def _add(self, item, action):
+        path, value = action.split()
+        path, value = self._path(path), self._values[value]
+        try:
+            current = self._lookup(item, path)
+        except KeyError:
+            current = None
+        if isinstance(value, set):
+            self._assign(item, path, (current or set()) | value)
+        else:
+            self._assign(item, path, (current or decimal.Decimal(0)) + value)
+
+    def _remove(self, item, action):
+        path = self._path(action)
+        try:
+            del self._lookup(item, path[:-1])[path[-1]]
+        except (KeyError, IndexError):
+            pass
+
+    def _delete(self, item, action):
+        path, value = action.split()
+        path = self._path(path)
+        self._assign(item, path, self._lookup(item, path) - self._values[value])
+
+    # condition expressions
+
+    def condition(self, item, expression):
+        tokens = self._tokens(expression)
+        result, rest = self._or(item, tokens)
+        if rest:
+            raise ValueError(f'Unsupported condition expression: {expression}')
+        return result
+
+    def _or(self, item, tokens):
+        result, tokens = self._and(item, tokens)
+        while tokens and tokens[0].upper() == 'OR':
+            other, tokens = self._and(item, tokens[1:])
+            result = result or other
+        return result, tokens
+
+    def _and(self, item, tokens):
+        result, tokens = self._not(item, tokens)
+        while tokens and tokens[0].upper() == 'AND':
+            other, tokens = self._not(item, tokens[1:])
+            result = result and other
+        return result, tokens
+
+    def _not(self, item, tokens):
+        if tokens[0].upper() == 'NOT':
+            result, tokens = self._not(item, tokens[1:])
+            return not result, tokens
+        if tokens[0] == '(':
+            result, tokens = self._or(item, tokens[1:])
+            return result, tokens[1:]
+        if tokens[0] in ('attribute_exists', 'attribute_not_exists'):
+            try:
+                self._lookup(item, self._path(tokens[2]))
+                exists = True
+            except KeyError:
+                exists = False
+            return exists == (tokens[0] == 'attribute_exists'), tokens[4:]
+        left, tokens = self._comparable(item, tokens)
+        operator, tokens = tokens[0], tokens[1:]
+        right, tokens = self._comparable(item, tokens)
+        if left is None or right is None:
+            return False, tokens
+        return {
+            '=': left == right,
+            '<>': left != right,
+            '<': left < right,
+            '<=': left <= right,
+            '>': left > right,
+            '>=': left >= right,
+        }[operator], tokens
+
+    def _comparable(self, item, tokens):
+        if tokens[0].startswith(':'):
+            return self._values[tokens[0]], tokens[1:]
+        if tokens[0] == 'size':
+            try:
+                return len(self._lookup(item, self._path(tokens[2]))), tokens[4:]
+            except KeyError:
+                return None, tokens[4:]
+        try:
+            return self._lookup(item, self._path(tokens[0])), tokens[1:]
+        except KeyError:
+            return None, tokens[1:]
+
+
+class FakeTable:
+
+    def __init__(self, name, partition_key):
+        self.name = name
+        self.partition_key = partition_key
+        self.items = {}
+
+    def _key(self, key):
+        if set(key) != {self.partition_key}:
+            raise client_error('ValidationException', 'GetItem', f'The provided key element does not match the schema of {self.name}')
+        return key[self.partition_key]
+
+    def _check(self, item, condition_expression, names, values, operation_name):
+        if condition_expression and not ExpressionEvaluator(names, values).condition(item or {}, condition_expression):
+            raise client_error('ConditionalCheckFailedException', operation_name, 'The conditional request failed')
+
+    def get_item(self, Key, ConsistentRead=False, **kwargs):
+        item = self.items.get(self._key(Key))
+        return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+        key = self._key({self.partition_key: Item.get(self.partition_key)})
+        self._check(self.items.get(key), ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues, 'PutItem')
+        self.items[key] = to_dynamodb(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        key = self._key(Key)
+        existing = self.items.get(key)
+        self._check(existing, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues, 'UpdateItem')
+        item = copy.deepcopy(existing) if existing is not None else to_dynamodb(dict(Key))
+        ExpressionEvaluator(ExpressionAttributeNames, ExpressionAttributeValues).update(item, UpdateExpression)
+        self.items[key] = item
+        return {'Attributes': copy.deepcopy(item)} if ReturnValues == 'ALL_NEW' else {}
+
+    def delete_item(self, Key, **kwargs):
+        self.items.pop(self._key(Key), None)
+        return {}
+
+
+class FakeDynamoDB:
+
+    def __init__(self):
+        self.tables = {}
+
+    def create_table(self, name, partition_key):
+        self.tables[name] = FakeTable(name, partition_key)
+
+    def Table(self, name):
+        # like boto3, a missing table only surfaces on first use
+        return self.tables.get(name) or MissingTable(name)
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.tables[table_name]
+            responses[table_name] = [
+                copy.deepcopy(table.items[table._key(key)])
+                for key in request['Keys'] if table._key(key) in table.items
+            ]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+class MissingTable:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, operation_name):
+        def operation(*args, **kwargs):
+            raise client_error('ResourceNotFoundException', operation_name, f'Requested resource not found: Table: {self.name} not found')
+        return operation
+
+
+class FakeApiGatewayManagementApi:
+
+    def __init__(self):
+        self.messages = collections.defaultdict(list)
+        self.gone_connection_ids = set()
+        self.listeners = []
+
+    def post_to_connection(self, Data, ConnectionId):
+        if ConnectionId in self.gone_connection_ids:
+            raise client_error('GoneException', 'PostToConnection')
+        message = Data.decode('utf-8') if isinstance(Data, bytes) else Data
+        self.messages[ConnectionId].append(message)
+        for listener in self.listeners:
+            listener(ConnectionId, message)
+        return {}
+
+
+class FakeTextract:
+
+    WORDS = (
+        'the', 'of', 'and', 'a', 'to', 'in', 'is', 'you', 'that', 'it', 'he', 'was', 'for', 'on', 'are',
+        'as', 'with', 'his', 'they', 'at', 'be', 'this', 'have', 'from', 'or', 'one', 'had', 'by', 'word',
+        'but', 'not', 'what', 'all', 'were', 'we', 'when', 'your', 'can', 'said', 'there', 'use', 'an',
+        'each', 'which', 'she', 'do', 'how', 'their', 'if', 'will', 'up', 'other', 'about', 'out', 'many',
+    )
+
+    # the largest document the synchronous API takes
+    MAX_SYNC_DOCUMENT_BYTES = 10 * 1024 * 1024
+
+    def __init__(self, sns, s3, page_counts, lines_per_page=40, seed=0, columns=1, max_in_flight_jobs=None):
+        self._sns = sns
+        self._s3 = s3
+        self._page_counts = page_counts
+        self._lines_per_page = lines_per_page
+        self._seed = seed
+        self._columns = columns
+        self.jobs = {}
+        # a job is in flight until its notification is delivered, see Pipeline.drain
+        self.max_in_flight_jobs = max_in_flight_jobs
+        self.in_flight_job_ids = set()
+        self.peak_in_flight_jobs = 0
+        self.throttled_requests = 0
+
+    @staticmethod
+    def _line_block(block_id, text, confidence, page, left, top, width, height=0.015):
+        return {
+            'BlockType': 'LINE',
+            'Id': block_id,
+            'Text': text,
+            'Confidence': confidence,
+            'Page': page,
+            'Geometry': {
+                'BoundingBox': {'Left': left, 'Top': top, 'Width': width, 'Height': height},
+                'Polygon': [{'X': left, 'Y': top}, {'X': left + width, 'Y': top}, {'X': left + width, 'Y': top + height}, {'X': left, 'Y': top + height}],
+            },
+        }
+
+    def _blocks(self, bucket_name, key, page_count):
+        rng = random.Random(f'{self._seed}/{bucket_name}/{key}')
+        blocks = []
+        ids = itertools.count()
+        for page in range(1, page_count + 1):
+            # a running header and a page number, then the body in columns, listed row by row across them
+            line_blocks = [
+                self._line_block(f'l-{next(ids)}', 'Synthetic Document', 99.0, page, 0.35, 0.03, 0.3),
+                self._line_block(f'l-{next(ids)}', str(page), 99.0, page, 0.49, 0.95, 0.02),
+            ]
+            rows = -(-self._lines_per_page // self._columns)
+            carried_word = None
+            column_width = 0.8 / self._columns - 0.02 * (self._columns - 1)
+            for line_index in range(self._lines_per_page):
+                words = [rng.choice(self.WORDS) for _ in range(rng.randint(4, 12))]
+                if carried_word:
+                    words[0] = carried_word
+                    carried_word = None
+                if rng.random() < 0.3:
+                    words[-1] += '.'
+                elif rng.random() < 0.1 and len(words[-1]) > 3:
+                    # hyphenated across the line break
+                    carried_word = words[-1][2:]
+                    words[-1] = f'{words[-1][:2]}-'
+                row, column = divmod(line_index, self._columns)
+                top = 0.1 + 0.8 * row / rows
+                left = 0.1 + column * (column_width + 0.04)
+                width = column_width * len(words) / 12
+                word_blocks = [
+                    {
+                        'BlockType': 'WORD',
+                        'Id': f'w-{next(ids)}',
+                        'Text': word,
+                        # mostly clean print with the odd smudged word
+                        'Confidence': rng.uniform(90, 100) if rng.random() < 0.97 else rng.uniform(30, 90),
+                        'Page': page,
+                        'Geometry': {'BoundingBox': {'Left': left + width * i / len(words), 'Top': top, 'Width': width / len(words), 'Height': 0.015}},
+                    }
+                    for i, word in enumerate(words)
+                ]
+                line_block = self._line_block(
+                    f'l-{next(ids)}',
+                    ' '.join(words),
+                    sum(block['Confidence'] for block in word_blocks) / len(word_blocks),
+                    page,
+                    left,
+                    top,
+                    width,
+                )
+                line_block['Relationships'] = [{'Type': 'CHILD', 'Ids': [block['Id'] for block in word_blocks]}]
+                line_blocks.append(line_block)
+                line_blocks.extend(word_blocks)
+            blocks.append({
+                'BlockType': 'PAGE',
+                'Id': f'p-{next(ids)}',
+                'Page': page,
+                'Geometry': {'BoundingBox': {'Left': 0, 'Top': 0, 'Width': 1, 'Height': 1}},
+                'Relationships': [{'Type': 'CHILD', 'Ids': [block['Id'] for block in line_blocks if block['BlockType'] == 'LINE']}],
+            })
+            blocks.extend(line_blocks)
+        return blocks
+
+    def detect_document_text(self, Document):
+        s3_object = Document['S3Object']
+        if len(self._s3.objects[(s3_object['Bucket'], s3_object['Name'])]['Body']) > self.MAX_SYNC_DOCUMENT_BYTES:
+            raise client_error('DocumentTooLargeException', 'DetectDocumentText', 'S3 object size is more than the maximum limit')
+        blocks = self._blocks(s3_object['Bucket'], s3_object['Name'], 1)
+        return {'DocumentMetadata': {'Pages': 1}, 'Blocks': blocks}
+
+    def start_document_text_detection(self, DocumentLocation, NotificationChannel, JobTag=None, **kwargs):
+        if self.max_in_flight_jobs is not None and len(self.in_flight_job_ids) >= self.max_in_flight_jobs:
+            self.throttled_requests += 1
+            raise client_error('LimitExceededException', 'StartDocumentTextDetection', 'Open jobs exceed maximum concurrent job limit')
+        s3_object = DocumentLocation['S3Object']
+        job_id = uuid.uuid4().hex
+        self.in_flight_job_ids.add(job_id)
+        self.peak_in_flight_jobs = max(self.peak_in_flight_jobs, len(self.in_flight_job_ids))
+        page_count = self._page_counts.get((s3_object['Bucket'], s3_object['Name']), 1)
+        self.jobs[job_id] = {
+            'Blocks': self._blocks(s3_object['Bucket'], s3_object['Name'], page_count),
+            'Pages': page_count,
+        }
+        message = {
+            'JobId': job_id,
+            'Status': 'SUCCEEDED',
+            'API': 'StartDocumentTextDetection',
+            'Timestamp': int(time.time() * 1000),
+            'DocumentLocation': {'S3ObjectName': s3_object['Name'], 'S3Bucket': s3_object['Bucket']},
+        }
+        if JobTag is not None:
+            message['JobTag'] = JobTag
+        self._sns.publish(NotificationChannel['SNSTopicArn'], message)
+        return {'JobId': job_id}
+
+    def get_document_text_detection(self, JobId, MaxResults=1000, NextToken=None):
+        job = self.jobs[JobId]
+        start = int(NextToken or 0)
+        resp = {
+            'JobStatus': 'SUCCEEDED',
+            'DocumentMetadata': {'Pages': job['Pages']},
+            'Blocks': copy.deepcopy(job['Blocks'][start:start + MaxResults]),
+        }
+        if start + MaxResults < len(job['Blocks']):
+            resp['NextToken'] = str(start + MaxResults)
+        return resp
+
+
+class FakePolly:
+
+    # roughly what a 48 kbps MP3 needs per character of speech
+    BYTES_PER_CHARACTER = 400
+
+    def __init__(self, sns, s3, max_in_flight_tasks=None):
+        self._sns = sns
+        self._s3 = s3
+        self.request_characters = 0
+        # a task is in flight until its notification is delivered, see Pipeline.drain
+        self.max_in_flight_tasks = max_in_flight_tasks
+        self.in_flight_task_ids = set()
+        self.peak_in_flight_tasks = 0
+        self.throttled_requests = 0
+
+    def start_speech_synthesis_task(self, OutputFormat, OutputS3BucketName, Text, VoiceId, OutputS3KeyPrefix='', SnsTopicArn=None, TextType='text', **kwargs):
+        if self.max_in_flight_tasks is not None and len(self.in_flight_task_ids) >= self.max_in_flight_tasks:
+            self.throttled_requests += 1
+            raise client_error('ThrottlingException', 'StartSpeechSynthesisTask', 'Rate exceeded')
+        task_id = str(uuid.uuid4())
+        self.in_flight_task_ids.add(task_id)
+        self.peak_in_flight_tasks = max(self.peak_in_flight_tasks, len(self.in_flight_task_ids))
+        key = f'{OutputS3KeyPrefix}.{task_id}.{OutputFormat}'
+        request_characters = len(re.sub(r'<[^>]+>', '', Text)) if TextType == 'ssml' else len(Text)
+        self.request_characters += request_characters
+        self._s3.put_object(Bucket=OutputS3BucketName, Key=key, Body=b'\xff\xfb' * (request_characters * self.BYTES_PER_CHARACTER // 2), ContentType='audio/mpeg')
+        task = {
+            'TaskId': task_id,
+            'TaskStatus': 'scheduled',
+            'OutputUri': f'https://s3.us-east-1.amazonaws.com/{OutputS3BucketName}/{key}',
+            'CreationTime': time.time(),
+            'RequestCharacters': request_characters,
+            'OutputFormat': OutputFormat,
+            'VoiceId': VoiceId,
+            'TextType': TextType,
+        }
+        if SnsTopicArn:
+            self._sns.publish(SnsTopicArn, {
+                'taskId': task_id,
+                'taskStatus': 'COMPLETED',
+                'outputUri': f's3://{OutputS3BucketName}/{key}',
+                'creationTime': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+                'requestCharacters': request_characters,
+                'outputFormat': OutputFormat,
+                'voiceId': VoiceId,
+                'textType': TextType,
+            })
+        return {'SynthesisTask': task}
+
+
+class FakeSns:
+
+    def __init__(self, events):
+        self._events = events
+
+    def publish(self, topic_arn, message):
+        self._events.append(('sns', topic_arn, {
+            'Records': [{
+                'EventSource': 'aws:sns',
+                'Sns': {
+                    'MessageId': str(uuid.uuid4()),
+                    'TopicArn': topic_arn,
+                    'Message': json.dumps(message),
+                },
+            }],
+        }))
+
+
+class FakeSqs:
+
+    def __init__(self, events):
+        self._events = events
+        self.sent_messages = 0
+        self.batch_sent_messages = 0
+
+    def _deliver(self, queue_url, message_bodies):
+        # delivered after whatever is already queued; delays are not waited out
+        message_ids = [str(uuid.uuid4()) for _ in message_bodies]
+        self._events.append(('sqs', queue_url, {
+            'Records': [
+                {
+                    'messageId': message_id,
+                    'eventSource': 'aws:sqs',
+                    'body': message_body,
+                    'attributes': {'ApproximateReceiveCount': '1'},
+                }
+                for message_id, message_body in zip(message_ids, message_bodies)
+            ],
+        }))
+        return message_ids
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, **kwargs):
+        self.sent_messages += 1
+        message_id, = self._deliver(QueueUrl, [MessageBody])
+        return {'MessageId': message_id}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if not 0 < len(Entries) <= 10:
+            raise client_error('TooManyEntriesInBatchRequest', 'SendMessageBatch')
+        self.batch_sent_messages += len(Entries)
+        message_ids = self._deliver(QueueUrl, [entry['MessageBody'] for entry in Entries])
+        return {
+            'Successful': [{'Id': entry['Id'], 'MessageId': message_id} for entry, message_id in zip(Entries, message_ids)],
+            'Failed': [],
+        }
+
+
+class FakeStepFunctions:
+
+    def __init__(self, events):
+        self._events = events
+        self.executions = {}
+
+    def start_execution(self, stateMachineArn, input='{}', name=None):
+        name = name or str(uuid.uuid4())
+        execution_arn = f'{stateMachineArn.replace(":stateMachine:", ":execution:")}:{name}'
+        if execution_arn in self.executions:
+            raise client_error('ExecutionAlreadyExists', 'StartExecution')
+        self.executions[execution_arn] = {'Status': 'RUNNING', 'Input': input}
+        self._events.append(('sfn', execution_arn, json.loads(input)))
+        return {'executionArn': execution_arn, 'startDate': time.time()}
+
+
+class FakeAws:
+
+    # one set of services shared by every client the handlers create, like a single account/region
+
+    def __init__(self, page_counts, lines_per_page=40, seed=0, columns=1, textract_max_in_flight_jobs=None, polly_max_in_flight_tasks=None):
+        self.events = collections.deque()
+        self.s3 = FakeS3()
+        self.dynamodb = FakeDynamoDB()
+        self.sns = FakeSns(self.events)
+        self.sqs = FakeSqs(self.events)
+        self.textract = FakeTextract(self.sns, self.s3, page_counts, lines_per_page, seed, columns, textract_max_in_flight_jobs)
+        self.polly = FakePolly(self.sns, self.s3, polly_max_in_flight_tasks)
+        self.stepfunctions = FakeStepFunctions(self.events)
+        self.apigatewaymanagementapi = FakeApiGatewayManagementApi()
+
+    def client(self, service_name=None, *args, **kwargs):
+        return getattr(self, service_name.replace('-', ''))
+
+    def resource(self, service_name=None, *args, **kwargs):
+        if service_name != 'dynamodb':
+            raise ValueError(f'No fake resource for {service_name}')
+        return self.dynamodb
@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Runs the whole conversion pipeline locally against the in-memory services in benchmark/fakes.py:
+#
+#   convert_images_to_text -> Textract/SNS -> on_textract_ready -> state machine -> Polly/SNS -> on_polly_ready
+#
+# either from WebSocket requests, from batches of them (--batch-size) or, with --ingest, from S3 events
+# delivered by the ingestion queue, and reports throughput, per-stage latency percentiles and memory peaks.  Usage:
+#
+#   python -m benchmark.run_pipeline --documents 200 --pages 5
+
+import argparse
+import boto3
+import collections
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import pathlib
+import random
+import struct
+import sys
+import time
+import tracemalloc
+import urllib.parse
+import uuid
+import zlib
+
+from benchmark.fakes import FakeAws
+
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parent.parent
+LAMBDA_DIR = ROOT_DIR / 'image_reader'
+# what the runtime layer puts on the functions' sys.path, see LambdaStack
+LAYER_DIRS = [LAMBDA_DIR / 'lambda_runtime_layer' / 'python']
+
+# handler module name -> Lambda function directory, see LambdaStack and StepFunctionsStack
+HANDLERS = {
+    'file_session': 'lambda_file_session',
+    'convert_images_to_text': 'lambda_convert_images_to_text',
+    'on_textract_ready': 'lambda_on_textract_ready',
+    'retrieve_text': 'lambda_retrieve_text',
+    'convert_text_to_audio': 'lambda_convert_text_to_audio',
+    'on_polly_ready': 'lambda_on_polly_ready',
+    'reprocess_job': 'lambda_reprocess_job',
+    'submit_batch': 'lambda_submit_batch',
+    'on_job_failed': 'lambda_on_job_failed',
+}
+
+S3_BUCKET = 'image-reader-benchmark'
+USER_ID = 'benchmark-user'
+REGION = 'us-east-1'
+ACCOUNT_ID = '123456789012'
+# see S3Stack
+INGEST_PREFIX = 'ingest/'
+INGESTION_MAX_RECEIVE_COUNT = 5
+INGESTION_QUEUE_URL = f'https://sqs.{REGION}.amazonaws.com/{ACCOUNT_ID}/ingestion'
+# the state machine's retries are spread over an hour and a half (see StepFunctionsStack), here they only wait for the queued events
+ADMISSION_MAX_ATTEMPTS = 1000
+
+
+class StageFailed(Exception):
+    pass
+
+
+class LambdaContext:
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+        self._deadline = time.monotonic() + 300
+
+    def get_remaining_time_in_millis(self):
+        return int((self._deadline - time.monotonic()) * 1000)
+
+
+class Pipeline:
+
+    def __init__(self, args):
+        self.args = args
+        self.stage_latencies = collections.defaultdict(list)
+        self.stage_memory_peaks = collections.defaultdict(int)
+        self.stage_errors = collections.Counter()
+        self.job_started = {}
+        self.job_finished = {}
+        self.job_failed = set()
+        # jobs whose user closed the page right after the upload, they complete without progress messages
+        self.job_disconnected = {}
+        # connection id -> app job id of the finished jobs rebuilt from their stored Textract output
+        self.job_reprocessed = {}
+        # SQS message id -> connection id named in the ingested object's metadata, and receive counts
+        self.ingestion_connection_ids = {}
+        self.ingestion_receive_counts = collections.Counter()
+        self.ingestion_dead_letters = []
+        # app job id -> times the state machine retried convert_text_to_audio for lack of Polly capacity
+        self.admission_retries = collections.Counter()
+        self.batch_ids = []
+
+        context = json.loads((ROOT_DIR / 'cdk.json').read_text())['context']
+        self.app_name = context['app-name']
+        self.ingestion_batch_size = int(context['ingestion-batch-size'])
+        self.textract_topic_arn = f'arn:aws:sns:{REGION}:{ACCOUNT_ID}:AmazonTextract-{self.app_name}'
+        self.polly_topic_arn = f'arn:aws:sns:{REGION}:{ACCOUNT_ID}:AmazonPolly-{self.app_name}'
+        self.state_machine_arn = f'arn:aws:states:{REGION}:{ACCOUNT_ID}:stateMachine:{self.app_name}-STATE-MACHINE'
+
+        self.page_counts = {}
+        # the fakes enforce quotas given on the command line, over them they throttle like the real services
+        self.aws = FakeAws(self.page_counts, args.lines_per_page, args.seed, args.columns, args.textract_quota, args.polly_quota)
+        # same tables as MainStack
+        self.aws.dynamodb.create_table(f'{self.app_name}Jobs', f'{self.app_name}JobId')
+        self.aws.dynamodb.create_table(f'{self.app_name}ResultCache', 'CacheKey')
+        self.aws.dynamodb.create_table(f'{self.app_name}Admission', 'Service')
+        self.aws.dynamodb.create_table(f'{self.app_name}Batches', 'BatchId')
+        self.aws.apigatewaymanagementapi.listeners.append(self._on_message)
+
+        os.environ.update({
+            'AWS_DEFAULT_REGION': REGION,
+            'APP_NAME': self.app_name,
+            'CONVERSION_API_ENDPOINT': 'benchmark',
+            'CONVERSION_API_REGION': REGION,
+            'S3_BUCKET': S3_BUCKET,
+            'TEXTRACT_SERVICE_ROLE': f'arn:aws:iam::{ACCOUNT_ID}:role/textract-service-role',
+            'POLLY_VOICE_ID': context['polly-voice-id'],
+            'POLLY_SPEECH_RATE': context['polly-speech-rate'],
+            'CONFIDENCE_LIMIT': context['confidence-limit'],
+            'RESULT_CACHE_TTL_DAYS': context['result-cache-ttl-days'],
+            'INGESTION_QUEUE_URL': INGESTION_QUEUE_URL,
+            'INGESTION_MAX_RECEIVE_COUNT': str(INGESTION_MAX_RECEIVE_COUNT),
+            'MAX_BATCH_DOCUMENTS': context['max-batch-documents'],
+            'TEXTRACT_MAX_IN_FLIGHT_JOBS': str(args.textract_quota or context['textract-max-in-flight-jobs']),
+            'POLLY_MAX_IN_FLIGHT_TASKS': str(args.polly_quota or context['polly-max-in-flight-tasks']),
+            # nothing completes while a handler waits in process, capacity only frees up between invocations
+            'POLLY_ADMISSION_WAIT_SECONDS': '0',
+            f'{self.app_name}_TEXTRACT_SNS_TOPIC_ARN': self.textract_topic_arn,
+            f'{self.app_name}_POLLY_SNS_TOPIC_ARN': self.polly_topic_arn,
+            f'{self.app_name}_STATE_MACHINE': self.state_machine_arn,
+        })
+
+        # every boto3 client/resource the handlers create talks to the fakes, including the ones
+        # the runtime layer creates from its own session
+        boto3.client = self.aws.client
+        boto3.resource = self.aws.resource
+        boto3.session.Session = lambda *args, **kwargs: self.aws
+        sys.path[:0] = [str(layer_dir) for layer_dir in LAYER_DIRS]
+        self.handlers = {name: self._load_handler(name, directory) for name, directory in HANDLERS.items()}
+        self.sns_subscriptions = {
+            self.textract_topic_arn: 'on_textract_ready',
+            self.polly_topic_arn: 'on_polly_ready',
+        }
+
+    @staticmethod
+    def _load_handler(name, directory):
+        spec = importlib.util.spec_from_file_location(name, LAMBDA_DIR / directory / f'{name}.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    def _on_message(self, connection_id, message):
+        if message.startswith('s3://'):
+            self.job_finished.setdefault(connection_id, time.perf_counter())
+        elif message.startswith('ERROR -'):
+            self.job_failed.add(connection_id)
+
+    def invoke(self, stage, event):
+        # payloads cross a JSON boundary between AWS services, so they do here too
+        event = json.loads(json.dumps(event))
+        trace_memory = tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')
+        if trace_memory:
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+
+        log = io.StringIO()
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(log if not self.args.verbose else sys.stdout):
+                result = self.handlers[stage].lambda_handler(event, LambdaContext(stage))
+        except Exception as e:
+            self.stage_errors[stage] += 1
+            if self.args.verbose:
+                raise
+            raise StageFailed(stage) from e
+        finally:
+            self.stage_latencies[stage].append(time.perf_counter() - start)
+            if trace_memory:
+                self.stage_memory_peaks[stage] = max(self.stage_memory_peaks[stage], tracemalloc.get_traced_memory()[1] - memory_before)
+
+        return json.loads(json.dumps(result)) if result is not None else None
+
+    def run_state_machine(self, execution_input):
+        # mirrors StepFunctionsStack._create_state_machine, LambdaInvoke puts the result under Payload
+        state = execution_input
+        if 'TextS3Key' not in execution_input.get('Payload', {}):
+            try:
+                state = {'Payload': self.invoke('retrieve_text', execution_input)}
+            except StageFailed as e:
+                self.catch(state, e)
+                raise
+        self.retry_on_admission_denied(state)
+
+    def retry_on_admission_denied(self, state):
+        # the state machine retries convert_text_to_audio with backoff, here it goes after the queued events
+        try:
+            self.invoke('convert_text_to_audio', state)
+        except StageFailed as e:
+            app_job_id = state['Payload'][f'{self.app_name}JobId']
+            if type(e.__cause__).__name__ != 'AdmissionDenied' or self.admission_retries[app_job_id] + 1 >= ADMISSION_MAX_ATTEMPTS:
+                self.catch(state, e)
+                raise
+            self.admission_retries[app_job_id] += 1
+            self.aws.events.append(('sfn-retry', 'convert_text_to_audio', state))
+
+    def catch(self, state, error):
+        # the catch of every task: on_job_failed gets the input of the failed step, with the error as Lambda reports it
+        cause = error.__cause__
+        self.invoke('on_job_failed', dict(state, Error={
+            'Error': type(cause).__name__,
+            'Cause': json.dumps({'errorMessage': str(cause), 'errorType': type(cause).__name__}),
+        }))
+
+    def build_corpus(self):
+        rng = random.Random(self.args.seed)
+        corpus = []
+        for index in range(self.args.documents):
+            app_job_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            suffix = '.png' if self.args.pages == 1 else '.pdf'
+            if corpus and rng.random() < self.args.duplicate_ratio:
+                # a re-upload of an earlier document, served from the result cache
+                content = self.aws.s3.objects[(S3_BUCKET, rng.choice(corpus)['Key'])]['Body']
+            else:
+                content = rng.getrandbits(8 * 1024 * self.args.document_kib).to_bytes(1024 * self.args.document_kib, 'big')
+                if suffix == '.png':
+                    content = build_png(content)
+            connection_id = f'connection-{index:05d}'
+            if self.args.ingest:
+                key, app_job_id = self.ingest(connection_id, f'document-{index:05d}{suffix}', content, index)
+            else:
+                key = self.upload(app_job_id, f'document-{index:05d}{suffix}', content)
+            job_key = f'{USER_ID}/{app_job_id}/images/{key.rsplit("/", 1)[1]}'
+            self.page_counts[(S3_BUCKET, job_key)] = self.args.pages
+            corpus.append({
+                'Bucket': S3_BUCKET,
+                'Key': key,
+                f'{self.app_name}JobId': app_job_id,
+                'UserId': USER_ID,
+                'ConnectionId': connection_id,
+                'ConfidenceLimit': self.args.confidence_limit,
+            })
+            if rng.random() < self.args.disconnect_ratio:
+                self.job_disconnected[connection_id] = f'{USER_ID}/{app_job_id}'
+                self.aws.apigatewaymanagementapi.gone_connection_ids.add(connection_id)
+        return corpus
+
+    def ingest(self, connection_id, file_name, content, index):
+        # what a batch uploader does, the object's metadata names the connection to follow the job on
+        key = f'{INGEST_PREFIX}{USER_ID}/{file_name}'
+        metadata = {
+            'connection-id': connection_id,
+        }
+        if self.args.confidence_limit:
+            metadata['confidence-limit'] = self.args.confidence_limit
+        self.aws.s3.put_object(Bucket=S3_BUCKET, Key=key, Body=content, ContentType='application/pdf', Metadata=metadata)
+        # the job id convert_images_to_text.ingest_object derives from the S3 event
+        sequencer = f'{index:016X}'
+        app_job_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f's3://{S3_BUCKET}/{key}#{sequencer}'))
+        return key, app_job_id
+
+    def build_ingestion_batches(self, corpus):
+        # one S3 event per SQS message, delivered in batches as the event source mapping does (see LambdaStack)
+        messages = []
+        for index, request in enumerate(corpus):
+            message_id = str(uuid.uuid4())
+            self.ingestion_connection_ids[message_id] = request['ConnectionId']
+            messages.append({
+                'messageId': message_id,
+                'eventSource': 'aws:sqs',
+                'attributes': {'ApproximateReceiveCount': '1'},
+                'body': json.dumps({
+                    'Records': [{
+                        'eventSource': 'aws:s3',
+                        'eventName': 'ObjectCreated:Put',
+                        's3': {
+                            'bucket': {'name': S3_BUCKET},
+                            'object': {'key': urllib.parse.quote_plus(request['Key'], safe='/'), 'sequencer': f'{index:016X}'},
+                        },
+                    }],
+                }),
+            })
+        return [{'Records': messages[index:index + self.ingestion_batch_size]} for index in range(0, len(messages), self.ingestion_batch_size)]
+
+    def build_batch_requests(self, corpus):
+        # what the web client sends on the WebSocket "batch" route for the documents it uploaded (see MainStack),
+        # each batch followed on a connection of its own
+        requests = []
+        for index in range(0, len(corpus), self.args.batch_size):
+            batch_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f'batch-{self.args.seed}-{index}'))
+            self.batch_ids.append(batch_id)
+            requests.append({
+                'BatchId': batch_id,
+                'Bucket': S3_BUCKET,
+                'Keys': [request['Key'] for request in corpus[index:index + self.args.batch_size]],
+                'UserId': USER_ID,
+                'ConfidenceLimit': self.args.confidence_limit,
+                'ConnectionId': f'batch-{index // self.args.batch_size:05d}',
+            })
+        return requests
+
+    def redeliver(self, messages, requeue):
+        # failed messages come back after the visibility timeout, until the queue sets them aside
+        retried = []
+        for message in messages:
+            self.ingestion_receive_counts[message['messageId']] += 1
+            if self.ingestion_receive_counts[message['messageId']] >= INGESTION_MAX_RECEIVE_COUNT:
+                self.ingestion_dead_letters.append(message['messageId'])
+                if message['messageId'] in self.ingestion_connection_ids:
+                    self.job_failed.add(self.ingestion_connection_ids[message['messageId']])
+            else:
+                retried.append(dict(message, attributes={
+                    'ApproximateReceiveCount': str(self.ingestion_receive_counts[message['messageId']] + 1),
+                }))
+        if retried:
+            requeue({'Records': retried})
+
+    def upload(self, app_job_id, file_name, content):
+        # what the web client does (see client/index.html): a presigned POST, or presigned parts and a complete call
+        upload = self.call_file_api('POST', '/uploads', {
+            'UserId': USER_ID,
+            f'{self.app_name}JobId': app_job_id,
+            'FileName': file_name,
+            'ContentType': 'application/pdf',
+            'Size': len(content),
+        })
+        if 'UploadId' not in upload:
+            self.aws.s3.send_presigned_post(upload['Fields'], content)
+            return upload['Key']
+
+        for index, part_url in enumerate(upload['PartUrls']):
+            self.aws.s3.send_presigned(part_url, content[index * upload['PartSize']:(index + 1) * upload['PartSize']])
+        self.call_file_api('POST', '/uploads/complete', {
+            'Key': upload['Key'],
+            'UploadId': upload['UploadId'],
+            'PartCount': len(upload['PartUrls']),
+        })
+        return upload['Key']
+
+    def call_file_api(self, method, resource, request):
+        # REST API proxy integration, see MainStack
+        response = self.invoke('file_session', {'httpMethod': method, 'resource': resource, 'body': json.dumps(request)})
+        if response['statusCode'] != 200:
+            raise RuntimeError(f'{method} {resource} failed: {response["body"]}')
+        return json.loads(response['body'])
+
+    def build_reprocess_requests(self):
+        # what reprocess-jobs.py sends for every finished job, with a connection to follow each one on
+        requests = []
+        for index, job in enumerate(self.aws.dynamodb.Table(f'{self.app_name}Jobs').items.values()):
+            if 'TextractOutputS3Key' in job:
+                connection_id = f'reprocess-{index:05d}'
+                self.job_reprocessed[connection_id] = job[f'{self.app_name}JobId']
+                requests.append({
+                    f'{self.app_name}JobId': job[f'{self.app_name}JobId'],
+                    'ConnectionId': connection_id,
+                })
+        return requests
+
+    def run(self):
+        if not self.args.no_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+
+        # same request the WebSocket $default route maps to the function (see MainStack), the "batch" route's,
+        # or the queued S3 events
+        corpus = self.build_corpus()
+        if self.args.batch_size:
+            self.drain('submit_batch', self.build_batch_requests(corpus))
+        else:
+            self.drain('convert_images_to_text', self.build_ingestion_batches(corpus) if self.args.ingest else corpus)
+        elapsed = time.perf_counter() - start
+        if self.args.reprocess:
+            self.drain('reprocess_job', self.build_reprocess_requests())
+        reprocess_elapsed = time.perf_counter() - start - elapsed
+
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return self.report(elapsed, reprocess_elapsed)
+
+    def drain(self, stage, requests):
+        requests = collections.deque(requests)
+        events = self.aws.events
+        while requests or events:
+            in_flight = len(self.job_started) - len(self.job_finished) - len(self.job_failed)
+            if requests and (in_flight < self.args.burst or not events):
+                request = requests.popleft()
+                if 'Records' in request:
+                    self.drain_ingestion_batch(stage, request, requests.append)
+                    continue
+                if request['ConnectionId'] not in self.job_disconnected:
+                    self.job_started[request['ConnectionId']] = time.perf_counter()
+                with contextlib.suppress(StageFailed):
+                    self.invoke(stage, request)
+                continue
+
+            kind, target, payload = events.popleft()
+            # a failed stage ends that job (or execution), the errors are counted per stage
+            with contextlib.suppress(StageFailed):
+                if kind == 'sns':
+                    self.complete_service_jobs(payload)
+                    self.invoke(self.sns_subscriptions[target], payload)
+                elif kind == 'sfn':
+                    self.run_state_machine(payload)
+                elif kind == 'sfn-retry':
+                    self.retry_on_admission_denied(payload)
+                elif kind == 'sqs':
+                    self.drain_ingestion_batch('convert_images_to_text', payload, lambda batch: events.append(('sqs', target, batch)))
+
+    def complete_service_jobs(self, payload):
+        # the job or task stops counting against the fake service's quota once its notification is out
+        for record in payload['Records']:
+            message = json.loads(record['Sns']['Message'])
+            self.aws.textract.in_flight_job_ids.discard(message.get('JobId'))
+            self.aws.polly.in_flight_task_ids.discard(message.get('taskId'))
+
+    def drain_ingestion_batch(self, stage, batch, requeue):
+        for message in batch['Records']:
+            # jobs deferred for lack of Textract capacity come back as messages of their own
+            connection_id = self.ingestion_connection_ids.get(message['messageId'])
+            if connection_id is not None and connection_id not in self.job_disconnected:
+                self.job_started.setdefault(connection_id, time.perf_counter())
+        try:
+            result = self.invoke(stage, batch)
+        except StageFailed:
+            # the whole batch is retried when the function fails
+            self.redeliver(batch['Records'], requeue)
+            return
+        failed_message_ids = {failure['itemIdentifier'] for failure in result['batchItemFailures']}
+        self.redeliver([message for message in batch['Records'] if message['messageId'] in failed_message_ids], requeue)
+
+    def report(self, elapsed, reprocess_elapsed):
+        end_to_end = sorted(
+            self.job_finished[connection_id] - started
+            for connection_id, started in self.job_started.items()
+            if connection_id in self.job_finished and connection_id not in self.job_reprocessed
+        )
+        # the final audio, whether single-task, stitched from parts or copied from the cache
+        audio_key_prefixes = tuple(f'{job_prefix}/audio/audio' for job_prefix in self.job_disconnected.values())
+        disconnected_completed = sum(
+            1 for bucket, key in self.aws.s3.objects if bucket == S3_BUCKET and key.startswith(audio_key_prefixes)
+        )
+        batches = [self.aws.dynamodb.Table(f'{self.app_name}Batches').items.get(batch_id, {}) for batch_id in self.batch_ids]
+        return {
+            'documents': self.args.documents,
+            'pages_per_document': self.args.pages,
+            'batches': len(self.batch_ids),
+            'batch_documents_completed': sum(int(batch.get('CompletedCount', 0)) for batch in batches),
+            'batch_documents_failed': sum(int(batch.get('FailedCount', 0)) for batch in batches),
+            'batch_manifests': sum(1 for batch in batches if 'ManifestS3Key' in batch),
+            'completed': len(end_to_end),
+            'failed': len(self.job_failed),
+            'disconnected': len(self.job_disconnected),
+            'disconnected_completed': disconnected_completed,
+            'ingestion_dead_letters': len(self.ingestion_dead_letters),
+            'reprocessed': len(self.job_reprocessed),
+            'reprocessed_completed': sum(1 for connection_id in self.job_reprocessed if connection_id in self.job_finished),
+            'reprocess_elapsed_seconds': reprocess_elapsed,
+            'elapsed_seconds': elapsed,
+            # a batch is followed as one job, its documents are what gets converted
+            'jobs_per_second': (sum(int(batch.get('CompletedCount', 0)) for batch in batches) if batches else len(end_to_end)) / elapsed if elapsed else 0.0,
+            'polly_request_characters': self.aws.polly.request_characters,
+            'textract_peak_in_flight_jobs': self.aws.textract.peak_in_flight_jobs,
+            'textract_throttled_requests': self.aws.textract.throttled_requests,
+            'textract_deferred_jobs': self.aws.sqs.sent_messages,
+            'polly_peak_in_flight_tasks': self.aws.polly.peak_in_flight_tasks,
+            'polly_throttled_requests': self.aws.polly.throttled_requests,
+            'polly_admission_retries': sum(self.admission_retries.values()),
+            'end_to_end_ms': percentiles(end_to_end),
+            'stages': {
+                stage: dict(
+                    percentiles(sorted(latencies)),
+                    invocations=len(latencies),
+                    errors=self.stage_errors[stage],
+                    memory_peak_kib=self.stage_memory_peaks[stage] / 1024 if stage in self.stage_memory_peaks else None,
+                )
+                for stage, latencies in self.stage_latencies.items()
+            },
+        }
+
+
+def build_png(padding, size=100):
+    # a blank image img2pdf can convert, with the random bytes in an ancillary chunk giving the file its size
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 0, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress((b'\x00' + b'\xff' * size) * size)),
+        chunk(b'pdDg', padding),
+        chunk(b'IEND', b''),
+    ])
+
+def percentiles(sorted_seconds):
+    if not sorted_seconds:
+        return {'p50': None, 'p90': None, 'p99': None, 'max': None}
+
+    def nearest_rank(p):
+        return sorted_seconds[min(len(sorted_seconds) - 1, int(p / 100 * len(sorted_seconds)))] * 1000
+
+    return {'p50': nearest_rank(50), 'p90': nearest_rank(90), 'p99': nearest_rank(99), 'max': sorted_seconds[-1] * 1000}
+
+
+def print_report(report):
+    def ms(value):
+        return f'{value:9.2f}' if value is not None else f'{"-":>9}'
+
+    if report['batches']:
+        print(f'{report["completed"]} of {report["batches"]} batches of {report["documents"]} documents ({report["pages_per_document"]} pages each) completed with {report["batch_manifests"]} manifests, {report["failed"]} failed')
+        print(f'{report["batch_documents_completed"]} documents converted, {report["batch_documents_failed"]} failed')
+    else:
+        print(f'{report["completed"]} of {report["documents"]} documents ({report["pages_per_document"]} pages each) completed, {report["failed"]} failed')
+    if report['ingestion_dead_letters']:
+        print(f'{report["ingestion_dead_letters"]} ingested documents set aside in the dead-letter queue')
+    if report['disconnected']:
+        print(f'{report["disconnected_completed"]} of {report["disconnected"]} documents of disconnected users completed')
+    if report['reprocessed']:
+        print(f'{report["reprocessed_completed"]} of {report["reprocessed"]} finished documents reprocessed from their stored Textract output in {report["reprocess_elapsed_seconds"]:.2f} s')
+    print(f'{report["jobs_per_second"]:.2f} jobs/s over {report["elapsed_seconds"]:.2f} s')
+    print(f'{report["polly_request_characters"]} characters billed by Polly')
+    print(f'Textract: {report["textract_peak_in_flight_jobs"]} jobs in flight at most, {report["textract_deferred_jobs"]} deferrals, {report["textract_throttled_requests"]} throttled requests')
+    print(f'Polly: {report["polly_peak_in_flight_tasks"]} tasks in flight at most, {report["polly_admission_retries"]} retries, {report["polly_throttled_requests"]} throttled requests')
+    print(f'end-to-end ms    p50 {ms(report["end_to_end_ms"]["p50"])}  p90 {ms(report["end_to_end_ms"]["p90"])}  p99 {ms(report["end_to_end_ms"]["p99"])}')
+    print()
+    print(f'{"stage":<24}{"calls":>7}{"errors":>7}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}{"peak KiB":>11}')
+    for stage, stats in report['stages'].items():
+        peak = f'{stats["memory_peak_kib"]:11.1f}' if stats['memory_peak_kib'] is not None else f'{"-":>11}'
+        print(f'{stage:<24}{stats["invocations"]:>7}{stats["errors"]:>7} {ms(stats["p50"])} {ms(stats["p90"])} {ms(stats["p99"])} {ms(stats["max"])}{peak}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the image-to-speech pipeline locally with in-memory AWS services.')
+    parser.add_argument('--documents', type=int, default=50, help='number of synthetic documents to convert')
+    parser.add_argument('--pages', type=int, default=3, help='pages per document, 1 sends PNGs through the synchronous Textract path')
+    parser.add_argument('--document-kib', type=int, default=4, help='size of each uploaded file, over 8 MiB they go up in parts')
+    parser.add_argument('--lines-per-page', type=int, default=40, help='text lines Textract reports per page')
+    parser.add_argument('--columns', type=int, default=1, help='text columns per page, Textract lists their lines row by row')
+    parser.add_argument('--confidence-limit', default='', help='sent with every request, a number or auto (default: the one in cdk.json)')
+    parser.add_argument('--burst', type=int, default=1, help='jobs submitted before their completions are processed')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0, help='share of documents that re-upload an earlier one')
+    parser.add_argument('--disconnect-ratio', type=float, default=0.0, help='share of users whose WebSocket connection is gone')
+    parser.add_argument('--ingest', action='store_true', help='put the documents under ingest/ and deliver their S3 events in SQS batches')
+    parser.add_argument('--batch-size', type=int, default=0, help='submit the uploaded documents in batches of this many, each followed on one connection')
+    parser.add_argument('--textract-quota', type=int, help='asynchronous Textract jobs in flight, admitted and enforced by the fake (default: the one in cdk.json, not enforced)')
+    parser.add_argument('--polly-quota', type=int, help='Polly synthesis tasks in flight, admitted and enforced by the fake (default: the one in cdk.json, not enforced)')
+    parser.add_argument('--reprocess', action='store_true', help='then rebuild every finished document from its stored Textract output')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc, which slows every stage down')
+    parser.add_argument('--json', metavar='FILE', help='also write the report as JSON, e.g. to compare two runs')
+    parser.add_argument('--verbose', action='store_true', help='show handler output and stop at the first error')
+    args = parser.parse_args()
+    if args.batch_size and args.ingest:
+        parser.error('--batch-size submits uploaded documents, not ingested ones')
+
+    report = Pipeline(args).run()
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,106 +1,650 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
-import datetime
+import hashlib
+import json
 import os
 import pathlib
+import tempfile
+import time
+import urllib.parse
+import uuid
+import zipfile
 
 import img2pdf
 
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+import admission
+
+from app_runtime import lazy_client, lazy_table, log_cold_start, notify_user, with_notifications
+from batches import record_document_outcome
+from confidence import apply_confidence_limit, format_confidence_limit, parse_confidence_limit
+from metrics import BYTES, MILLISECONDS, Metrics, elapsed_ms, utc_now, with_metrics
+from moderation import get_lexicon, get_lexicon_version, read_moderated_lines
+from reading_order import LineBlocks, iter_ordered_lines
+from textract_output import TextractOutputWriter, get_textract_output_s3_key
+
 
 APP_NAME = os.environ['APP_NAME']
+S3_BUCKET = os.environ['S3_BUCKET']
 TEXTRACT_SERVICE_ROLE_ARN = os.environ['TEXTRACT_SERVICE_ROLE']
 
-CONVERSION_API_ENDPOINT = os.environ['CONVERSION_API_ENDPOINT']
 CONVERSION_API_REGION = os.environ['CONVERSION_API_REGION']
-apig_management_client = boto3.client(
-    'apigatewaymanagementapi',
-    endpoint_url=f'https://{CONVERSION_API_ENDPOINT}.execute-api.{CONVERSION_API_REGION}.amazonaws.com/prod',
-)
+# jobs Textract has no capacity for wait here, see defer_job, and so do the documents of a batch
+INGESTION_QUEUE_URL = os.environ['INGESTION_QUEUE_URL']
+# receives before a message goes to the dead-letter queue, see S3Stack
+INGESTION_MAX_RECEIVE_COUNT = int(os.environ['INGESTION_MAX_RECEIVE_COUNT'])
+DEFERRAL_BASE_SECONDS = 5
+DEFERRAL_MAX_SECONDS = 300
+# the input is gone, invalid or not supported, every receive of the message would fail the same way
+TERMINAL_ERROR_CODES = ('NoSuchKey', '404', 'InvalidS3ObjectException', 'UnsupportedDocumentException', 'BadDocumentException', 'DocumentTooLargeException')
+
+ddb_table = lazy_table(f'{APP_NAME}Jobs')
+ddb_result_cache_table = lazy_table(f'{APP_NAME}ResultCache')
 
-ddb_table = boto3.resource('dynamodb').Table(f'{APP_NAME}Jobs')
+# settings that change the text or audio produced for the same input file, part of the cache key
+POLLY_VOICE_ID = os.environ['POLLY_VOICE_ID']
+POLLY_SPEECH_RATE = os.environ['POLLY_SPEECH_RATE']
+CONFIDENCE_LIMIT = os.environ['CONFIDENCE_LIMIT']  # unless the request comes with its own
+RESULT_CACHE_TTL_SECONDS = int(os.environ['RESULT_CACHE_TTL_DAYS']) * 24 * 60 * 60
+RESULT_CACHE_STATS_KEY = '#stats'
 
-textract_client = boto3.client(
-    service_name = 'textract',
-    region_name = CONVERSION_API_REGION,
+IMAGE_FILE_SUFFIXES = ('.jpg', '.png', '.tif', '.tiff')
+# inputs that can only hold one page, TIFFs may hold several
+SINGLE_PAGE_FILE_SUFFIXES = ('.jpg', '.png')
+# the largest image the synchronous Textract API takes, larger ones are converted to PDF
+MAX_SYNC_DOCUMENT_BYTES = 10 * 1024 * 1024
+# img2pdf holds every image it embeds until the PDF is written, so the images of one PDF are capped
+# to what fits the function's memory (see LambdaStack); the archive and the PDF itself go to /tmp
+MAX_PDF_IMAGES = 200
+MAX_PDF_INPUT_BYTES = 200 * 1024 * 1024
+PDF_UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
 )
 
-s3_client = boto3.client('s3')
+textract_client = lazy_client('textract', region_name=CONVERSION_API_REGION)
 
+s3_client = lazy_client('s3')
+sfn_client = lazy_client('stepfunctions')
+sqs_client = lazy_client('sqs')
 
+metrics = Metrics('convert_images_to_text')
+
+
+@log_cold_start
+@with_notifications
+@with_metrics(metrics)
 def lambda_handler(event, context):
+    # the ingestion queue delivers S3 events in batches, the WebSocket API one request at a time
+    if 'Records' in event:
+        return ingest_records(event['Records'])
+
     try:
         invoke_textract(event)
     except Exception:
         notify_user('ERROR - Failed to convert file', event['ConnectionId'])
         raise
 
+def ingest_records(sqs_records):
+    # one at a time, so the event source's maximum concurrency bounds how many jobs start at once;
+    # messages that failed for a transient reason go back to the queue and end up in the dead-letter queue
+    batch_item_failures = []
+    for sqs_record in sqs_records:
+        try:
+            body = json.loads(sqs_record['body'])
+            queued_job = get_queued_job(body)
+            if queued_job:
+                invoke_queued_job(queued_job)
+                continue
+            # S3 sends a test event when the notification is set up
+            for s3_record in body.get('Records', []):
+                ingest_object(s3_record['s3']['bucket']['name'], urllib.parse.unquote_plus(s3_record['s3']['object']['key']), s3_record['s3']['object'].get('sequencer', ''), s3_record.get('eventTime'))
+        except Exception as e:
+            print(f'Failed to ingest SQS message {sqs_record.get("messageId")}: {e!r}')
+            if is_terminal_error(e):
+                record_failed_message(sqs_record)
+                continue
+            batch_item_failures.append({
+                'itemIdentifier': sqs_record['messageId'],
+            })
+            if int(sqs_record['attributes']['ApproximateReceiveCount']) >= INGESTION_MAX_RECEIVE_COUNT:
+                record_failed_message(sqs_record)
+
+    return {
+        'batchItemFailures': batch_item_failures,
+    }
+
+def ingest_object(bucket_name, key, sequencer, event_time):
+    # ingest/{user_id}/<file name>; an uploader with a WebSocket open can name it
+    # in the object's connection-id metadata, and a confidence limit in confidence-limit
+    _, user_id, file_name = key.split('/', 2)
+    file_name = pathlib.PurePath(file_name).name
+
+    # the same object delivered twice maps to the same job, which is only started once
+    app_job_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f's3://{bucket_name}/{key}#{sequencer}'))
+    if get_started_job(app_job_id):
+        print(f'App Job {app_job_id} was already started for s3://{bucket_name}/{key}.')
+        return
+
+    # the job works on a copy where the WebSocket API's jobs keep their input,
+    # so the PDF convert_to_pdf writes next to it does not land in ingest/ and start another job
+    input_file_s3_key = f'{user_id}/{app_job_id}/images/{file_name}'
+    s3_client.copy_object(
+        CopySource={
+            'Bucket': bucket_name,
+            'Key': key,
+        },
+        Bucket=bucket_name,
+        Key=input_file_s3_key,
+    )
+    s3_resp = s3_client.head_object(
+        Bucket=bucket_name,
+        Key=input_file_s3_key,
+    )
+    print(f'Ingesting s3://{bucket_name}/{key} as App Job {app_job_id}.')
+    invoke_textract({
+        'Bucket': bucket_name,
+        'Key': input_file_s3_key,
+        f'{APP_NAME}JobId': app_job_id,
+        'UserId': user_id,
+        'ConnectionId': s3_resp['Metadata'].get('connection-id'),
+        'ConfidenceLimit': s3_resp['Metadata'].get('confidence-limit'),
+        'QueuedTime': event_time,
+    })
+
+def get_queued_job(body):
+    # messages sent before QueuedJob replaced DeferredJob may still be in the queue, drop the old name in the next release
+    return body.get('QueuedJob') or body.get('DeferredJob')
+
+def invoke_queued_job(event):
+    # deferred by defer_job or sent by submit_batch
+    app_job_id = event[f'{APP_NAME}JobId']
+    started_job = get_started_job(app_job_id)
+    if started_job:
+        print(f'App Job {app_job_id} was already started.')
+        # a key of an earlier batch or job, which is not going to report to this batch
+        if started_job.get('BatchId') != event.get('BatchId'):
+            record_document_outcome(event.get('BatchId'), app_job_id, error=f'App Job {app_job_id} was already started')
+        return
+    invoke_textract(event)
+
+def is_terminal_error(error):
+    # ValueError is what convert_to_pdf and check_pdf_input raise for an input they cannot convert
+    if isinstance(error, ClientError):
+        return error.response['Error']['Code'] in TERMINAL_ERROR_CODES
+    return isinstance(error, ValueError)
+
+def record_failed_message(sqs_record):
+    # the message is not coming back, the batch it belongs to would otherwise never finish
+    # and the user would keep waiting, their last message may be that the job is queued
+    try:
+        body = json.loads(sqs_record['body'])
+        event = get_queued_job(body)
+        if event:
+            notify_user('ERROR - Failed to convert file', event.get('ConnectionId'))
+            record_document_outcome(event.get('BatchId'), event.get(f'{APP_NAME}JobId'), error='Failed to convert file')
+        for s3_record in body.get('Records', []):
+            notify_user('ERROR - Failed to convert file', get_uploader_connection_id(s3_record['s3']['bucket']['name'], urllib.parse.unquote_plus(s3_record['s3']['object']['key'])))
+    except Exception as e:
+        print(f'Failed to record the outcome of SQS message {sqs_record.get("messageId")}: {e!r}')
+
+def get_uploader_connection_id(bucket_name, key):
+    # the connection-id metadata of an object under ingest/, see ingest_object
+    try:
+        s3_resp = s3_client.head_object(
+            Bucket=bucket_name,
+            Key=key,
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return None
+    return s3_resp['Metadata'].get('connection-id')
+
+def get_started_job(app_job_id):
+    item = ddb_table.get_item(
+        Key={
+            f'{APP_NAME}JobId': app_job_id,
+        },
+        ConsistentRead=True,
+    ).get('Item')
+    # a synchronous job whose execution may not have started is taken over, see detect_text_synchronously
+    if item is None or item.get('ExecutionPending'):
+        return None
+    return item
+
+def defer_job(event):
+    # comes back through ingest_records after a jittered delay, which grows every time the job is deferred
+    attempt = event.get('AdmissionAttempt', 0)
+    delay_seconds = int(admission.backoff_delay(attempt, DEFERRAL_BASE_SECONDS, DEFERRAL_MAX_SECONDS))
+    sqs_client.send_message(
+        QueueUrl=INGESTION_QUEUE_URL,
+        MessageBody=json.dumps({
+            # the queue wait of the job counts from the first time it was queued
+            'QueuedJob': dict(event, AdmissionAttempt=attempt + 1, QueuedTime=event.get('QueuedTime') or utc_now()),
+        }),
+        DelaySeconds=delay_seconds,
+    )
+    print(f'Deferred App Job {event[f"{APP_NAME}JobId"]} by {delay_seconds} s (attempt {attempt + 1}).')
+    metrics.put('DeferredJobs', 1)
+    if attempt == 0:
+        notify_user('Textract is at capacity, the job is queued', event['ConnectionId'])
 
 def invoke_textract(event):
-    start_time_utc = datetime.datetime.utcnow().isoformat()
+    # one metrics record per job, several jobs may come in one invocation
+    try:
+        return start_text_detection(event)
+    finally:
+        metrics.flush(**{f'{APP_NAME}JobId': event[f'{APP_NAME}JobId'], 'BatchId': event.get('BatchId')})
+
+def start_text_detection(event):
+    start_time_utc = utc_now()
+    # submitted by submit_batch, deferred by defer_job or created under ingest/
+    metrics.put('QueueWaitMs', elapsed_ms(event.get('QueuedTime'), start_time_utc), MILLISECONDS)
 
     sns_topic_arn = os.environ[f'{APP_NAME}_TEXTRACT_SNS_TOPIC_ARN']
 
+    app_job_id = event[f'{APP_NAME}JobId']
+    bucket_name = event['Bucket']
+    confidence_limit = parse_confidence_limit(event.get('ConfidenceLimit'), CONFIDENCE_LIMIT)
+
+    cache_key, input_bytes = compute_cache_key(bucket_name, event['Key'], confidence_limit)
+    if serve_from_cache(cache_key, event, start_time_utc):
+        return None
+
+    if pathlib.PurePath(event['Key']).suffix.lower() in SINGLE_PAGE_FILE_SUFFIXES and input_bytes <= MAX_SYNC_DOCUMENT_BYTES:
+        notify_user('Invoking Textract', event['ConnectionId'])
+        return detect_text_synchronously(event, cache_key, start_time_utc, confidence_limit)
+
+    # the lease is given back by on_textract_ready when the job's notification arrives
+    try:
+        admission.acquire(admission.TEXTRACT, app_job_id)
+    except admission.AdmissionDenied:
+        defer_job(event)
+        return None
+
     notify_user('Invoking Textract', event['ConnectionId'])
+    try:
+        with metrics.timer('PdfConversionMs'):
+            input_file_s3_key = convert_to_pdf(event['Key'], bucket_name)
+        resp = textract_client.start_document_text_detection(
+            DocumentLocation={
+                'S3Object': {
+                    'Bucket': bucket_name,
+                    'Name': input_file_s3_key,
+                },
+            },
+            NotificationChannel={
+                'RoleArn': TEXTRACT_SERVICE_ROLE_ARN,
+                'SNSTopicArn': sns_topic_arn,
+            },
+            JobTag=app_job_id,  # returned in the completion notification, see on_textract_ready
+        )
+    except Exception as e:
+        admission.release(admission.TEXTRACT, app_job_id)
+        # the quota in cdk.json is above what the account gets
+        if admission.is_throttling_error(e):
+            print(f'Textract throttled App Job {app_job_id}: {e!r}')
+            defer_job(event)
+            return None
+        raise
 
+    ddb_table.put_item(
+        Item={
+            f'{APP_NAME}JobId': app_job_id,
+            'UserId': event['UserId'],
+            'StartTime': start_time_utc,
+            'ConnectionId':  event['ConnectionId'],
+            'TextractJobId': resp['JobId'],
+            'InputFile': os.path.basename(input_file_s3_key),
+            'CacheKey': cache_key,
+            'ConfidenceLimit': format_confidence_limit(confidence_limit),  # passed on to retrieve_text
+            'TextractStartTime': utc_now(),
+            **get_queued_time_attributes(event),
+            **get_batch_attributes(event),
+        },
+    )
+
+    return resp
+
+def detect_text_synchronously(event, cache_key, start_time_utc, confidence_limit):
+    # a single page fits the synchronous API, which takes JPEG/PNG as they are and needs
+    # neither img2pdf, nor the SNS notification, nor the retrieve_text step
     app_job_id = event[f'{APP_NAME}JobId']
+    user_id = event['UserId']
     bucket_name = event['Bucket']
-    input_file_s3_key = convert_to_pdf(event['Key'], app_job_id, bucket_name)
 
-    resp = textract_client.start_document_text_detection(
-        DocumentLocation={
-            'S3Object': {
-                'Bucket': bucket_name,
-                'Name': input_file_s3_key,
+    textract_start_time_utc = utc_now()
+    with metrics.timer('TextractMs'):
+        resp = textract_client.detect_document_text(
+            Document={
+                'S3Object': {
+                    'Bucket': bucket_name,
+                    'Name': event['Key'],
+                },
+            },
+        )
+    metrics.put('TextractPages', resp['DocumentMetadata']['Pages'])
+    textract_output_writer = TextractOutputWriter()
+    line_blocks_chunks, confidence_report = apply_confidence_limit(
+        textract_output_writer.record([LineBlocks(resp['Blocks'])]),
+        confidence_limit,
+    )
+    # the lines are ordered while they are moderated
+    with metrics.timer('ModerationMs', exclude=['RetrievalMs']):
+        extracted_lines, undesirable_phrase = read_moderated_lines(
+            metrics.timed(iter_ordered_lines(line_blocks_chunks, confidence_report.confidence_limit), 'RetrievalMs'),
+            get_lexicon(S3_BUCKET),
+        )
+    if undesirable_phrase:
+        print(f'Undesirable phrase "{undesirable_phrase.phrase}" at line {undesirable_phrase.line}, column {undesirable_phrase.column} of App Job {app_job_id}')
+        notify_user('ERROR - Text moderation failed', event['ConnectionId'])
+        record_document_outcome(event.get('BatchId'), app_job_id, error='Text moderation failed')
+        return None
+
+    text_s3_key = f'{user_id}/{app_job_id}/text/text.txt'
+    text = '\n'.join(extracted_lines).encode('utf-8')
+    metrics.put('LineCount', len(extracted_lines))
+    metrics.put('TextBytes', len(text), BYTES)
+    with metrics.timer('StorageMs'):
+        s3_client.put_object(
+            Body=text,
+            Bucket=bucket_name,
+            Key=text_s3_key,
+        )
+        # kept for reprocess_job, in the bucket retrieve_text reads it back from
+        textract_output_s3_key = get_textract_output_s3_key(user_id, app_job_id)
+        textract_output_writer.upload(S3_BUCKET, textract_output_s3_key)
+
+    try:
+        ddb_table.put_item(
+            Item={
+                f'{APP_NAME}JobId': app_job_id,
+                'UserId': user_id,
+                'StartTime': start_time_utc,
+                'ConnectionId':  event['ConnectionId'],
+                'TextractMode': 'SYNC',
+                'InputFile': os.path.basename(event['Key']),
+                'CacheKey': cache_key,
+                'ConfidenceLimit': format_confidence_limit(confidence_limit),
+                'TextractOutputS3Key': textract_output_s3_key,
+                'TextractStartTime': textract_start_time_utc,
+                'TextRetrievedTime': utc_now(),
+                **confidence_report.to_item_attributes(),
+                **get_queued_time_attributes(event),
+                **get_batch_attributes(event),
+                # until the execution is started, a retry of the job runs it again instead of skipping it
+                'ExecutionPending': True,
             },
+            ConditionExpression=f'attribute_not_exists({APP_NAME}JobId)',
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        # written by the attempt that is taken over, its execution may already have updated the job
+        print(f'App Job {app_job_id} is taken over.')
+
+    notify_user('Text retrieved from Textract', event['ConnectionId'])
+    if confidence_report.dropped_line_count:
+        notify_user(confidence_report.summary(), event['ConnectionId'])
+    notify_user('Text moderation succeeded', event['ConnectionId'])
+    notify_user('Text stored to S3', event['ConnectionId'])
+
+    # same shape as the retrieve_text output, the state machine skips that step when it sees TextS3Key;
+    # named after the job, so a retry that gets here again does not start a second execution
+    try:
+        sfn_client.start_execution(
+            stateMachineArn=os.environ[f'{APP_NAME}_STATE_MACHINE'],
+            name=app_job_id,
+            input=json.dumps({
+                'Payload': {
+                    'TextS3Bucket': bucket_name,
+                    'TextS3Key': text_s3_key,
+                    f'{APP_NAME}JobId': app_job_id,
+                    'ConnectionId': event['ConnectionId'],
+                    'UserId': user_id,
+                    'InputFile': os.path.basename(event['Key']),
+                    'BatchId': event.get('BatchId'),
+                },
+            }),
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ExecutionAlreadyExists':
+            raise
+        print(f'The execution of App Job {app_job_id} was already started.')
+
+    ddb_table.update_item(
+        Key={
+            f'{APP_NAME}JobId': app_job_id,
+        },
+        UpdateExpression='REMOVE ExecutionPending',
+    )
+
+    return resp
+
+def compute_cache_key(bucket_name, input_file_s3_key, confidence_limit):
+    if input_file_s3_key.endswith('/'):
+        input_file_s3_keys = [image_object['Key'] for image_object in list_image_objects(bucket_name, input_file_s3_key)]
+    else:
+        input_file_s3_keys = [input_file_s3_key]
+
+    # the size of the input comes along, it decides whether the synchronous API can take it
+    content_hash = hashlib.sha256()
+    input_bytes = 0
+    for key in input_file_s3_keys:
+        s3_resp = s3_client.get_object(
+            Bucket=bucket_name,
+            Key=key,
+        )
+        for data in s3_resp['Body'].iter_chunks():
+            content_hash.update(data)
+            input_bytes += len(data)
+    metrics.put('InputBytes', input_bytes, BYTES)
+
+    return f'{content_hash.hexdigest()}/{POLLY_VOICE_ID}/{POLLY_SPEECH_RATE}/{format_confidence_limit(confidence_limit)}/{get_lexicon_version(S3_BUCKET)}', input_bytes
+
+def serve_from_cache(cache_key, event, start_time_utc):
+    now = int(time.time())
+    cache_item = ddb_result_cache_table.get_item(
+        Key={
+            'CacheKey': cache_key,
+        },
+    ).get('Item')
+
+    # DynamoDB deletes expired items lazily, so the TTL is checked here as well
+    if cache_item is None or cache_item['ExpiresAt'] <= now:
+        count_cache_lookup('Misses')
+        return False
+
+    user_id = event['UserId']
+    app_job_id = event[f'{APP_NAME}JobId']
+    bucket_name = event['Bucket']
+    audio_s3_key = f'{user_id}/{app_job_id}/audio/{os.path.basename(cache_item["AudioS3Key"])}'
+
+    try:
+        s3_client.copy_object(
+            CopySource={
+                'Bucket': cache_item['TextS3Bucket'],
+                'Key': cache_item['TextS3Key'],
+            },
+            Bucket=bucket_name,
+            Key=f'{user_id}/{app_job_id}/text/text.txt',
+        )
+        s3_client.copy_object(
+            CopySource={
+                'Bucket': cache_item['AudioS3Bucket'],
+                'Key': cache_item['AudioS3Key'],
+            },
+            Bucket=bucket_name,
+            Key=audio_s3_key,
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        # the cached outputs were deleted, evict the entry and run the pipeline again
+        ddb_result_cache_table.delete_item(
+            Key={
+                'CacheKey': cache_key,
+            },
+        )
+        count_cache_lookup('Misses')
+        return False
+
+    # sliding expiration, entries in use stay cached
+    ddb_result_cache_table.update_item(
+        Key={
+            'CacheKey': cache_key,
         },
-        NotificationChannel={
-            'RoleArn': TEXTRACT_SERVICE_ROLE_ARN,
-            'SNSTopicArn': sns_topic_arn,
+        UpdateExpression='SET ExpiresAt = :expires_at ADD HitCount :one',
+        ExpressionAttributeValues={
+            ':expires_at': now + RESULT_CACHE_TTL_SECONDS,
+            ':one': 1,
         },
     )
+    count_cache_lookup('Hits')
 
     ddb_table.put_item(
         Item={
             f'{APP_NAME}JobId': app_job_id,
-            'UserId': event['UserId'],
+            'UserId': user_id,
             'StartTime': start_time_utc,
             'ConnectionId':  event['ConnectionId'],
-            'TextractJobId': resp['JobId'],
-            'InputFile': os.path.basename(input_file_s3_key),
+            'InputFile': os.path.basename(event['Key'].rstrip('/')),
+            'CacheKey': cache_key,
+            'CacheHit': True,
+            'AudioReadyTime': utc_now(),
+            **get_queued_time_attributes(event),
+            **get_batch_attributes(event),
         },
     )
 
-    return resp
+    notify_user('Result found in cache', event['ConnectionId'])
+    notify_user(f'Polly output is ready for App Job {app_job_id}', event['ConnectionId'])
+    notify_user(f's3://{bucket_name}/{audio_s3_key}', event['ConnectionId'])
+    record_document_outcome(event.get('BatchId'), app_job_id, audio_output_file_uri=f's3://{bucket_name}/{audio_s3_key}')
+    return True
+
+def get_queued_time_attributes(event):
+    # QueueWaitMs of the job, on_polly_ready measures its end-to-end time from there
+    if event.get('QueuedTime'):
+        return {'QueuedTime': event['QueuedTime']}
+    return {}
+
+def get_batch_attributes(event):
+    # jobs of a batch report their outcome to it, see on_polly_ready and on_job_failed
+    if event.get('BatchId'):
+        return {'BatchId': event['BatchId']}
+    return {}
+
+def count_cache_lookup(counter_name):
+    metrics.put(f'Cache{counter_name}', 1)
+    ddb_result_cache_table.update_item(
+        Key={
+            'CacheKey': RESULT_CACHE_STATS_KEY,
+        },
+        UpdateExpression='ADD #counter_name :one',
+        ExpressionAttributeNames={
+            '#counter_name': counter_name,
+        },
+        ExpressionAttributeValues={
+            ':one': 1,
+        },
+    )
+
+def convert_to_pdf(input_file_s3_key, bucket_name):
+    # a key ending with / is a prefix holding one image per page
+    if input_file_s3_key.endswith('/'):
+        new_input_file_s3_key = f'{input_file_s3_key.rstrip("/")}.pdf'
+        image_objects = list_image_objects(bucket_name, input_file_s3_key)
+        check_pdf_input(input_file_s3_key, [image_object['Size'] for image_object in image_objects])
+        upload_as_pdf([S3Image(bucket_name, image_object['Key']) for image_object in image_objects], bucket_name, new_input_file_s3_key)
+        return new_input_file_s3_key
 
-def convert_to_pdf(input_file_s3_key, app_job_id, bucket_name):
     input_file_suffix_lower = pathlib.PurePath(input_file_s3_key).suffix.lower()
+    new_input_file_s3_key = str(pathlib.PurePath(input_file_s3_key).with_suffix('.pdf'))
 
     # TODO use S3 object type instead?
     if input_file_suffix_lower == '.pdf':
         return input_file_s3_key
-    elif input_file_suffix_lower in ('.jpg', '.png'):
-        new_input_file_s3_key = str(pathlib.PurePath(input_file_s3_key).with_suffix('.pdf'))
-
+    elif input_file_suffix_lower in IMAGE_FILE_SUFFIXES:
+        # img2pdf turns every frame of a multi-page TIFF into its own page
         s3_resp = s3_client.get_object(
             Bucket=bucket_name,
             Key=input_file_s3_key,
         )
-        with open(f'/tmp/input-file-{app_job_id}.pdf', 'wb') as f:
-	        f.write(img2pdf.convert(s3_resp['Body']))
-
-        s3_client.upload_file(
-            Filename=f'/tmp/input-file-{app_job_id}.pdf',
+        check_pdf_input(input_file_s3_key, [s3_resp['ContentLength']])
+        upload_as_pdf([s3_resp['Body']], bucket_name, new_input_file_s3_key)
+        return new_input_file_s3_key
+    elif input_file_suffix_lower == '.zip':
+        # zipfile needs to seek, so the archive is downloaded to /tmp first
+        s3_resp = s3_client.get_object(
             Bucket=bucket_name,
-            Key=new_input_file_s3_key,
+            Key=input_file_s3_key,
         )
+        with tempfile.TemporaryFile() as zip_buffer:
+            for data in s3_resp['Body'].iter_chunks(1024 * 1024):
+                zip_buffer.write(data)
+            with zipfile.ZipFile(zip_buffer) as zip_file:
+                image_infos = sorted(
+                    (info for info in zip_file.infolist() if pathlib.PurePath(info.filename).suffix.lower() in IMAGE_FILE_SUFFIXES),
+                    key=lambda info: info.filename,
+                )
+                if not image_infos:
+                    raise ValueError(f'No supported image files in {input_file_s3_key}')
+                check_pdf_input(input_file_s3_key, [info.file_size for info in image_infos])
+                upload_as_pdf([zip_file.open(info) for info in image_infos], bucket_name, new_input_file_s3_key)
         return new_input_file_s3_key
     else:
         raise ValueError(f'Input file type not supported: {input_file_suffix_lower}')
 
-def notify_user(message, connection_id):
-    apig_response = apig_management_client.post_to_connection(
-        Data=message,
-        ConnectionId=connection_id,
-    )
+def list_image_objects(bucket_name, prefix):
+    image_objects = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+        for s3_object in page.get('Contents', []):
+            if pathlib.PurePath(s3_object['Key']).suffix.lower() in IMAGE_FILE_SUFFIXES:
+                image_objects.append(s3_object)
+
+    if not image_objects:
+        raise ValueError(f'No supported image files under {prefix}')
+
+    # pages are ordered by key, e.g. page-001.png, page-002.png, ...
+    return sorted(image_objects, key=lambda s3_object: s3_object['Key'])
+
+def check_pdf_input(input_file_s3_key, image_sizes):
+    if len(image_sizes) > MAX_PDF_IMAGES or sum(image_sizes) > MAX_PDF_INPUT_BYTES:
+        raise ValueError(f'{input_file_s3_key} has {len(image_sizes)} images of {sum(image_sizes)} bytes, more than the {MAX_PDF_IMAGES} images of {MAX_PDF_INPUT_BYTES} bytes one PDF takes.')
+
+def upload_as_pdf(images, bucket_name, key):
+    # the PDF is written to /tmp and uploaded from there in parts
+    with tempfile.TemporaryFile() as pdf_buffer:
+        img2pdf.convert(images, outputstream=pdf_buffer)
+        pdf_buffer.seek(0)
+
+        s3_client.upload_fileobj(
+            Fileobj=pdf_buffer,
+            Bucket=bucket_name,
+            Key=key,
+            ExtraArgs={
+                'ContentType': 'application/pdf',
+            },
+            Config=PDF_UPLOAD_TRANSFER_CONFIG,
+        )
+
+
+class S3Image:
+
+    # an image of a prefix, fetched only when img2pdf gets to it rather than all of them opened at once
+
+    def __init__(self, bucket_name, key):
+        self.bucket_name = bucket_name
+        self.key = key
+
+    def read(self):
+        return s3_client.get_object(
+            Bucket=self.bucket_name,
+            Key=self.key,
+        )['Body'].read()
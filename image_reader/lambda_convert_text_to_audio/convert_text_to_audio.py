@@ -1,61 +1,154 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import admission
+
+from app_runtime import lazy_client, lazy_table, log_cold_start, notify_user, with_notifications
+from metrics import BYTES, Metrics, utc_now, with_metrics
+from ssml import to_ssml_chunks
 
 
 APP_NAME = os.environ['APP_NAME']
 S3_BUCKET = os.environ['S3_BUCKET']
+POLLY_VOICE_ID = os.environ['POLLY_VOICE_ID']
+POLLY_SPEECH_RATE = os.environ['POLLY_SPEECH_RATE']
 
-polly_client = boto3.client('polly')
-ddb_table = boto3.resource('dynamodb').Table(f'{APP_NAME}Jobs')
+# Polly accepts at most 100,000 billed characters per synthesis task, smaller chunks synthesize in parallel;
+# SSML tags are not billed, but count towards the 200,000 characters a task takes in all
+MAX_CHUNK_CHARACTERS = int(os.environ.get('POLLY_MAX_CHUNK_CHARACTERS', '10000'))
+MAX_CONCURRENT_TASKS = int(os.environ.get('POLLY_MAX_CONCURRENT_TASKS', '8'))
+# how long to wait for Polly capacity before leaving the rest to the state machine's retry
+ADMISSION_WAIT_SECONDS = int(os.environ.get('POLLY_ADMISSION_WAIT_SECONDS', '20'))
 
-CONVERSION_API_ENDPOINT = os.environ['CONVERSION_API_ENDPOINT']
-CONVERSION_API_REGION = os.environ['CONVERSION_API_REGION']
-apig_management_client = boto3.client(
-    'apigatewaymanagementapi',
-    endpoint_url=f'https://{CONVERSION_API_ENDPOINT}.execute-api.{CONVERSION_API_REGION}.amazonaws.com/prod',
-)
+polly_client = lazy_client('polly')
+s3_client = lazy_client('s3')
+ddb_table = lazy_table(f'{APP_NAME}Jobs')
 
+metrics = Metrics('convert_text_to_audio')
 
+
+@log_cold_start
+@with_notifications
+@with_metrics(metrics)
 def lambda_handler(event, context):
-    text = event['Payload']['Text']
+    text = read_text(event['Payload']['TextS3Bucket'], event['Payload']['TextS3Key'])
     user_id = event['Payload']['UserId']
     app_job_id = event['Payload'][f'{APP_NAME}JobId']
     connection_id = event['Payload']['ConnectionId']
     input_file = event['Payload']['InputFile']
 
     sns_topic_arn = os.environ[f'{APP_NAME}_POLLY_SNS_TOPIC_ARN']
+    # what is left of the invocation, less a margin to start the admitted tasks and record them
+    admission_wait_seconds = min(ADMISSION_WAIT_SECONDS, context.get_remaining_time_in_millis() / 1000 - 10)
+
+    try:
+        invoke_polly(text, user_id, app_job_id, connection_id, input_file, sns_topic_arn, admission_wait_seconds)
+    finally:
+        metrics.flush(**{f'{APP_NAME}JobId': app_job_id, 'BatchId': event['Payload'].get('BatchId')})
 
-    invoke_polly(text, user_id, app_job_id, connection_id, input_file, sns_topic_arn)
-
-def invoke_polly(text, user_id, app_job_id, connection_id, input_file, sns_topic_arn):
-    notify_user('Invoking Polly', connection_id)
-    resp = polly_client.start_speech_synthesis_task(
-        OutputFormat='mp3',
-        OutputS3BucketName=S3_BUCKET,
-        OutputS3KeyPrefix=f'{user_id}/{app_job_id}/audio/audio',
-        Text=text,
-        VoiceId='Ivy',
-        SnsTopicArn=sns_topic_arn,
+def read_text(bucket_name, key):
+    s3_resp = s3_client.get_object(
+        Bucket=bucket_name,
+        Key=key,
     )
+    text = s3_resp['Body'].read()
+    metrics.put('TextBytes', len(text), BYTES)
+    return text.decode('utf-8')
 
-    ddb_table.update_item(
+def invoke_polly(text, user_id, app_job_id, connection_id, input_file, sns_topic_arn, admission_wait_seconds=0):
+    # one <speak> document per chunk, cut between sentences
+    chunks = to_ssml_chunks(text.split('\n'), MAX_CHUNK_CHARACTERS, POLLY_SPEECH_RATE)
+    if not chunks:
+        raise ValueError(f'No text to synthesize for App Job {app_job_id}.')
+    metrics.put('SsmlChunks', len(chunks))
+
+    if len(chunks) == 1:
+        segment_names = ['audio']
+    else:
+        segment_names = [f'part-{index:05d}' for index in range(len(chunks))]
+
+    # on_polly_ready collects one segment per task and stitches them once all have arrived,
+    # so the expected count has to be in place before the first task can finish;
+    # the state machine retries when Polly is at capacity, the tasks an earlier attempt started are kept
+    ddb_response = ddb_table.update_item(
         Key={
             f'{APP_NAME}JobId': app_job_id,
         },
-        UpdateExpression='SET PollyJobId = :polly_job_id',
+        UpdateExpression='SET PollyTaskCount = :polly_task_count, AudioSegmentUris = if_not_exists(AudioSegmentUris, :no_segments), PollyTaskIds = if_not_exists(PollyTaskIds, :no_segments), SynthesisStartTime = if_not_exists(SynthesisStartTime, :now)',
         ExpressionAttributeValues={
-            ':polly_job_id': resp['SynthesisTask']['TaskId']
+            ':polly_task_count': len(chunks),
+            ':no_segments': {},
+            ':now': utc_now(),
         },
         ReturnValues='ALL_NEW',
     )
+    pending_segments = [
+        (chunk, segment_name) for chunk, segment_name in zip(chunks, segment_names)
+        if segment_name not in ddb_response['Attributes']['PollyTaskIds']
+    ]
+    if len(pending_segments) == len(chunks):
+        notify_user('Invoking Polly', connection_id)
 
-    notify_user(f'Polly (Lambda) response: {resp}', connection_id)
+    # each task holds a lease until on_polly_ready gets its notification
+    admitted_segments = []
+    deadline = time.monotonic() + admission_wait_seconds
+    try:
+        with metrics.timer('AdmissionWaitMs'):
+            for chunk, segment_name in pending_segments:
+                admission.acquire(admission.POLLY, f'{app_job_id}/{segment_name}', max(0, deadline - time.monotonic()))
+                admitted_segments.append((chunk, segment_name))
+    except admission.AdmissionDenied as e:
+        print(e)
 
-def notify_user(message, connection_id):
-    apig_response = apig_management_client.post_to_connection(
-        Data=message,
-        ConnectionId=connection_id,
-    )
+    polly_task_ids = {}
+    if admitted_segments:
+        with ThreadPoolExecutor(max_workers=min(len(admitted_segments), MAX_CONCURRENT_TASKS)) as executor:
+            task_ids = list(executor.map(
+                lambda args: start_speech_synthesis_task(*args, user_id, app_job_id, sns_topic_arn),
+                admitted_segments,
+            ))
+        polly_task_ids = {
+            segment_name: task_id
+            for (_, segment_name), task_id in zip(admitted_segments, task_ids) if task_id is not None
+        }
+    if polly_task_ids:
+        names = {f'#segment_{index}': segment_name for index, segment_name in enumerate(polly_task_ids)}
+        ddb_table.update_item(
+            Key={
+                f'{APP_NAME}JobId': app_job_id,
+            },
+            UpdateExpression='SET ' + ', '.join(f'PollyTaskIds.{name} = :task_{index}' for index, name in enumerate(names)),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={f':task_{index}': polly_task_ids[segment_name] for index, segment_name in enumerate(names.values())},
+        )
+        notify_user(f'Polly (Lambda) started {len(polly_task_ids)} synthesis task(s): {list(polly_task_ids.values())}', connection_id)
+
+    metrics.put('PollyTasksStarted', len(polly_task_ids))
+    metrics.put('PollyTasksDeferred', len(pending_segments) - len(polly_task_ids))
+    if len(polly_task_ids) < len(pending_segments):
+        raise admission.AdmissionDenied(admission.POLLY, f'{len(pending_segments) - len(polly_task_ids)} of {len(chunks)} tasks of App Job {app_job_id}')
+
+def start_speech_synthesis_task(ssml, segment_name, user_id, app_job_id, sns_topic_arn):
+    try:
+        resp = polly_client.start_speech_synthesis_task(
+            OutputFormat='mp3',
+            OutputS3BucketName=S3_BUCKET,
+            OutputS3KeyPrefix=f'{user_id}/{app_job_id}/audio/{segment_name}',
+            Text=ssml,
+            TextType='ssml',
+            VoiceId=POLLY_VOICE_ID,
+            SnsTopicArn=sns_topic_arn,
+        )
+    except Exception as e:
+        admission.release(admission.POLLY, f'{app_job_id}/{segment_name}')
+        # the quota in cdk.json is above what the account gets, the segment is left for the retry
+        if admission.is_throttling_error(e):
+            print(f'Polly throttled segment {segment_name} of App Job {app_job_id}: {e!r}')
+            return None
+        raise
+    return resp['SynthesisTask']['TaskId']
@@ -0,0 +1,193 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import os
+import pathlib
+import re
+
+from botocore.config import Config
+
+from app_runtime import lazy_client, log_cold_start
+
+
+APP_NAME = os.environ['APP_NAME']
+S3_BUCKET = os.environ['S3_BUCKET']
+
+PRESIGNED_URL_EXPIRES_SECONDS = int(os.environ.get('PRESIGNED_URL_EXPIRES_SECONDS', '3600'))
+# larger uploads go in parts, which the client sends in parallel and retries one by one;
+# every part but the last needs to be at least 5 MB, and there can be at most 10,000 of them
+MULTIPART_UPLOAD_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+# the largest PDF or TIFF asynchronous Textract takes
+MAX_UPLOAD_SIZE = 500 * 1024 * 1024
+
+UPLOAD_FILE_SUFFIXES = ('.jpg', '.png', '.tif', '.tiff', '.pdf', '.zip')
+# {user_id}/{app_job_id}/images/<file name> is uploaded, the job's audio/ and text/ are downloaded,
+# and so is {user_id}/{batch_id}/manifest/ of a batch, see batches.py in the runtime layer
+UPLOAD_KEY_RE = re.compile(r'^[\w.@+=-]+/[\w.@+=-]+/images/[^/]+$')
+DOWNLOAD_KEY_RE = re.compile(r'^[\w.@+=-]+/[\w.@+=-]+/(audio|text|manifest)/[^/]+$')
+
+# browsers PUT/GET straight to the bucket, the URLs have to be signed for its region with SigV4
+s3_client = lazy_client('s3', config=Config(signature_version='s3v4', s3={'addressing_style': 'virtual'}))
+
+
+@log_cold_start
+def lambda_handler(event, context):
+    # REST API proxy integration, see MainStack._create_api_gateway_rest
+    routes = {
+        ('POST', '/uploads'): create_upload,
+        ('POST', '/uploads/complete'): complete_upload,
+        ('POST', '/uploads/abort'): abort_upload,
+        ('GET', '/downloads'): create_download,
+    }
+    route = routes.get((event['httpMethod'], event['resource']))
+    if route is None:
+        return respond(404, {'Message': f'No route for {event["httpMethod"]} {event["resource"]}'})
+
+    try:
+        if event['httpMethod'] == 'GET':
+            request = event.get('queryStringParameters') or {}
+        else:
+            request = json.loads(event.get('body') or '{}')
+        return respond(200, route(request))
+    except KeyError as e:
+        return respond(400, {'Message': f'Missing {e.args[0]}.'})
+    except (TypeError, ValueError) as e:
+        print(f'Rejected {event["httpMethod"]} {event["resource"]}: {e!r}')
+        return respond(400, {'Message': str(e)})
+
+def respond(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+        },
+        'body': json.dumps(body),
+    }
+
+def create_upload(request):
+    user_id = request['UserId']
+    app_job_id = request[f'{APP_NAME}JobId']
+    file_name = pathlib.PurePath(request['FileName']).name
+    size = int(request['Size'])
+    if pathlib.PurePath(file_name).suffix.lower() not in UPLOAD_FILE_SUFFIXES:
+        raise ValueError(f'Input file type not supported: {file_name}')
+    if not 0 < size <= MAX_UPLOAD_SIZE:
+        raise ValueError(f'File size {size} is not between 1 and {MAX_UPLOAD_SIZE} bytes.')
+
+    key = check_key(f'{user_id}/{app_job_id}/images/{file_name}', UPLOAD_KEY_RE)
+    content_type = request.get('ContentType') or 'application/octet-stream'
+    if size <= MULTIPART_UPLOAD_THRESHOLD:
+        # a form POST, whose policy caps the size of the file; the content type is one of its fields,
+        # so it does not depend on the header the browser sends
+        presigned_post = s3_client.generate_presigned_post(
+            Bucket=S3_BUCKET,
+            Key=key,
+            Fields={
+                'Content-Type': content_type,
+            },
+            Conditions=[
+                {'Content-Type': content_type},
+                ['content-length-range', 1, MULTIPART_UPLOAD_THRESHOLD],
+            ],
+            ExpiresIn=PRESIGNED_URL_EXPIRES_SECONDS,
+        )
+        return {
+            'Bucket': S3_BUCKET,
+            'Key': key,
+            'Url': presigned_post['url'],
+            'Fields': presigned_post['fields'],
+        }
+
+    multipart_upload = s3_client.create_multipart_upload(
+        Bucket=S3_BUCKET,
+        Key=key,
+        ContentType=content_type,
+    )
+    part_count = -(-size // MULTIPART_UPLOAD_PART_SIZE)
+    return {
+        'Bucket': S3_BUCKET,
+        'Key': key,
+        'UploadId': multipart_upload['UploadId'],
+        'PartSize': MULTIPART_UPLOAD_PART_SIZE,
+        # signed locally, no request to S3 per part
+        'PartUrls': [
+            s3_client.generate_presigned_url(
+                ClientMethod='upload_part',
+                Params={
+                    'Bucket': S3_BUCKET,
+                    'Key': key,
+                    'UploadId': multipart_upload['UploadId'],
+                    'PartNumber': part_number,
+                },
+                ExpiresIn=PRESIGNED_URL_EXPIRES_SECONDS,
+            )
+            for part_number in range(1, part_count + 1)
+        ],
+    }
+
+def complete_upload(request):
+    key = check_key(request['Key'], UPLOAD_KEY_RE)
+    upload_id = request['UploadId']
+    part_count = int(request['PartCount'])
+
+    # the parts S3 received, so the client does not need to read their ETags
+    parts = []
+    size = 0
+    for page in s3_client.get_paginator('list_parts').paginate(Bucket=S3_BUCKET, Key=key, UploadId=upload_id):
+        parts.extend({'ETag': part['ETag'], 'PartNumber': part['PartNumber']} for part in page.get('Parts', []))
+        size += sum(part['Size'] for part in page.get('Parts', []))
+    if len(parts) != part_count:
+        raise ValueError(f'{len(parts)} of {part_count} parts of {key} uploaded.')
+    # presigned parts take any size, the upload is checked before it becomes an object
+    if size > MAX_UPLOAD_SIZE:
+        abort_upload(request)
+        raise ValueError(f'File size {size} is more than {MAX_UPLOAD_SIZE} bytes.')
+
+    s3_client.complete_multipart_upload(
+        Bucket=S3_BUCKET,
+        Key=key,
+        MultipartUpload={
+            'Parts': parts,
+        },
+        UploadId=upload_id,
+    )
+    return {
+        'Bucket': S3_BUCKET,
+        'Key': key,
+    }
+
+def abort_upload(request):
+    # parts left behind by clients that never come back are removed by the bucket's lifecycle rule
+    key = check_key(request['Key'], UPLOAD_KEY_RE)
+    s3_client.abort_multipart_upload(
+        Bucket=S3_BUCKET,
+        Key=key,
+        UploadId=request['UploadId'],
+    )
+    return {
+        'Bucket': S3_BUCKET,
+        'Key': key,
+    }
+
+def create_download(request):
+    key = check_key(request['Key'], DOWNLOAD_KEY_RE)
+    return {
+        'Bucket': S3_BUCKET,
+        'Key': key,
+        'Url': s3_client.generate_presigned_url(
+            ClientMethod='get_object',
+            Params={
+                'Bucket': S3_BUCKET,
+                'Key': key,
+            },
+            ExpiresIn=PRESIGNED_URL_EXPIRES_SECONDS,
+        ),
+    }
+
+def check_key(key, key_re):
+    if not key_re.match(key) or '/../' in f'/{key}/':
+        raise ValueError(f'Invalid key {key!r}.')
+    return key
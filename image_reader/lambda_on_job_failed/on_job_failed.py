@@ -0,0 +1,44 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import os
+
+from app_runtime import log_cold_start, notify_user, with_notifications
+from batches import record_document_outcome
+from metrics import Metrics, with_metrics
+
+
+APP_NAME = os.environ['APP_NAME']
+ERROR_PREFIX = 'ERROR - '
+
+metrics = Metrics('on_job_failed')
+
+
+@log_cold_start
+@with_notifications
+@with_metrics(metrics)
+def lambda_handler(event, context):
+    # the state machine's catch, see StepFunctionsStack: the input of the step that failed,
+    # which is the retrieve_text input or a retrieve_text output under Payload, with the error under Error
+    payload = event.get('Payload') or event
+    app_job_id = payload[f'{APP_NAME}JobId']
+    error_message = get_error_message(event['Error'])
+    print(f'App Job {app_job_id} failed: {event["Error"]}')
+    metrics.put('FailedJobs', 1)
+    metrics.flush(**{f'{APP_NAME}JobId': app_job_id, 'BatchId': payload.get('BatchId'), 'Error': event['Error'].get('Error')})
+
+    notify_user(f'{ERROR_PREFIX}{error_message}', payload.get('ConnectionId'))
+    record_document_outcome(payload.get('BatchId'), app_job_id, error=error_message)
+
+def get_error_message(error):
+    # Cause holds what Lambda reports for an unhandled exception, errorMessage among it;
+    # only the messages raised for the user (ERROR - ...) are passed on as they are
+    try:
+        cause = json.loads(error.get('Cause') or '{}')
+    except ValueError:
+        cause = {}
+    error_message = cause.get('errorMessage') if isinstance(cause, dict) else None
+    if error_message and error_message.startswith(ERROR_PREFIX):
+        return error_message[len(ERROR_PREFIX):]
+    return 'Failed to convert file'
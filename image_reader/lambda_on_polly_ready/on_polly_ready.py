@@ -1,61 +1,276 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import json
 import os
+import time
+import urllib.parse
 
-from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+import admission
+
+from app_runtime import lazy_client, lazy_table, log_cold_start, notify_user, with_notifications
+from batches import record_document_outcome
+from metrics import MILLISECONDS, Metrics, elapsed_ms, utc_now, with_metrics
+from sns_records import batch_get_items, record_failure, report_failures
 
 
 APP_NAME = os.environ['APP_NAME']
-ddb_table = boto3.resource('dynamodb').Table(f'{APP_NAME}Jobs')
+ddb_table = lazy_table(f'{APP_NAME}Jobs')
+ddb_result_cache_table = lazy_table(f'{APP_NAME}ResultCache')
+RESULT_CACHE_TTL_SECONDS = int(os.environ['RESULT_CACHE_TTL_DAYS']) * 24 * 60 * 60
+s3_client = lazy_client('s3')
+
+# every part of an S3 multipart upload but the last needs to be at least 5 MB
+STITCH_PART_SIZE = 8 * 1024 * 1024
+# DeleteObjects takes at most this many keys
+DELETE_OBJECTS_MAX_KEYS = 1000
 
-CONVERSION_API_ENDPOINT = os.environ['CONVERSION_API_ENDPOINT']
-CONVERSION_API_REGION = os.environ['CONVERSION_API_REGION']
-apig_management_client = boto3.client(
-    'apigatewaymanagementapi',
-    endpoint_url=f'https://{CONVERSION_API_ENDPOINT}.execute-api.{CONVERSION_API_REGION}.amazonaws.com/prod',
-)
+metrics = Metrics('on_polly_ready')
 
 
+@log_cold_start
+@with_notifications
+@with_metrics(metrics)
 def lambda_handler(event, context):
 
-    polly_job_ids = []
-    audio_output_file_uri = None
+    polly_messages = []
+    failures = []
     for polly_record in event['Records']:
-        message = json.loads(polly_record['Sns']['Message'])
-        job_id = message['taskId']
-        status = message['taskStatus']
-        audio_output_file_uri = message['outputUri']
+        try:
+            message = json.loads(polly_record['Sns']['Message'])
+            job_id = message['taskId']
+            status = message['taskStatus']
+            audio_output_file_uri = message['outputUri']
+        except (KeyError, ValueError) as e:
+            failures.append(record_failure(polly_record, e))
+            continue
 
-        polly_job_ids.append(job_id)
+        polly_messages.append((polly_record, message))
 
         print(f'JobId {job_id} has finished with status {status}.  Output: {audio_output_file_uri}.')
 
-    if len(polly_job_ids) != 1:
-        raise ValueError(f'Number of Polly job ids is not one: {polly_job_ids}.')
-
-    ddb_response = ddb_table.query(
-        IndexName='PollyJobId',
-        KeyConditionExpression=Key('PollyJobId').eq(polly_job_ids[0]),
+    # failed tasks only need the job's ConnectionId and BatchId, fetched for all of them at once;
+    # completed tasks get their item back from the update that records the segment
+    failed_app_job_ids = {
+        get_app_job_id(message['outputUri'])
+        for _, message in polly_messages if message['taskStatus'] != 'COMPLETED'
+    }
+    items = batch_get_items(
+        ddb_table,
+        f'{APP_NAME}JobId',
+        failed_app_job_ids,
+        ProjectionExpression='#app_job_id, ConnectionId, BatchId',
+        ExpressionAttributeNames={
+            '#app_job_id': f'{APP_NAME}JobId',
+        },
     )
 
-    if ddb_response['ResponseMetadata']['HTTPStatusCode'] != 200:
-        raise RuntimeError(f'Failed to query Dynamodb with PollyJobId {polly_job_ids[0]}.  DynamoDB response: {ddb_response}.')
+    for polly_record, message in polly_messages:
+        app_job_id = None
+        try:
+            app_job_id = get_app_job_id(message['outputUri'])
+            # succeeded or not, the task no longer counts against the Polly quota
+            admission.release(admission.POLLY, get_lease_id(message['outputUri']))
+            if message['taskStatus'] == 'COMPLETED':
+                on_task_completed(message)
+            else:
+                on_task_failed(message, items[app_job_id])
+        except Exception as e:
+            failures.append(record_failure(polly_record, e))
+        finally:
+            metrics.flush(**{f'{APP_NAME}JobId': app_job_id, 'PollyTaskId': message['taskId']})
+
+    return report_failures(event['Records'], failures, 'Polly')
+
+def get_app_job_id(audio_output_file_uri):
+    # Polly writes to {user_id}/{app_job_id}/audio/<prefix>.<task id>.mp3 (see convert_text_to_audio)
+    _, audio_output_file_s3_key = parse_s3_uri(audio_output_file_uri)
+    return audio_output_file_s3_key.split('/')[-3]
 
-    if ddb_response['Count'] != 1:
-        raise ValueError(f'Number of DynamoDB items matching PollyJobId {polly_job_ids[0]} is not one.  DynamoDB response: {ddb_response}.')
+def get_lease_id(audio_output_file_uri):
+    # {app_job_id}/<segment name>, see convert_text_to_audio.invoke_polly
+    _, audio_output_file_s3_key = parse_s3_uri(audio_output_file_uri)
+    return f'{get_app_job_id(audio_output_file_uri)}/{os.path.basename(audio_output_file_s3_key).split(".")[0]}'
 
-    item = ddb_response['Items'][0]
-    app_job_id = item[f'{APP_NAME}JobId']
+def on_task_failed(message, item):
+    metrics.put('PollyFailedTasks', 1)
+    notify_user(f'ERROR - Polly task {message["taskId"]} failed with status {message["taskStatus"]}', item['ConnectionId'])
+    record_document_outcome(item.get('BatchId'), item[f'{APP_NAME}JobId'], error=f'Polly task {message["taskId"]} failed with status {message["taskStatus"]}')
+
+def on_task_completed(message):
+    audio_output_file_uri = message['outputUri']
+    bucket_name, audio_output_file_s3_key = parse_s3_uri(audio_output_file_uri)
+    app_job_id = get_app_job_id(audio_output_file_uri)
+    segment_name = os.path.basename(audio_output_file_s3_key).split('.')[0]
+    metrics.put('PollyTasks', 1)
+    # billed per character, SSML tags aside
+    metrics.put('PollyCharacters', message.get('requestCharacters'))
+
+    ddb_response = ddb_table.update_item(
+        Key={
+            f'{APP_NAME}JobId': app_job_id,
+        },
+        UpdateExpression='SET AudioSegmentUris.#segment_name = :audio_segment_uri',
+        ConditionExpression=f'attribute_exists({APP_NAME}JobId)',
+        ExpressionAttributeNames={
+            '#segment_name': segment_name,
+        },
+        ExpressionAttributeValues={
+            ':audio_segment_uri': audio_output_file_uri,
+        },
+        ReturnValues='ALL_NEW',
+    )
+
+    item = ddb_response['Attributes']
     connection_id = item['ConnectionId']
+    # a notification delivered again after the audio was stitched, its segment is gone
+    if 'AudioReadyTime' in item:
+        print(f'Audio of App Job {app_job_id} is already ready.')
+        return
+
+    audio_segment_uris = item['AudioSegmentUris']
+    if len(audio_segment_uris) < item['PollyTaskCount']:
+        print(f'{len(audio_segment_uris)} of {item["PollyTaskCount"]} audio segments ready for App Job {app_job_id}.')
+        return
+
+    metrics.put('AudioSegments', len(audio_segment_uris))
+    if len(audio_segment_uris) == 1:
+        audio_output_file_uri = next(iter(audio_segment_uris.values()))
+    else:
+        # segment names are zero-padded, so sorting them restores the text order
+        with metrics.timer('StitchMs'):
+            audio_output_file_uri = stitch_audio_segments(
+                [audio_segment_uris[name] for name in sorted(audio_segment_uris)],
+                bucket_name,
+                f'{os.path.dirname(audio_output_file_s3_key)}/audio.mp3',
+            )
+        delete_audio_segments(audio_segment_uris.values())
 
-    apig_response = apig_management_client.post_to_connection(
-        Data=f'Polly output is ready for App Job {app_job_id}',
-        ConnectionId=connection_id,
+    if 'CacheKey' in item:
+        cache_result(item['CacheKey'], bucket_name, audio_output_file_s3_key, audio_output_file_uri)
+    record_audio_ready(app_job_id, item)
+
+    notify_user(f'Polly output is ready for App Job {app_job_id}', connection_id)
+    notify_user(audio_output_file_uri, connection_id)
+    record_document_outcome(item.get('BatchId'), app_job_id, audio_output_file_uri=audio_output_file_uri)
+
+def record_audio_ready(app_job_id, item):
+    audio_ready_time_utc = utc_now()
+    metrics.put('SynthesisMs', elapsed_ms(item.get('SynthesisStartTime'), audio_ready_time_utc), MILLISECONDS)
+    # from when the job was last reprocessed, or else queued, or else uploaded
+    metrics.put('EndToEndMs', elapsed_ms(item.get('ReprocessTime') or item.get('QueuedTime') or item.get('StartTime'), audio_ready_time_utc), MILLISECONDS)
+    ddb_table.update_item(
+        Key={
+            f'{APP_NAME}JobId': app_job_id,
+        },
+        UpdateExpression='SET AudioReadyTime = :audio_ready_time',
+        ExpressionAttributeValues={
+            ':audio_ready_time': audio_ready_time_utc,
+        },
+    )
+
+def cache_result(cache_key, bucket_name, audio_output_file_s3_key, audio_output_file_uri):
+    # text and audio share the {user_id}/{app_job_id} prefix, see convert_images_to_text.serve_from_cache
+    audio_s3_bucket, audio_s3_key = parse_s3_uri(audio_output_file_uri)
+    now = int(time.time())
+    ddb_result_cache_table.put_item(
+        Item={
+            'CacheKey': cache_key,
+            'TextS3Bucket': bucket_name,
+            'TextS3Key': f'{os.path.dirname(os.path.dirname(audio_output_file_s3_key))}/text/text.txt',
+            'AudioS3Bucket': audio_s3_bucket,
+            'AudioS3Key': audio_s3_key,
+            'CreatedAt': now,
+            'ExpiresAt': now + RESULT_CACHE_TTL_SECONDS,
+            'HitCount': 0,
+        },
     )
-    apig_response = apig_management_client.post_to_connection(
-        Data=audio_output_file_uri,
-        ConnectionId=connection_id,
+
+def stitch_audio_segments(audio_segment_uris, bucket_name, key):
+    # MP3 frames are self-contained, so appending the segments in order yields a playable file
+    multipart_upload = s3_client.create_multipart_upload(
+        Bucket=bucket_name,
+        Key=key,
+        ContentType='audio/mpeg',
     )
+    upload_id = multipart_upload['UploadId']
+    parts = []
+
+    def upload_part(body):
+        resp = s3_client.upload_part(
+            Body=body,
+            Bucket=bucket_name,
+            Key=key,
+            PartNumber=len(parts) + 1,
+            UploadId=upload_id,
+        )
+        parts.append({
+            'ETag': resp['ETag'],
+            'PartNumber': len(parts) + 1,
+        })
+
+    try:
+        buffer = bytearray()
+        for audio_segment_uri in audio_segment_uris:
+            segment_bucket_name, segment_key = parse_s3_uri(audio_segment_uri)
+            s3_resp = s3_client.get_object(
+                Bucket=segment_bucket_name,
+                Key=segment_key,
+            )
+            for data in s3_resp['Body'].iter_chunks():
+                buffer += data
+                if len(buffer) >= STITCH_PART_SIZE:
+                    upload_part(bytes(buffer))
+                    buffer.clear()
+        if buffer or not parts:
+            upload_part(bytes(buffer))
+
+        s3_client.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=key,
+            MultipartUpload={
+                'Parts': parts,
+            },
+            UploadId=upload_id,
+        )
+    except Exception:
+        s3_client.abort_multipart_upload(
+            Bucket=bucket_name,
+            Key=key,
+            UploadId=upload_id,
+        )
+        raise
+
+    return f's3://{bucket_name}/{key}'
+
+def delete_audio_segments(audio_segment_uris):
+    # audio.mp3 holds all of them, kept they would double the audio stored for the job
+    keys_by_bucket_name = {}
+    for audio_segment_uri in audio_segment_uris:
+        segment_bucket_name, segment_key = parse_s3_uri(audio_segment_uri)
+        keys_by_bucket_name.setdefault(segment_bucket_name, []).append(segment_key)
+    try:
+        for segment_bucket_name, keys in keys_by_bucket_name.items():
+            for start in range(0, len(keys), DELETE_OBJECTS_MAX_KEYS):
+                s3_resp = s3_client.delete_objects(
+                    Bucket=segment_bucket_name,
+                    Delete={
+                        'Objects': [{'Key': key} for key in keys[start:start + DELETE_OBJECTS_MAX_KEYS]],
+                        'Quiet': True,
+                    },
+                )
+                for error in s3_resp.get('Errors', []):
+                    print(f'Failed to delete audio segment s3://{segment_bucket_name}/{error["Key"]}: {error["Code"]}')
+    except ClientError as e:
+        # the audio is ready all the same
+        print(f'Failed to delete the audio segments: {e!r}')
+
+def parse_s3_uri(uri):
+    parsed_uri = urllib.parse.urlparse(uri)
+    if parsed_uri.scheme == 's3':
+        return parsed_uri.netloc, parsed_uri.path.lstrip('/')
+    # path-style https://s3.<region>.amazonaws.com/<bucket>/<key>
+    bucket_name, _, key = parsed_uri.path.lstrip('/').partition('/')
+    return bucket_name, key
@@ -1,76 +1,92 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import datetime
 import json
 import os
+import time
 import uuid
 
-from boto3.dynamodb.conditions import Key
+import admission
+
+from app_runtime import lazy_client, lazy_table, log_cold_start, notify_user, with_notifications
+from metrics import MILLISECONDS, Metrics, elapsed_ms, with_metrics
+from sns_records import batch_get_items, record_failure, report_failures
 
 
 APP_NAME = os.environ['APP_NAME']
-ddb_table = boto3.resource('dynamodb').Table(f'{APP_NAME}Jobs')
-sfn_client = boto3.client('stepfunctions')
+ddb_table = lazy_table(f'{APP_NAME}Jobs')
+sfn_client = lazy_client('stepfunctions')
 
-CONVERSION_API_ENDPOINT = os.environ['CONVERSION_API_ENDPOINT']
-CONVERSION_API_REGION = os.environ['CONVERSION_API_REGION']
-apig_management_client = boto3.client(
-    'apigatewaymanagementapi',
-    endpoint_url=f'https://{CONVERSION_API_ENDPOINT}.execute-api.{CONVERSION_API_REGION}.amazonaws.com/prod',
-)
+metrics = Metrics('on_textract_ready')
 
 
+@log_cold_start
+@with_notifications
+@with_metrics(metrics)
 def lambda_handler(event, context):
 
-    textract_job_ids = []
+    textract_messages = []
+    failures = []
     for textract_record in event['Records']:
-        message = json.loads(textract_record['Sns']['Message'])
-        job_id = message['JobId']
-        status = message['Status']
-        file_loc = message['DocumentLocation']['S3ObjectName']
-
-        textract_job_ids.append(job_id)
-
-        print(f'JobId {job_id} has finished with status {status} for file {file_loc}.')
-
-    if len(textract_job_ids) != 1:
-        raise ValueError(f'Number of Textract job ids is not one: {textract_job_ids}.')
-
-    ddb_response = ddb_table.query(
-        IndexName='TextractJobId',
-        KeyConditionExpression=Key('TextractJobId').eq(textract_job_ids[0]),
+        try:
+            message = json.loads(textract_record['Sns']['Message'])
+            job_id = message['JobId']
+            status = message['Status']
+            file_loc = message['DocumentLocation']['S3ObjectName']
+            app_job_id = message['JobTag']  # convert_images_to_text tags every Textract job with its app job id
+        except (KeyError, ValueError) as e:
+            failures.append(record_failure(textract_record, e))
+            continue
+
+        textract_messages.append((textract_record, message))
+
+        print(f'JobId {job_id} has finished with status {status} for file {file_loc}, App Job {app_job_id}.')
+
+    items = batch_get_items(
+        ddb_table,
+        f'{APP_NAME}JobId',
+        {message['JobTag'] for _, message in textract_messages},
+        ConsistentRead=True,  # the item was written right before the Textract job started
     )
 
-    if ddb_response['ResponseMetadata']['HTTPStatusCode'] != 200:
-        raise RuntimeError(f'Failed to query Dynamodb with TextractJobId {textract_job_ids[0]}.  DynamoDB response: {ddb_response}.')
-
-    if ddb_response['Count'] != 1:
-        raise ValueError(f'Number of DynamoDB items matching TextractJobId {textract_job_ids[0]} is not one.  DynamoDB response: {ddb_response}.')
-
-    item = ddb_response['Items'][0]
+    for textract_record, message in textract_messages:
+        try:
+            # succeeded or not, the job no longer counts against the Textract quota
+            admission.release(admission.TEXTRACT, message['JobTag'])
+            item = items.get(message['JobTag'])
+            if item is None or item.get('TextractJobId') != message['JobId']:
+                raise ValueError(f'No App Job {message["JobTag"]} found for Textract job {message["JobId"]}.')
+            # Timestamp is when the job finished, in milliseconds since the epoch
+            textract_end_time_utc = datetime.datetime.utcfromtimestamp(message.get('Timestamp', time.time() * 1000) / 1000).isoformat()
+            metrics.put('TextractJobMs', elapsed_ms(item.get('TextractStartTime'), textract_end_time_utc), MILLISECONDS)
+            metrics.put('TextractFailedJobs' if message['Status'] != 'SUCCEEDED' else 'TextractSucceededJobs', 1)
+            start_state_machine(message['JobId'], item, textract_end_time_utc)
+        except Exception as e:
+            failures.append(record_failure(textract_record, e))
+        finally:
+            metrics.flush(**{f'{APP_NAME}JobId': message['JobTag']})
+
+    return report_failures(event['Records'], failures, 'Textract')
+
+def start_state_machine(textract_job_id, item, textract_end_time_utc):
     app_job_id = item[f'{APP_NAME}JobId']
     connection_id = item['ConnectionId']
-    user_id = item['UserId']
-    input_file = item['InputFile']
 
     state_machine_arn = os.environ[f'{APP_NAME}_STATE_MACHINE']
     sfn_client.start_execution(  # this returns immediately
         stateMachineArn=state_machine_arn,
         name=datetime.datetime.utcnow().strftime(f'%Y%m%d-%H%M%S-{uuid.uuid1()}'),
-        input=f'''
-            {{
-                "TextractJobId": "{textract_job_ids[0]}",
-                "{APP_NAME}JobId": "{app_job_id}",
-                "ConnectionId": "{connection_id}",
-                "UserId": "{user_id}",
-                "InputFile": "{input_file}"
-            }}
-        ''',
+        input=json.dumps({
+            'TextractJobId': textract_job_id,
+            f'{APP_NAME}JobId': app_job_id,
+            'ConnectionId': connection_id,
+            'UserId': item['UserId'],
+            'InputFile': item['InputFile'],
+            'ConfidenceLimit': item.get('ConfidenceLimit'),
+            'BatchId': item.get('BatchId'),
+            'TextractEndTime': textract_end_time_utc,  # recorded with the job by retrieve_text
+        }),
     )
 
-    apig_response = apig_management_client.post_to_connection(
-        Data=f'Textract output is ready for App Job {app_job_id}',
-        ConnectionId=connection_id,
-    )
+    notify_user(f'Textract output is ready for App Job {app_job_id}', connection_id)
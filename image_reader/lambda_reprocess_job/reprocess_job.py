@@ -0,0 +1,87 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import datetime
+import json
+import os
+import uuid
+
+from app_runtime import lazy_client, lazy_table, log_cold_start, notify_user, with_notifications
+from confidence import format_confidence_limit, parse_confidence_limit
+from moderation import get_lexicon_version
+
+
+APP_NAME = os.environ['APP_NAME']
+S3_BUCKET = os.environ['S3_BUCKET']
+POLLY_VOICE_ID = os.environ['POLLY_VOICE_ID']
+POLLY_SPEECH_RATE = os.environ['POLLY_SPEECH_RATE']
+CONFIDENCE_LIMIT = os.environ['CONFIDENCE_LIMIT']  # for jobs recorded before they had their own
+
+ddb_table = lazy_table(f'{APP_NAME}Jobs')
+sfn_client = lazy_client('stepfunctions')
+
+
+@log_cold_start
+@with_notifications
+def lambda_handler(event, context):
+    # rebuilds the text and audio of a finished job from the Textract output stored with it (see reprocess-jobs.py),
+    # optionally with another confidence limit and to another WebSocket connection
+    app_job_id = event[f'{APP_NAME}JobId']
+    item = ddb_table.get_item(
+        Key={
+            f'{APP_NAME}JobId': app_job_id,
+        },
+        ConsistentRead=True,
+    ).get('Item')
+    if item is None or 'TextractOutputS3Key' not in item:
+        raise ValueError(f'App Job {app_job_id} has no stored Textract output to reprocess.')
+
+    connection_id = event.get('ConnectionId') or item['ConnectionId']
+    confidence_limit = format_confidence_limit(
+        parse_confidence_limit(event.get('ConfidenceLimit'), item.get('ConfidenceLimit', CONFIDENCE_LIMIT)),
+    )
+
+    item_attributes = {
+        'ConnectionId': connection_id,
+        'ConfidenceLimit': confidence_limit,
+        'ReprocessTime': datetime.datetime.utcnow().isoformat(),
+    }
+    if 'CacheKey' in item:
+        # on_polly_ready caches the new result under the settings it was built with
+        item_attributes['CacheKey'] = rebuild_cache_key(item['CacheKey'], confidence_limit)
+    ddb_table.update_item(
+        Key={
+            f'{APP_NAME}JobId': app_job_id,
+        },
+        # convert_text_to_audio keeps the segments, tasks and start time it finds, those of the earlier run are dropped
+        UpdateExpression='SET ' + ', '.join(f'{name} = :{name}' for name in item_attributes) + ' REMOVE AudioSegmentUris, PollyTaskIds, SynthesisStartTime, AudioReadyTime',
+        ExpressionAttributeValues={f':{name}': value for name, value in item_attributes.items()},
+    )
+
+    # same input as on_textract_ready starts the state machine with, retrieve_text reads the stored output instead
+    sfn_resp = sfn_client.start_execution(
+        stateMachineArn=os.environ[f'{APP_NAME}_STATE_MACHINE'],
+        name=datetime.datetime.utcnow().strftime(f'%Y%m%d-%H%M%S-{uuid.uuid1()}'),
+        input=json.dumps({
+            'TextractJobId': item.get('TextractJobId'),
+            'TextractOutputS3Key': item['TextractOutputS3Key'],
+            f'{APP_NAME}JobId': app_job_id,
+            'ConnectionId': connection_id,
+            'UserId': item['UserId'],
+            'InputFile': item['InputFile'],
+            'ConfidenceLimit': confidence_limit,
+        }),
+    )
+
+    notify_user(f'Reprocessing App Job {app_job_id} from its stored Textract output', connection_id)
+
+    return {
+        f'{APP_NAME}JobId': app_job_id,
+        'ExecutionArn': sfn_resp['executionArn'],
+    }
+
+def rebuild_cache_key(cache_key, confidence_limit):
+    # <content hash>/<voice>/<speech rate>/<confidence limit>/<lexicon version>, see convert_images_to_text.compute_cache_key;
+    # retrieve_text moderates the text again with the current lexicon
+    content_hash = cache_key.split('/')[0]
+    return f'{content_hash}/{POLLY_VOICE_ID}/{POLLY_SPEECH_RATE}/{confidence_limit}/{get_lexicon_version(S3_BUCKET)}'
@@ -1,52 +1,149 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import os
 
+from app_runtime import lazy_client, lazy_table, log_cold_start, notify_user, with_notifications
+from confidence import apply_confidence_limit, parse_confidence_limit
+from metrics import BYTES, Metrics, utc_now, with_metrics
+from moderation import get_lexicon, read_moderated_lines
+from reading_order import LineBlocks, iter_ordered_lines
+from textract_output import TextractOutputWriter, get_textract_output_s3_key, iter_stored_line_blocks
 
-CONFIDENCE_LIMIT = 80
+
+# used when the request does not come with its own, may be 'auto'
+CONFIDENCE_LIMIT = os.environ['CONFIDENCE_LIMIT']
+
+# max number of blocks per GetDocumentTextDetection response (Textract's own upper bound)
+TEXTRACT_PAGE_SIZE = 1000
 
 APP_NAME = os.environ['APP_NAME']
+S3_BUCKET = os.environ['S3_BUCKET']
+s3_client = lazy_client('s3')
+ddb_table = lazy_table(f'{APP_NAME}Jobs')
 
-CONVERSION_API_ENDPOINT = os.environ['CONVERSION_API_ENDPOINT']
 CONVERSION_API_REGION = os.environ['CONVERSION_API_REGION']
-apig_management_client = boto3.client(
-    'apigatewaymanagementapi',
-    endpoint_url=f'https://{CONVERSION_API_ENDPOINT}.execute-api.{CONVERSION_API_REGION}.amazonaws.com/prod',
-)
+textract_client = lazy_client('textract', region_name=CONVERSION_API_REGION)
 
-textract_client = boto3.client(
-    service_name = 'textract',
-    region_name = CONVERSION_API_REGION,
-)
+metrics = Metrics('retrieve_text')
 
 
+@log_cold_start
+@with_notifications
+@with_metrics(metrics)
 def lambda_handler(event, context):
-    textract_job_id = event['TextractJobId']
+    try:
+        return retrieve_text(event)
+    finally:
+        metrics.flush(**{f'{APP_NAME}JobId': event[f'{APP_NAME}JobId'], 'BatchId': event.get('BatchId')})
+
+def retrieve_text(event):
+    textract_job_id = event.get('TextractJobId')
+    user_id = event['UserId']
+    app_job_id = event[f'{APP_NAME}JobId']
     connection_id = event['ConnectionId']
 
-    extracted_lines = []
-    textract_resp = textract_client.get_document_text_detection(
-        JobId=textract_job_id,
-    )
-    if textract_resp['JobStatus'] == 'SUCCEEDED':
-        for block in textract_resp['Blocks']:
-            if block['BlockType'] == 'LINE' and block['Confidence'] >= CONFIDENCE_LIMIT:
-                extracted_lines.append(block['Text'])
+    # reprocess_job points at the output stored by an earlier run, Textract is not called again
+    textract_output_s3_key = event.get('TextractOutputS3Key')
+    if textract_output_s3_key:
+        textract_output_writer = None
+        line_blocks_chunks = iter_stored_line_blocks(S3_BUCKET, textract_output_s3_key)
     else:
-        raise RuntimeError(f'Textract job {textract_job_id} failed.')
+        textract_output_writer = TextractOutputWriter()
+        line_blocks_chunks = textract_output_writer.record(iter_line_blocks(textract_job_id))
 
-    apig_response = apig_management_client.post_to_connection(
-        Data='Text retrieved from Textract',
-        ConnectionId=connection_id,
+    line_blocks_chunks, confidence_report = apply_confidence_limit(
+        line_blocks_chunks,
+        parse_confidence_limit(event.get('ConfidenceLimit'), CONFIDENCE_LIMIT),
     )
 
+    # moderated while Textract pages in, a rejected document is neither fetched further, nor stored, nor synthesized
+    with metrics.timer('ModerationMs', exclude=['RetrievalMs']):
+        extracted_lines, undesirable_phrase = read_moderated_lines(
+            metrics.timed(iter_ordered_lines(line_blocks_chunks, confidence_report.confidence_limit), 'RetrievalMs'),
+            get_lexicon(S3_BUCKET),
+        )
+    if undesirable_phrase:
+        print(f'Undesirable phrase "{undesirable_phrase.phrase}" at line {undesirable_phrase.line}, column {undesirable_phrase.column} of App Job {app_job_id}')
+        # on_job_failed passes the message on to the user
+        raise ValueError('ERROR - Text moderation failed')
+
+    if textract_output_writer:
+        textract_output_s3_key = get_textract_output_s3_key(user_id, app_job_id)
+        with metrics.timer('StorageMs'):
+            textract_output_writer.upload(S3_BUCKET, textract_output_s3_key)
+
+    record_text_retrieval(app_job_id, confidence_report, textract_output_s3_key, event.get('TextractEndTime'))
+    notify_user('Text retrieved from Textract', connection_id)
+    if confidence_report.dropped_line_count:
+        notify_user(confidence_report.summary(), connection_id)
+    notify_user('Text moderation succeeded', connection_id)
+
+    # the text itself stays out of the state machine payload (256 KB limit),
+    # downstream functions read it back from S3 via TextS3Bucket/TextS3Key
+    text_s3_key = f'{user_id}/{app_job_id}/text/text.txt'
+    text = '\n'.join(extracted_lines).encode('utf-8')
+    metrics.put('LineCount', len(extracted_lines))
+    metrics.put('TextBytes', len(text), BYTES)
+    with metrics.timer('StorageMs'):
+        s3_client.put_object(
+            Body=text,
+            Bucket=S3_BUCKET,
+            Key=text_s3_key,
+        )
+    notify_user('Text stored to S3', connection_id)
+
     return {
         'TextractJobId': textract_job_id,
-        'Text': '\n'.join(extracted_lines),
-        f'{APP_NAME}JobId': event[f'{APP_NAME}JobId'],
+        'TextS3Bucket': S3_BUCKET,
+        'TextS3Key': text_s3_key,
+        f'{APP_NAME}JobId': app_job_id,
         'ConnectionId': connection_id,
-        'UserId': event['UserId'],
+        'UserId': user_id,
         'InputFile': event['InputFile'],
+        'BatchId': event.get('BatchId'),
     }
+
+def record_text_retrieval(app_job_id, confidence_report, textract_output_s3_key, textract_end_time_utc):
+    item_attributes = {
+        **confidence_report.to_item_attributes(),
+        'TextractOutputS3Key': textract_output_s3_key,
+        'TextRetrievedTime': utc_now(),
+    }
+    # not when reprocessing, the job keeps the time of the Textract job its text came from
+    if textract_end_time_utc:
+        item_attributes['TextractEndTime'] = textract_end_time_utc
+    ddb_table.update_item(
+        Key={
+            f'{APP_NAME}JobId': app_job_id,
+        },
+        UpdateExpression='SET ' + ', '.join(f'{name} = :{name}' for name in item_attributes),
+        ExpressionAttributeValues={f':{name}': value for name, value in item_attributes.items()},
+    )
+
+def iter_line_blocks(textract_job_id):
+    # only the fields of the LINE blocks outlive each response page
+    next_token = None
+    while True:
+        kwargs = {
+            'JobId': textract_job_id,
+            'MaxResults': TEXTRACT_PAGE_SIZE,
+        }
+        if next_token:
+            kwargs['NextToken'] = next_token
+
+        textract_resp = textract_client.get_document_text_detection(**kwargs)
+        if textract_resp['JobStatus'] != 'SUCCEEDED':
+            raise RuntimeError(f'Textract job {textract_job_id} failed.')
+        if not next_token:
+            # billed per page, every response tells how many the document has
+            metrics.put('TextractPages', textract_resp['DocumentMetadata']['Pages'])
+
+        next_token = textract_resp.get('NextToken')
+        line_blocks = LineBlocks(textract_resp['Blocks'])
+        # drop the raw blocks before the lines are ordered and the next page is fetched
+        del textract_resp
+        yield line_blocks
+
+        if not next_token:
+            break
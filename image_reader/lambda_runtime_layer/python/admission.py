@@ -0,0 +1,150 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Keeps the asynchronous Textract jobs and Polly tasks in flight under their service quotas. Every job or task
+# holds a lease in the {APP_NAME}Admission table (one item per service, a map of lease id -> expiry) from before
+# it is started until its completion notification arrives; work that finds no free lease waits and is retried
+# with jittered exponential backoff instead of running into LimitExceededException and failing.
+
+import os
+import random
+import time
+
+from botocore.exceptions import ClientError
+
+from app_runtime import lazy_table
+
+
+TEXTRACT = 'textract'
+POLLY = 'polly'
+
+# concurrent StartDocumentTextDetection jobs and StartSpeechSynthesisTask tasks, see cdk.json
+QUOTAS = {
+    TEXTRACT: int(os.environ.get('TEXTRACT_MAX_IN_FLIGHT_JOBS', '100')),
+    POLLY: int(os.environ.get('POLLY_MAX_IN_FLIGHT_TASKS', '40')),
+}
+# a lease whose completion notification was lost is taken back after this
+LEASE_SECONDS = int(os.environ.get('ADMISSION_LEASE_SECONDS', str(2 * 60 * 60)))
+
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 900  # the longest an SQS message can be delayed
+
+THROTTLING_ERROR_CODES = frozenset((
+    'LimitExceededException',
+    'ProvisionedThroughputExceededException',
+    'ServiceQuotaExceededException',
+    'ThrottlingException',
+))
+
+admission_table = lazy_table(f'{os.environ["APP_NAME"]}Admission')
+
+
+class AdmissionDenied(Exception):
+
+    # the class name is the Lambda error type the state machine retries on, see StepFunctionsStack
+
+    def __init__(self, service, lease_id):
+        super().__init__(f'No {service} capacity for {lease_id}, {QUOTAS[service]} in flight.')
+        self.service = service
+        self.lease_id = lease_id
+
+
+def backoff_delay(attempt, base_seconds=BACKOFF_BASE_SECONDS, max_seconds=BACKOFF_MAX_SECONDS):
+    # "full jitter": waiting callers spread over the whole interval instead of retrying in step
+    return random.uniform(0, min(max_seconds, base_seconds * 2 ** attempt))
+
+def is_throttling_error(error):
+    return isinstance(error, ClientError) and error.response['Error']['Code'] in THROTTLING_ERROR_CODES
+
+def acquire(service, lease_id, wait_seconds=0):
+    # waits up to wait_seconds for a free lease, raises AdmissionDenied if none came up
+    deadline = time.monotonic() + wait_seconds
+    attempt = 0
+    while not try_acquire(service, lease_id):
+        delay = backoff_delay(attempt)
+        if time.monotonic() + delay > deadline:
+            raise AdmissionDenied(service, lease_id)
+        time.sleep(delay)
+        attempt += 1
+
+def try_acquire(service, lease_id):
+    for _ in range(2):
+        try:
+            # holding the lease already (a retried start) is not counted twice
+            admission_table.update_item(
+                Key={
+                    'Service': service,
+                },
+                UpdateExpression='SET Leases.#lease_id = :expires_at',
+                ConditionExpression='attribute_exists(Leases.#lease_id) OR size(Leases) < :quota',
+                ExpressionAttributeNames={
+                    '#lease_id': lease_id,
+                },
+                ExpressionAttributeValues={
+                    ':expires_at': int(time.time()) + LEASE_SECONDS,
+                    ':quota': QUOTAS[service],
+                },
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        # full, or the service's item does not exist yet
+        if not reclaim_expired_leases(service):
+            return False
+    return False
+
+def reclaim_expired_leases(service):
+    item = admission_table.get_item(
+        Key={
+            'Service': service,
+        },
+        ConsistentRead=True,
+    ).get('Item')
+    if item is None or 'Leases' not in item:
+        admission_table.update_item(
+            Key={
+                'Service': service,
+            },
+            UpdateExpression='SET Leases = if_not_exists(Leases, :no_leases)',
+            ExpressionAttributeValues={
+                ':no_leases': {},
+            },
+        )
+        return True
+
+    now = int(time.time())
+    expired_lease_ids = [lease_id for lease_id, expires_at in item['Leases'].items() if expires_at <= now]
+    if not expired_lease_ids:
+        return False
+
+    names = {f'#lease_{index}': lease_id for index, lease_id in enumerate(expired_lease_ids)}
+    print(f'Reclaiming {len(expired_lease_ids)} expired {service} lease(s): {expired_lease_ids}')
+    try:
+        # only if none of them was renewed in the meantime
+        admission_table.update_item(
+            Key={
+                'Service': service,
+            },
+            UpdateExpression='REMOVE ' + ', '.join(f'Leases.{name}' for name in names),
+            ConditionExpression=' AND '.join(f'Leases.{name} <= :now' for name in names),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={
+                ':now': now,
+            },
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+    return True
+
+def release(service, lease_id):
+    admission_table.update_item(
+        Key={
+            'Service': service,
+        },
+        UpdateExpression='REMOVE Leases.#lease_id',
+        ExpressionAttributeNames={
+            '#lease_id': lease_id,
+        },
+    )
@@ -0,0 +1,230 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Shared by every function of the app (deployed as a Lambda layer): AWS clients are created on first use
+# from a single botocore session instead of at import time, so a cold start only pays for what it calls.
+
+import time
+
+IMPORT_STARTED = time.perf_counter()
+
+import boto3
+import collections
+import functools
+import json
+import os
+import threading
+
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+IMPORT_DURATION_MS = (time.perf_counter() - IMPORT_STARTED) * 1000
+
+# the pool has to cover the thread pools some handlers use, idle connections are reused by warm containers
+MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '32'))
+try:
+    CLIENT_CONFIG = Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        retries={'mode': 'standard'},
+        tcp_keepalive=True,
+    )
+except TypeError:  # botocore < 1.27 has no tcp_keepalive, connections are still pooled and reused
+    CLIENT_CONFIG = Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        retries={'mode': 'standard'},
+    )
+
+_lock = threading.RLock()
+_session = None
+_clients = {}
+_resources = {}
+_init_durations_ms = {}
+_cold_start = True
+
+# progress messages go out from a background thread while the handler carries on, and are flushed before it returns
+NOTIFY_FLUSH_TIMEOUT_SECONDS = float(os.environ.get('NOTIFY_FLUSH_TIMEOUT_SECONDS', '10'))
+# the client acts on these as whole messages, so they are never merged with others
+TERMINAL_MESSAGE_PREFIXES = ('s3://', 'ERROR -')
+# on top of botocore's own retries, a terminal message that fails (throttled, say) is posted again after a growing delay
+NOTIFY_MAX_ATTEMPTS = 4
+NOTIFY_RETRY_BASE_SECONDS = 0.2
+
+_notification_condition = threading.Condition()
+_pending_notifications = collections.OrderedDict()
+_notifications_in_flight = 0
+_notification_sender = None
+_gone_connection_ids = set()
+
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            started = time.perf_counter()
+            _session = boto3.session.Session()
+            _init_durations_ms['session'] = (time.perf_counter() - started) * 1000
+        return _session
+
+def client(service_name, config=None, **kwargs):
+    # config adds to CLIENT_CONFIG (the signature version of presigned URLs, say), pass a module-level one
+    cache_key = (service_name, id(config), tuple(sorted(kwargs.items())))
+    with _lock:
+        if cache_key not in _clients:
+            session = get_session()
+            started = time.perf_counter()
+            _clients[cache_key] = session.client(service_name, config=CLIENT_CONFIG.merge(config) if config else CLIENT_CONFIG, **kwargs)
+            _init_durations_ms[service_name] = _init_durations_ms.get(service_name, 0) + (time.perf_counter() - started) * 1000
+        return _clients[cache_key]
+
+def resource(service_name):
+    with _lock:
+        if service_name not in _resources:
+            session = get_session()
+            started = time.perf_counter()
+            _resources[service_name] = session.resource(service_name, config=CLIENT_CONFIG)
+            _init_durations_ms[f'{service_name}-resource'] = (time.perf_counter() - started) * 1000
+        return _resources[service_name]
+
+
+class LazyProxy:
+
+    # stands in for a module-level client/resource/table and creates it on first attribute access
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+
+    def __getattr__(self, name):
+        if self._target is None:
+            self._target = self._factory()
+        return getattr(self._target, name)
+
+
+def lazy_client(service_name, **kwargs):
+    return LazyProxy(lambda: client(service_name, **kwargs))
+
+def lazy_resource(service_name):
+    return LazyProxy(lambda: resource(service_name))
+
+def lazy_table(table_name):
+    return LazyProxy(lambda: resource('dynamodb').Table(table_name))
+
+def notify_user(message, connection_id):
+    global _notification_sender
+    with _notification_condition:
+        # jobs ingested from S3 (see convert_images_to_text.ingest_records) may have no WebSocket attached
+        if connection_id is None or connection_id in _gone_connection_ids:
+            return
+        _pending_notifications.setdefault(connection_id, []).append(message)
+        if _notification_sender is None:
+            _notification_sender = threading.Thread(target=send_notifications, name='notify-user', daemon=True)
+            _notification_sender.start()
+        _notification_condition.notify_all()
+
+def send_notifications():
+    # a single sender keeps the messages of a connection in order,
+    # whatever queues up while a message is in flight goes out in the next round
+    global _notifications_in_flight
+    while True:
+        with _notification_condition:
+            _notification_condition.wait_for(lambda: _pending_notifications)
+            connection_id, messages = _pending_notifications.popitem(last=False)
+            _notifications_in_flight += 1
+        try:
+            for message in coalesce_messages(messages):
+                if not post_to_connection(message, connection_id):
+                    break
+        finally:
+            with _notification_condition:
+                _notifications_in_flight -= 1
+                _notification_condition.notify_all()
+
+def coalesce_messages(messages):
+    progress_messages = []
+    for message in messages:
+        if message.startswith(TERMINAL_MESSAGE_PREFIXES):
+            if progress_messages:
+                yield '\n'.join(progress_messages)
+                progress_messages = []
+            yield message
+        else:
+            progress_messages.append(message)
+    if progress_messages:
+        yield '\n'.join(progress_messages)
+
+def post_to_connection(message, connection_id):
+    conversion_api_endpoint = os.environ['CONVERSION_API_ENDPOINT']
+    conversion_api_region = os.environ['CONVERSION_API_REGION']
+    apig_management_client = client(
+        'apigatewaymanagementapi',
+        endpoint_url=f'https://{conversion_api_endpoint}.execute-api.{conversion_api_region}.amazonaws.com/prod',
+    )
+    max_attempts = NOTIFY_MAX_ATTEMPTS if message.startswith(TERMINAL_MESSAGE_PREFIXES) else 1
+    for attempt in range(max_attempts):
+        try:
+            apig_management_client.post_to_connection(
+                Data=message,
+                ConnectionId=connection_id,
+            )
+            return True
+        except Exception as e:
+            # the user closed the page, the job itself carries on without progress messages
+            if isinstance(e, ClientError) and e.response['Error']['Code'] == 'GoneException':
+                with _notification_condition:
+                    _gone_connection_ids.add(connection_id)
+                    _pending_notifications.pop(connection_id, None)
+                print(f'Connection {connection_id} is gone, dropping its notifications')
+                return False
+            print(f'Failed to notify connection {connection_id} (attempt {attempt + 1} of {max_attempts}): {e!r}')
+            if attempt + 1 < max_attempts:
+                time.sleep(NOTIFY_RETRY_BASE_SECONDS * 2 ** attempt)
+    # only this message is lost, the ones after it still go out, the terminal ones are what the client waits for
+    print(f'Dropped a notification to connection {connection_id}: {message[:100]!r}')
+    return True
+
+def flush_notifications(timeout=NOTIFY_FLUSH_TIMEOUT_SECONDS):
+    with _notification_condition:
+        flushed = _notification_condition.wait_for(
+            lambda: not _pending_notifications and not _notifications_in_flight,
+            timeout,
+        )
+    if not flushed:
+        print(f'Notifications not sent within {timeout} seconds')
+
+def with_notifications(handler):
+    # Lambda freezes the sender thread once the handler returns, so nothing may be left in the queue
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            flush_notifications()
+    return wrapper
+
+def init_timings():
+    return {
+        'RuntimeImportMs': round(IMPORT_DURATION_MS, 3),
+        'ClientInitMs': {name: round(duration, 3) for name, duration in _init_durations_ms.items()},
+    }
+
+def log_cold_start(handler):
+    # logs the init timings once per container, after its first invocation created the clients it needed
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _cold_start
+        if not _cold_start:
+            return handler(event, context)
+
+        _cold_start = False
+        init_to_invoke_ms = (time.perf_counter() - IMPORT_STARTED) * 1000
+        started = time.perf_counter()
+        try:
+            return handler(event, context)
+        finally:
+            timings = {
+                'InitToInvokeMs': round(init_to_invoke_ms, 3),
+                'FirstInvokeMs': round((time.perf_counter() - started) * 1000, 3),
+                **init_timings(),
+            }
+            print(f'Cold start: {json.dumps(timings)}')
+    return wrapper
@@ -0,0 +1,104 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Batches of documents submitted in one request (see submit_batch). Every document runs as a job of its own,
+# without a WebSocket connection of its own; as the jobs finish, the batch item counts them, the batch's
+# connection gets the running totals and, after the last one, the s3:// URI of a manifest of all documents.
+
+import datetime
+import json
+import os
+
+from botocore.exceptions import ClientError
+
+from app_runtime import lazy_client, lazy_table, notify_user
+
+
+QUEUED = 'QUEUED'
+COMPLETED = 'COMPLETED'
+FAILED = 'FAILED'
+
+# progress goes out about this many times per batch, however many documents it has
+PROGRESS_STEPS = 100
+
+batch_table = lazy_table(f'{os.environ["APP_NAME"]}Batches')
+s3_client = lazy_client('s3')
+
+
+def get_manifest_s3_key(user_id, batch_id):
+    # downloadable through file_session like the audio and text of a job
+    return f'{user_id}/{batch_id}/manifest/manifest.json'
+
+def record_document_outcome(batch_id, app_job_id, audio_output_file_uri=None, error=None):
+    # does nothing for jobs outside a batch; a document is counted once, whatever reports it again
+    if not batch_id:
+        return
+
+    succeeded = error is None
+    try:
+        ddb_response = batch_table.update_item(
+            Key={
+                'BatchId': batch_id,
+            },
+            UpdateExpression='SET Documents.#app_job_id.#status = :status, Documents.#app_job_id.#outcome = :outcome ADD #count :one',
+            ConditionExpression='Documents.#app_job_id.#status = :queued',
+            ExpressionAttributeNames={
+                '#app_job_id': app_job_id,
+                '#status': 'Status',
+                '#outcome': 'AudioS3Uri' if succeeded else 'Error',
+                '#count': 'CompletedCount' if succeeded else 'FailedCount',
+            },
+            ExpressionAttributeValues={
+                ':status': COMPLETED if succeeded else FAILED,
+                ':outcome': audio_output_file_uri if succeeded else error,
+                ':queued': QUEUED,
+                ':one': 1,
+            },
+            ReturnValues='ALL_NEW',
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print(f'App Job {app_job_id} of batch {batch_id} was already recorded.')
+        return
+
+    batch = ddb_response['Attributes']
+    document_count = int(batch['DocumentCount'])
+    done_count = int(batch['CompletedCount'] + batch['FailedCount'])
+    if done_count % max(1, document_count // PROGRESS_STEPS) == 0 or done_count == document_count:
+        notify_user(f'Batch {batch_id}: {done_count} of {document_count} documents done, {int(batch["FailedCount"])} failed', batch['ConnectionId'])
+    # only the update that counted the last document gets here with all of them done
+    if done_count == document_count:
+        write_manifest(batch)
+
+def write_manifest(batch):
+    end_time_utc = datetime.datetime.utcnow().isoformat()
+    manifest_s3_key = get_manifest_s3_key(batch['UserId'], batch['BatchId'])
+    documents = sorted(batch['Documents'].items(), key=lambda document: document[1]['Index'])
+    manifest = {
+        'BatchId': batch['BatchId'],
+        'UserId': batch['UserId'],
+        'StartTime': batch['StartTime'],
+        'EndTime': end_time_utc,
+        'DocumentCount': batch['DocumentCount'],
+        'CompletedCount': batch['CompletedCount'],
+        'FailedCount': batch['FailedCount'],
+        'Documents': [dict(JobId=app_job_id, **document) for app_job_id, document in documents],
+    }
+    s3_client.put_object(
+        Body=json.dumps(manifest, indent=2, default=int).encode('utf-8'),  # DynamoDB numbers come back as Decimal
+        Bucket=batch['Bucket'],
+        Key=manifest_s3_key,
+        ContentType='application/json',
+    )
+    batch_table.update_item(
+        Key={
+            'BatchId': batch['BatchId'],
+        },
+        UpdateExpression='SET EndTime = :end_time, ManifestS3Key = :manifest_s3_key',
+        ExpressionAttributeValues={
+            ':end_time': end_time_utc,
+            ':manifest_s3_key': manifest_s3_key,
+        },
+    )
+    notify_user(f's3://{batch["Bucket"]}/{manifest_s3_key}', batch['ConnectionId'])
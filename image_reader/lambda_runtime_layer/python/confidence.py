@@ -0,0 +1,102 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Per-job confidence limits for the lines Textract reads, either given with the request or,
+# with 'auto', picked from the document's own confidence histogram, and a report of what they dropped.
+
+import decimal
+
+
+ADAPTIVE_CONFIDENCE_LIMIT = 'auto'
+# an adaptive limit stays within these, whatever the document looks like
+MIN_ADAPTIVE_CONFIDENCE_LIMIT = 50.0
+MAX_ADAPTIVE_CONFIDENCE_LIMIT = 90.0
+# the low and the high confidence lines need to be this far apart to be told apart, or nothing much is dropped
+MIN_CONFIDENCE_CLASS_DISTANCE = 20.0
+# recorded on the job item, 10 points per bin
+REPORT_HISTOGRAM_BINS = 10
+
+
+def parse_confidence_limit(value, default):
+    if value is None or value == '':
+        value = default
+    if str(value).strip().lower() == ADAPTIVE_CONFIDENCE_LIMIT:
+        return ADAPTIVE_CONFIDENCE_LIMIT
+
+    confidence_limit = float(value)
+    if not 0 <= confidence_limit <= 100:
+        raise ValueError(f'Confidence limit {value} is not between 0 and 100 or "{ADAPTIVE_CONFIDENCE_LIMIT}".')
+    return confidence_limit
+
+def format_confidence_limit(confidence_limit):
+    # as stored on the job item and in the cache key, 80 rather than 80.0
+    if confidence_limit == ADAPTIVE_CONFIDENCE_LIMIT:
+        return confidence_limit
+    return f'{confidence_limit:g}'
+
+def choose_confidence_limit(line_blocks_chunks):
+    # Otsu's threshold over a histogram of 1-point bins: the limit that best separates
+    # low from high confidence lines, as long as the document has both
+    histogram = [0] * 101
+    for line_blocks in line_blocks_chunks:
+        for confidence in line_blocks.confidence:
+            histogram[int(confidence)] += 1
+
+    line_count = sum(histogram)
+    total = sum(score * count for score, count in enumerate(histogram))
+    best_limit, best_variance, best_distance = MIN_ADAPTIVE_CONFIDENCE_LIMIT, 0.0, 0.0
+    low_count, low_total = 0, 0
+    for score in range(100):
+        low_count += histogram[score]
+        low_total += score * histogram[score]
+        high_count = line_count - low_count
+        if not low_count or not high_count:
+            continue
+        distance = (total - low_total) / high_count - low_total / low_count
+        variance = low_count * high_count * distance ** 2
+        if variance > best_variance:
+            best_limit, best_variance, best_distance = score + 1, variance, distance
+
+    if best_distance < MIN_CONFIDENCE_CLASS_DISTANCE:
+        return MIN_ADAPTIVE_CONFIDENCE_LIMIT
+    return min(max(float(best_limit), MIN_ADAPTIVE_CONFIDENCE_LIMIT), MAX_ADAPTIVE_CONFIDENCE_LIMIT)
+
+
+class ConfidenceReport:
+
+    def __init__(self, confidence_limit):
+        self.confidence_limit = confidence_limit
+        self.line_count = 0
+        self.dropped_line_count = 0
+        self.histogram = [0] * REPORT_HISTOGRAM_BINS
+
+    def tally(self, line_blocks_chunks):
+        # passes the chunks through, counting their lines on the way
+        for line_blocks in line_blocks_chunks:
+            for confidence in line_blocks.confidence:
+                self.histogram[min(int(confidence) * REPORT_HISTOGRAM_BINS // 100, REPORT_HISTOGRAM_BINS - 1)] += 1
+                if confidence < self.confidence_limit:
+                    self.dropped_line_count += 1
+            self.line_count += len(line_blocks)
+            yield line_blocks
+
+    def to_item_attributes(self):
+        return {
+            'ConfidenceLimitUsed': decimal.Decimal(format_confidence_limit(self.confidence_limit)),
+            'LineCount': self.line_count,
+            'DroppedLineCount': self.dropped_line_count,
+            'ConfidenceHistogram': self.histogram,
+        }
+
+    def summary(self):
+        return f'Dropped {self.dropped_line_count} of {self.line_count} lines below confidence {format_confidence_limit(self.confidence_limit)}'
+
+
+def apply_confidence_limit(line_blocks_chunks, confidence_limit):
+    # returns the chunks to read the lines from, with the report on them filled in as they are read;
+    # an adaptive limit needs every confidence first, so the (compact) chunks are all held
+    if confidence_limit == ADAPTIVE_CONFIDENCE_LIMIT:
+        line_blocks_chunks = list(line_blocks_chunks)
+        confidence_limit = choose_confidence_limit(line_blocks_chunks)
+    confidence_report = ConfidenceReport(confidence_limit)
+    return confidence_report.tally(line_blocks_chunks), confidence_report
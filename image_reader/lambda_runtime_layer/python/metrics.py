@@ -0,0 +1,113 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Per-stage timings, sizes and billable units as CloudWatch embedded metrics: one JSON line per job and stage
+# on stdout, which CloudWatch Logs turns into metrics of the {APP_NAME} namespace by Stage, while the job id
+# and the other properties stay in the log line for CloudWatch Logs Insights. Nothing is sent from the function.
+
+import contextlib
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE') or os.environ['APP_NAME']
+
+MILLISECONDS = 'Milliseconds'
+BYTES = 'Bytes'
+COUNT = 'Count'
+
+
+def utc_now():
+    # the format of StartTime and the other <stage>Time attributes of a job
+    return datetime.datetime.utcnow().isoformat()
+
+def elapsed_ms(since, until=None):
+    # between two of those, or ISO 8601 times with a Z as S3 events have them
+    if not since:
+        return None
+    until = datetime.datetime.fromisoformat(until.rstrip('Z')) if until else datetime.datetime.utcnow()
+    # times taken by different services, e.g. Textract's notification in whole milliseconds, may be a bit off
+    return max(0, (until - datetime.datetime.fromisoformat(since.rstrip('Z'))).total_seconds() * 1000)
+
+
+class Metrics:
+
+    # collects the metrics of the job a handler works on, until flush writes them out
+
+    def __init__(self, stage):
+        self.stage = stage
+        self._lock = threading.Lock()
+        self._values = {}
+        self._units = {}
+
+    def put(self, name, value, unit=COUNT):
+        # values put under the same name add up, e.g. the pages of every Textract response
+        if value is None:
+            return
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+            self._units[name] = unit
+
+    def get(self, name):
+        return self._values.get(name, 0)
+
+    @contextlib.contextmanager
+    def timer(self, name, exclude=()):
+        # less what was put under the names in exclude meanwhile, e.g. by an iterable timed on its own
+        started = time.perf_counter()
+        excluded_before = sum(self.get(excluded_name) for excluded_name in exclude)
+        try:
+            yield
+        finally:
+            excluded = sum(self.get(excluded_name) for excluded_name in exclude) - excluded_before
+            self.put(name, (time.perf_counter() - started) * 1000 - excluded, MILLISECONDS)
+
+    def timed(self, iterable, name):
+        # only the time spent producing the items, not the time their consumer spends on them
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.put(name, (time.perf_counter() - started) * 1000, MILLISECONDS)
+                return
+            self.put(name, (time.perf_counter() - started) * 1000, MILLISECONDS)
+            yield item
+
+    def flush(self, **properties):
+        with self._lock:
+            values, units = self._values, self._units
+            self._values, self._units = {}, {}
+        if not values:
+            return
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [['Stage']],
+                    'Metrics': [{'Name': name, 'Unit': units[name]} for name in values],
+                }],
+            },
+            'Stage': self.stage,
+            **{name: value for name, value in properties.items() if value is not None},
+            **{name: round(value, 3) for name, value in values.items()},
+        }))
+
+
+def with_metrics(metrics):
+    # whatever a handler left unflushed, a failed invocation included, goes out before it returns
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            try:
+                return handler(event, context)
+            finally:
+                metrics.flush()
+        return wrapper
+    return decorator
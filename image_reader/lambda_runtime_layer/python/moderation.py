@@ -0,0 +1,185 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Aho-Corasick over word tokens: a list of undesirable words and phrases is compiled ahead of time
+# (see upload-moderation-lexicon.py) into a lexicon in S3, which every container loads once and re-validates
+# by ETag. Text is then scanned in a single pass whatever the size of the list, while it is being read.
+
+import collections
+import gzip
+import json
+import os
+import re
+import time
+import unicodedata
+
+from botocore.exceptions import ClientError
+
+from app_runtime import client
+
+
+# letters and digits, apostrophes only inside a word ("don't"), punctuation around it is dropped
+TOKEN_RE = re.compile(r"[^\W_]+(?:['’][^\W_]+)*")
+
+Match = collections.namedtuple('Match', ['phrase', 'line', 'column'])
+
+LEXICON_FORMAT_VERSION = 1
+LEXICON_S3_KEY = os.environ.get('MODERATION_LEXICON_S3_KEY', 'moderation/lexicon.json.gz')
+LEXICON_REFRESH_SECONDS = float(os.environ.get('MODERATION_LEXICON_REFRESH_SECONDS', '60'))
+
+
+def normalize_token(token):
+    return unicodedata.normalize('NFKC', token).casefold().replace('’', "'")
+
+def tokenize(line):
+    for match in TOKEN_RE.finditer(line):
+        yield match.start(), normalize_token(match.group())
+
+def read_moderated_lines(lines, lexicon):
+    # scans the lines while they are read, at the first undesirable phrase the rest is left unread
+    if not lexicon:
+        return list(lines), None
+
+    read_lines = []
+
+    def read():
+        for line in lines:
+            read_lines.append(line)
+            yield line
+
+    return read_lines, next(lexicon.scan(read()), None)
+
+def load_phrases(lines):
+    # one word or phrase per line, blank lines and lines starting with # are skipped
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+class Automaton:
+
+    def __init__(self, phrases):
+        # state 0 is the root, goto[state] maps the next token to a state
+        self.goto = [{}]
+        self.fail = [0]
+        # (number of tokens, phrase) for every phrase that ends in a state, including via its fail links
+        self.output = [[]]
+        self.phrase_count = 0
+
+        for phrase in phrases:
+            tokens = [token for _, token in tokenize(phrase)]
+            if not tokens:
+                continue
+            state = 0
+            for token in tokens:
+                if token not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][token] = len(self.goto) - 1
+                state = self.goto[state][token]
+            if not self.output[state]:
+                self.phrase_count += 1
+            self.output[state] = [(len(tokens), ' '.join(tokens))]
+        self.max_phrase_tokens = max((length for outputs in self.output for length, _ in outputs), default=0)
+        self.build_fail_links()
+
+    def build_fail_links(self):
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and token not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(token, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def to_bytes(self):
+        # only the trie and the phrases ending in each state, the fail links are rebuilt on load in linear time
+        own_output = [
+            outputs[:1] if outputs and outputs[0] not in self.output[self.fail[state]] else []
+            for state, outputs in enumerate(self.output)
+        ]
+        return gzip.compress(json.dumps({
+            'Version': LEXICON_FORMAT_VERSION,
+            'PhraseCount': self.phrase_count,
+            'Goto': self.goto,
+            'Output': own_output,
+        }, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+
+    @classmethod
+    def from_bytes(cls, data):
+        lexicon = json.loads(gzip.decompress(data).decode('utf-8'))
+        if lexicon['Version'] != LEXICON_FORMAT_VERSION:
+            raise ValueError(f'Unsupported moderation lexicon version {lexicon["Version"]}.')
+
+        automaton = cls([])
+        automaton.goto = lexicon['Goto']
+        automaton.fail = [0] * len(automaton.goto)
+        automaton.output = [[tuple(output) for output in outputs] for outputs in lexicon['Output']]
+        automaton.phrase_count = lexicon['PhraseCount']
+        automaton.max_phrase_tokens = max((length for outputs in automaton.output for length, _ in outputs), default=0)
+        automaton.build_fail_links()
+        return automaton
+
+    def __bool__(self):
+        return self.phrase_count > 0
+
+    def scan(self, lines):
+        # phrases may span line breaks, positions are 1-based and point at the phrase's first token
+        state = 0
+        positions = collections.deque(maxlen=self.max_phrase_tokens or 1)
+        for line_number, line in enumerate(lines, start=1):
+            for column, token in tokenize(line):
+                positions.append((line_number, column + 1))
+                while state and token not in self.goto[state]:
+                    state = self.fail[state]
+                state = self.goto[state].get(token, 0)
+                for length, phrase in self.output[state]:
+                    yield Match(phrase, *positions[-length])
+
+
+_lexicon = Automaton([])
+_lexicon_etag = None
+_lexicon_checked_at = None
+
+
+def get_lexicon(bucket_name, key=LEXICON_S3_KEY):
+    # kept for the life of the container, re-validated at most every LEXICON_REFRESH_SECONDS
+    # so an uploaded list takes effect under load without a deploy
+    global _lexicon, _lexicon_etag, _lexicon_checked_at
+    now = time.monotonic()
+    if _lexicon_checked_at is not None and now - _lexicon_checked_at < LEXICON_REFRESH_SECONDS:
+        return _lexicon
+
+    try:
+        s3_resp = client('s3').get_object(
+            Bucket=bucket_name,
+            Key=key,
+            **({'IfNoneMatch': _lexicon_etag} if _lexicon_etag else {}),
+        )
+        _lexicon = Automaton.from_bytes(s3_resp['Body'].read())
+        _lexicon_etag = s3_resp['ETag']
+        print(f'Loaded moderation lexicon s3://{bucket_name}/{key} with {_lexicon.phrase_count} phrase(s)')
+    except ClientError as e:
+        error_code = e.response['Error']['Code']
+        if error_code in ('304', 'NotModified'):
+            pass
+        elif error_code in ('NoSuchKey', '404'):
+            # no list uploaded (or it was deleted), nothing is undesirable
+            _lexicon = Automaton([])
+            _lexicon_etag = None
+        elif _lexicon_etag is not None:
+            print(f'Failed to refresh moderation lexicon s3://{bucket_name}/{key}, keeping the loaded one: {e!r}')
+        else:
+            raise
+    _lexicon_checked_at = now
+    return _lexicon
+
+def get_lexicon_version(bucket_name, key=LEXICON_S3_KEY):
+    # part of the result cache key: results moderated with another lexicon are not served once it changes
+    get_lexicon(bucket_name, key)
+    return _lexicon_etag.strip('"') if _lexicon_etag else 'none'
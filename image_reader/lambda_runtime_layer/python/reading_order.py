@@ -0,0 +1,239 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Puts Textract LINE blocks into reading order, one page at a time as the blocks stream in:
+# running headers/footers and page numbers are dropped, columns are read top to bottom, left to right.
+
+import array
+import collections
+import itertools
+import re
+
+
+# Textract geometry is relative to the page, lines starting above/below these are page margins
+HEADER_BAND = 0.08
+FOOTER_BAND = 0.92
+# narrower white space between two runs of text does not separate columns
+MIN_COLUMN_GAP = 0.015
+# a column of text holds a few lines and is wider than a form's labels or a centered heading
+MIN_COLUMN_LINES = 3
+MIN_COLUMN_WIDTH = 0.2
+# columns sit side by side over at least this share of the shortest of them, not one above the other
+MIN_SHARED_COLUMN_SPAN = 0.5
+# running headers/footers repeat on every page, or every other page on facing pages
+RUNNING_MARGIN_TEXT_PAGES = 2
+
+ROMAN_NUMERAL = r'(?=[mdclxvi])m{0,3}(?:cm|cd|d?c{0,3})(?:xc|xl|l?x{0,3})(?:ix|iv|v?i{0,3})'
+PAGE_NUMBER_RE = re.compile(rf'^[-–—\s]*(?:page\s*)?(?:\d+|{ROMAN_NUMERAL})(?:\s*(?:of|/)\s*\d+)?[-–—\s]*$', re.IGNORECASE)
+DIGITS_RE = re.compile(r'\d+')
+
+Line = collections.namedtuple('Line', ['text', 'left', 'top', 'width', 'height'])
+
+
+def iter_ordered_lines(line_blocks_chunks, confidence_limit):
+    # chunks come page after page (GetDocumentTextDetection pages through the blocks in that order),
+    # only the lines of the current page are held as objects
+    reading_order = ReadingOrder()
+    page = None
+    page_lines = []
+    for line_blocks in line_blocks_chunks:
+        for index in line_blocks.confident(confidence_limit):
+            if line_blocks.page[index] != page:
+                yield from reading_order.order_page(page_lines)
+                page = line_blocks.page[index]
+                page_lines = []
+            page_lines.append(line_blocks.line(index))
+    yield from reading_order.order_page(page_lines)
+
+
+class LineBlocks:
+
+    # the LINE blocks of a Textract response as parallel arrays, of a few bytes per line;
+    # WORD blocks, polygons, relationships and ids go with the response
+
+    __slots__ = ('text', 'page', 'confidence', 'left', 'top', 'width', 'height')
+
+    def __init__(self, blocks=()):
+        self.text = []
+        self.page = array.array('I')
+        self.confidence = array.array('d')  # compared against the limit as it is
+        self.left = array.array('f')
+        self.top = array.array('f')
+        self.width = array.array('f')
+        self.height = array.array('f')
+        for block in blocks:
+            if block['BlockType'] != 'LINE':
+                continue
+            bounding_box = block['Geometry']['BoundingBox']
+            self.text.append(block['Text'])
+            # DetectDocumentText leaves Page out, it only reads single pages
+            self.page.append(block.get('Page', 1))
+            self.confidence.append(block['Confidence'])
+            self.left.append(bounding_box['Left'])
+            self.top.append(bounding_box['Top'])
+            self.width.append(bounding_box['Width'])
+            self.height.append(bounding_box['Height'])
+
+    def __len__(self):
+        return len(self.text)
+
+    def to_dict(self):
+        # geometry to 9 significant digits, which is what a float32 needs to come back the same
+        return {
+            'Text': self.text,
+            'Page': self.page.tolist(),
+            'Confidence': self.confidence.tolist(),
+            'Left': [float(f'{value:.9g}') for value in self.left],
+            'Top': [float(f'{value:.9g}') for value in self.top],
+            'Width': [float(f'{value:.9g}') for value in self.width],
+            'Height': [float(f'{value:.9g}') for value in self.height],
+        }
+
+    @classmethod
+    def from_dict(cls, line_blocks_dict):
+        line_blocks = cls()
+        line_blocks.text = line_blocks_dict['Text']
+        line_blocks.page.fromlist(line_blocks_dict['Page'])
+        line_blocks.confidence.fromlist(line_blocks_dict['Confidence'])
+        line_blocks.left.fromlist(line_blocks_dict['Left'])
+        line_blocks.top.fromlist(line_blocks_dict['Top'])
+        line_blocks.width.fromlist(line_blocks_dict['Width'])
+        line_blocks.height.fromlist(line_blocks_dict['Height'])
+        return line_blocks
+
+    def confident(self, confidence_limit):
+        # indexes of the lines at or above the limit, one pass over the confidence column
+        return itertools.compress(range(len(self.confidence)), [confidence >= confidence_limit for confidence in self.confidence])
+
+    def line(self, index):
+        return Line(self.text[index], self.left[index], self.top[index], self.width[index], self.height[index])
+
+
+class ReadingOrder:
+
+    def __init__(self):
+        self.page_index = 0
+        # margin text -> page it was last seen on, repeats on the next pages are running headers/footers
+        self.margin_texts = {}
+
+    def order_page(self, lines):
+        if not lines:
+            return []
+
+        self.page_index += 1
+        # kept margin lines (a title above the columns, say) go before/after the body and do not shape its columns
+        header_lines, body_lines, footer_lines = [], [], []
+        for line in sorted(lines, key=lambda line: (line.top, line.left)):
+            if is_in_margin(line):
+                if not self.is_page_furniture(line):
+                    (header_lines if line.top < HEADER_BAND else footer_lines).append(line)
+            else:
+                body_lines.append(line)
+        return [line.text for line in header_lines] + order_body_lines(body_lines) + [line.text for line in footer_lines]
+
+    def is_page_furniture(self, line):
+        if PAGE_NUMBER_RE.match(line.text):
+            return True
+        # the first occurrence is kept, it may well be the title of the document,
+        # text that only comes back pages later (a chapter heading) is kept as well
+        margin_text = DIGITS_RE.sub('#', ' '.join(line.text.lower().split()))
+        last_seen_page_index = self.margin_texts.get(margin_text)
+        self.margin_texts[margin_text] = self.page_index
+        return last_seen_page_index is not None and self.page_index - last_seen_page_index <= RUNNING_MARGIN_TEXT_PAGES
+
+
+def is_in_margin(line):
+    return line.top < HEADER_BAND or line.top + line.height > FOOTER_BAND
+
+def order_body_lines(lines):
+    # lines come sorted top to bottom
+    if not lines:
+        return []
+
+    columns = find_columns(lines)
+    if len(columns) == 1:
+        return [line.text for row in group_rows(lines) for line in row]
+
+    # a line across several columns (a title, a figure caption) ends one row of columns and starts the next
+    ordered_lines = []
+    row = [[] for _ in columns]
+    for line in lines:
+        overlapped = [index for index, column in enumerate(columns) if overlaps(line, column)]
+        if len(overlapped) > 1:
+            ordered_lines.extend(line.text for column_lines in row for line in column_lines)
+            ordered_lines.append(line.text)
+            row = [[] for _ in columns]
+        else:
+            row[overlapped[0] if overlapped else nearest_column(line, columns)].append(line)
+    ordered_lines.extend(line.text for column_lines in row for line in column_lines)
+    return ordered_lines
+
+def group_rows(lines):
+    # lines side by side (a label and its value) make one row, read left to right
+    rows = []
+    for line in lines:
+        if rows and line.top < rows[-1][0].top + rows[-1][0].height / 2:
+            rows[-1].append(line)
+        else:
+            rows.append([line])
+    return [sorted(row, key=lambda line: line.left) for row in rows]
+
+def find_columns(lines):
+    # merges the horizontal extents of the lines, separate runs are columns;
+    # lines wider than half the page would bridge the gutter and are left out
+    narrow_lines = sorted((line for line in lines if line.width < 0.5), key=lambda line: line.left)
+    if not narrow_lines:
+        return [[min(line.left for line in lines), max(line.left + line.width for line in lines)]]
+
+    runs = [Run(narrow_lines[0])]
+    for line in narrow_lines[1:]:
+        if line.left - runs[-1].right < MIN_COLUMN_GAP:
+            runs[-1].add(line)
+        else:
+            runs.append(Run(line))
+
+    # runs too short or too narrow to be columns of text go with the nearer of their neighbours
+    while len(runs) > 1:
+        index = min(range(len(runs)), key=lambda index: (runs[index].is_column(), runs[index].line_count))
+        if runs[index].is_column():
+            break
+        if index == 0 or (index < len(runs) - 1 and runs[index + 1].left - runs[index].right < runs[index].left - runs[index - 1].right):
+            runs[index].merge(runs.pop(index + 1))
+        else:
+            runs[index - 1].merge(runs.pop(index))
+
+    shared_span = min(run.bottom for run in runs) - max(run.top for run in runs)
+    if len(runs) > 1 and shared_span < MIN_SHARED_COLUMN_SPAN * min(run.bottom - run.top for run in runs):
+        return [[runs[0].left, max(run.right for run in runs)]]
+    return [[run.left, run.right] for run in runs]
+
+class Run:
+
+    # a candidate column: the horizontal extent of the lines it holds and the height they span
+
+    def __init__(self, line):
+        self.left, self.right = line.left, line.left + line.width
+        self.top, self.bottom = line.top, line.top + line.height
+        self.line_count = 1
+
+    def add(self, line):
+        self.right = max(self.right, line.left + line.width)
+        self.top = min(self.top, line.top)
+        self.bottom = max(self.bottom, line.top + line.height)
+        self.line_count += 1
+
+    def merge(self, run):
+        self.left, self.right = min(self.left, run.left), max(self.right, run.right)
+        self.top, self.bottom = min(self.top, run.top), max(self.bottom, run.bottom)
+        self.line_count += run.line_count
+
+    def is_column(self):
+        return self.line_count >= MIN_COLUMN_LINES and self.right - self.left >= MIN_COLUMN_WIDTH
+
+
+def overlaps(line, column):
+    return line.left < column[1] and line.left + line.width > column[0]
+
+def nearest_column(line, columns):
+    center = line.left + line.width / 2
+    return min(range(len(columns)), key=lambda index: abs(center - (columns[index][0] + columns[index][1]) / 2))
@@ -0,0 +1,60 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Textract and Polly notifications come in batches of SNS records (see on_textract_ready and on_polly_ready):
+# the job items of a batch are read at once, and a record that fails is reported without failing the others.
+
+import time
+
+import admission
+
+from app_runtime import lazy_resource
+
+
+# BatchGetItem takes at most this many keys
+BATCH_GET_MAX_KEYS = 100
+# keys DynamoDB could not read (throttled, say) are read again after a jittered delay
+UNPROCESSED_KEYS_BASE_SECONDS = 0.05
+UNPROCESSED_KEYS_MAX_SECONDS = 2
+
+ddb_resource = lazy_resource('dynamodb')
+
+
+def batch_get_items(table, key_name, key_values, **request_options):
+    items = {}
+    keys = [{key_name: key_value} for key_value in key_values]
+    while keys:
+        request_items = {
+            table.name: {
+                'Keys': keys[:BATCH_GET_MAX_KEYS],
+                **request_options,
+            },
+        }
+        keys = keys[BATCH_GET_MAX_KEYS:]
+        attempt = 0
+        while True:
+            ddb_response = ddb_resource.batch_get_item(RequestItems=request_items)
+            for item in ddb_response['Responses'].get(table.name, []):
+                items[item[key_name]] = item
+            request_items = ddb_response.get('UnprocessedKeys')
+            if not request_items:
+                break
+            time.sleep(admission.backoff_delay(attempt, UNPROCESSED_KEYS_BASE_SECONDS, UNPROCESSED_KEYS_MAX_SECONDS))
+            attempt += 1
+    return items
+
+def record_failure(sns_record, error):
+    print(f'Failed to process SNS message {sns_record["Sns"].get("MessageId")}: {error!r}')
+    return {
+        'MessageId': sns_record['Sns'].get('MessageId'),
+        'Error': repr(error),
+    }
+
+def report_failures(records, failures, service_name):
+    # one bad record does not fail the others, only a batch where nothing succeeded is raised for a retry
+    if failures and len(failures) == len(records):
+        raise RuntimeError(f'Failed to process all {len(records)} {service_name} notifications: {failures}.')
+    return {
+        'Processed': len(records) - len(failures),
+        'Failures': failures,
+    }
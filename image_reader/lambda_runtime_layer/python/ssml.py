@@ -0,0 +1,117 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Turns the OCR lines of text.txt into SSML for Polly: words hyphenated across line breaks are rejoined,
+# lines are joined into sentences and paragraphs, and the document is cut into <speak> documents on
+# sentence boundaries so each synthesis task reads whole sentences.
+
+import re
+
+from xml.sax.saxutils import escape
+
+
+DEFAULT_SPEECH_RATE = '100%'
+
+# a letter followed by a hyphen (or a soft hyphen, or the ¬ some OCR makes of one) at the end of a line
+HYPHENATED_LINE_END_RE = re.compile(r'(?<=[^\W\d_])[-\u00ad\u2010\u2011¬]$')
+SENTENCE_END_RE = re.compile(r'[.!?…]+["\'”’)\]]*$')
+# a possible sentence end inside a paragraph, confirmed by what comes before and after it
+SENTENCE_BOUNDARY_RE = re.compile(r'[.!?…]+["\'”’)\]]*\s+')
+OPENING_PUNCTUATION = '"\'“‘(['
+# a period after these does not end the sentence ("Dr. Smith", "e.g. The"), nor does one after an initial
+ABBREVIATIONS = frozenset((
+    'mr', 'mrs', 'ms', 'dr', 'prof', 'st', 'jr', 'sr', 'vs', 'etc', 'e.g', 'i.e', 'cf', 'fig', 'no', 'vol', 'pp', 'inc', 'ltd', 'co',
+))
+
+# lines shorter than this share of a full line end their paragraph when they end a sentence,
+# and are a heading of their own when they start one without ending it
+SHORT_LINE_RATIO = 0.8
+HEADING_LINE_RATIO = 0.5
+
+
+def iter_paragraphs(lines):
+    lines = [' '.join(line.split()) for line in lines]
+    # most lines of a page run the full width of their column, the longer ones give its length
+    line_lengths = sorted(len(line) for line in lines if line)
+    full_line_length = line_lengths[len(line_lengths) * 3 // 4] if line_lengths else 0
+
+    paragraph = ''
+    for index, line in enumerate(lines):
+        if not line:
+            if paragraph:
+                yield paragraph
+            paragraph = ''
+            continue
+
+        next_line = lines[index + 1] if index + 1 < len(lines) else ''
+        if not paragraph and len(line) < HEADING_LINE_RATIO * full_line_length and not SENTENCE_END_RE.search(line) and next_line[:1].isupper():
+            yield line
+            continue
+
+        if HYPHENATED_LINE_END_RE.search(paragraph) and line[0].islower():
+            paragraph = paragraph[:-1] + line
+        else:
+            paragraph = f'{paragraph} {line}' if paragraph else line
+
+        if len(line) < SHORT_LINE_RATIO * full_line_length and SENTENCE_END_RE.search(line):
+            yield paragraph
+            paragraph = ''
+    if paragraph:
+        yield paragraph
+
+def split_sentences(paragraph):
+    sentences = []
+    start = 0
+    for match in SENTENCE_BOUNDARY_RE.finditer(paragraph):
+        following = paragraph[match.end():].lstrip(OPENING_PUNCTUATION)[:1]
+        if not (following.isupper() or following.isdigit()):
+            continue
+        words = paragraph[start:match.start()].split()
+        last_word = words[-1].lstrip(OPENING_PUNCTUATION).lower() if words else ''
+        if match.group().startswith('.') and (last_word in ABBREVIATIONS or (len(last_word) == 1 and last_word.isalpha())):
+            continue
+        sentences.append(paragraph[start:match.end()].strip())
+        start = match.end()
+    if paragraph[start:].strip():
+        sentences.append(paragraph[start:].strip())
+    return sentences
+
+def cut_text(text, max_characters):
+    # a single sentence longer than a chunk is cut at the last whitespace that fits
+    while len(text) > max_characters:
+        cut = text.rfind(' ', 1, max_characters)
+        if cut <= 0:
+            cut = max_characters
+        yield text[:cut].strip()
+        text = text[cut:].strip()
+    if text:
+        yield text
+
+def to_ssml_chunks(lines, max_chunk_characters, speech_rate=DEFAULT_SPEECH_RATE):
+    # max_chunk_characters counts the text Polly bills, the tags around it are not billed
+    chunks = []
+    chunk_paragraphs = []
+    chunk_characters = 0
+    for paragraph in iter_paragraphs(lines):
+        chunk_paragraphs.append([])
+        for sentence in split_sentences(paragraph):
+            for text in cut_text(sentence, max_chunk_characters):
+                if chunk_characters + len(text) > max_chunk_characters and chunk_characters:
+                    chunks.append(render_ssml(chunk_paragraphs, speech_rate))
+                    # the paragraph goes on in the next chunk
+                    chunk_paragraphs = [[]]
+                    chunk_characters = 0
+                chunk_paragraphs[-1].append(text)
+                chunk_characters += len(text) + 1
+    if chunk_characters:
+        chunks.append(render_ssml(chunk_paragraphs, speech_rate))
+    return chunks
+
+def render_ssml(paragraphs, speech_rate):
+    body = ''.join(
+        '<p>' + ''.join(f'<s>{escape(sentence)}</s>' for sentence in sentences) + '</p>'
+        for sentences in paragraphs if sentences
+    )
+    if speech_rate != DEFAULT_SPEECH_RATE:
+        body = f'<prosody rate="{escape(speech_rate)}">{body}</prosody>'
+    return f'<speak>{body}</speak>'
@@ -0,0 +1,61 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# The LINE blocks Textract returned for a job, kept next to its text as gzipped JSON lines (one line per
+# response page), so finished jobs can be filtered, ordered and moderated again without running Textract.
+
+import gzip
+import io
+import json
+
+from app_runtime import client
+from reading_order import LineBlocks
+
+
+TEXTRACT_OUTPUT_FORMAT_VERSION = 1
+
+
+def get_textract_output_s3_key(user_id, app_job_id):
+    return f'{user_id}/{app_job_id}/textract/lines.jsonl.gz'
+
+
+class TextractOutputWriter:
+
+    def __init__(self):
+        # only the compressed output is held while the pages stream through
+        self.buffer = io.BytesIO()
+        self.gzip_file = gzip.GzipFile(fileobj=self.buffer, mode='wb')
+        self.write_line({'Version': TEXTRACT_OUTPUT_FORMAT_VERSION})
+
+    def write_line(self, value):
+        self.gzip_file.write(json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+        self.gzip_file.write(b'\n')
+
+    def record(self, line_blocks_chunks):
+        # passes the chunks through, writing each of them on the way
+        for line_blocks in line_blocks_chunks:
+            self.write_line(line_blocks.to_dict())
+            yield line_blocks
+
+    def upload(self, bucket_name, key):
+        self.gzip_file.close()
+        client('s3').put_object(
+            Body=self.buffer.getvalue(),
+            Bucket=bucket_name,
+            Key=key,
+            ContentType='application/gzip',
+        )
+
+
+def iter_stored_line_blocks(bucket_name, key):
+    # same chunks as the Textract pages they were written from, decompressed as they are read
+    s3_resp = client('s3').get_object(
+        Bucket=bucket_name,
+        Key=key,
+    )
+    with gzip.GzipFile(fileobj=s3_resp['Body'], mode='rb') as gzip_file:
+        header = json.loads(gzip_file.readline())
+        if header.get('Version') != TEXTRACT_OUTPUT_FORMAT_VERSION:
+            raise ValueError(f'Unsupported Textract output version {header.get("Version")} in s3://{bucket_name}/{key}.')
+        for line in gzip_file:
+            yield LineBlocks.from_dict(json.loads(line))
@@ -4,22 +4,48 @@
 import pathlib
 
 from aws_cdk.aws_apigatewayv2 import CfnApi
-from aws_cdk.aws_iam import ManagedPolicy, Role, ServicePrincipal
-from aws_cdk.aws_lambda import Code, Function, LayerVersion, Runtime
+from aws_cdk.aws_iam import ManagedPolicy, PolicyStatement, Role, ServicePrincipal
+from aws_cdk.aws_lambda import Code, EventSourceMapping, Function, LayerVersion, Runtime
 from aws_cdk.aws_s3 import Bucket
 from aws_cdk.aws_sns import Topic
-from aws_cdk.core import Aws, Construct, Stack
+from aws_cdk.aws_sqs import Queue
+from aws_cdk.core import Aws, Construct, Duration, Stack
+
+from image_reader.s3_stack import INGESTION_MAX_RECEIVE_COUNT
+from image_reader.step_functions_stack import get_state_machine_name
 
 
 TAG_NAME = 'app'
+# img2pdf holds up to the 200 MB of images convert_images_to_text.MAX_PDF_INPUT_BYTES allows for one PDF
+PDF_CONVERSION_MEMORY_SIZE = 1536
 
 
 class LambdaStack(Stack):
 
-    def __init__(self, scope: Construct, construct_id: str, s3_bucket: Bucket, conversion_api: CfnApi, textract_sns_topic: Topic, polly_sns_topic: Topic, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str, s3_bucket: Bucket, ingestion_queue: Queue, conversion_api: CfnApi, textract_sns_topic: Topic, polly_sns_topic: Topic, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         app_name = self.node.try_get_context('app-name')
+        polly_voice_id = self.node.try_get_context('polly-voice-id')
+        polly_speech_rate = self.node.try_get_context('polly-speech-rate')
+        confidence_limit = self.node.try_get_context('confidence-limit')
+        result_cache_ttl_days = self.node.try_get_context('result-cache-ttl-days')
+        ingestion_max_concurrency = int(self.node.try_get_context('ingestion-max-concurrency'))
+        ingestion_batch_size = int(self.node.try_get_context('ingestion-batch-size'))
+        textract_max_in_flight_jobs = self.node.try_get_context('textract-max-in-flight-jobs')
+        polly_max_in_flight_tasks = self.node.try_get_context('polly-max-in-flight-tasks')
+        max_batch_documents = self.node.try_get_context('max-batch-documents')
+
+        # the state machine is created in StepFunctionsStack, which depends on this stack
+        state_machine_arn = f'arn:{Aws.PARTITION}:states:{Aws.REGION}:{Aws.ACCOUNT_ID}:stateMachine:{get_state_machine_name(app_name)}'
+
+        # lazily created AWS clients and the notify_user helper shared by every function
+        self.runtime_layer = LayerVersion(
+            self,
+            id=f'{app_name}-LAMBDA-LAYER-RUNTIME',
+            code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_runtime_layer')),
+            compatible_runtimes=[Runtime.PYTHON_3_7],
+        )
 
         self.on_polly_ready_func = Function(
             self,
@@ -28,11 +54,14 @@ class LambdaStack(Stack):
             handler='on_polly_ready.lambda_handler',
             runtime=Runtime.PYTHON_3_7,
             code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_on_polly_ready')),
+            timeout=Duration.minutes(5),  # stitching long audio from its segments
             environment={
                 'APP_NAME': app_name,
                 'CONVERSION_API_ENDPOINT': conversion_api.ref,
                 'CONVERSION_API_REGION': Aws.REGION,
+                'RESULT_CACHE_TTL_DAYS': result_cache_ttl_days,
             },
+            layers=[self.runtime_layer],
             role=Role(
                 self,
                 id=f'{app_name}-ON-POLLY-READY-FUNC-ROLE',
@@ -40,11 +69,58 @@ class LambdaStack(Stack):
                 managed_policies=[
                     ManagedPolicy.from_aws_managed_policy_name('service-role/AWSLambdaBasicExecutionRole'),
                     ManagedPolicy.from_aws_managed_policy_name('AmazonAPIGatewayInvokeFullAccess'),
-                    ManagedPolicy.from_aws_managed_policy_name('AmazonDynamoDBReadOnlyAccess'),
+                    ManagedPolicy.from_aws_managed_policy_name('AmazonDynamoDBFullAccess'),
+                    ManagedPolicy.from_aws_managed_policy_name('AmazonS3FullAccess'),
                 ]
             ),
         )
 
+        # shared by the function behind the WebSocket API and the one draining the ingestion queue
+        convert_images_to_text_environment = {
+            'APP_NAME': app_name,
+            'CONVERSION_API_ENDPOINT': conversion_api.ref,
+            'CONVERSION_API_REGION': Aws.REGION,
+            'S3_BUCKET': s3_bucket.bucket_name,  # holds the moderation lexicon, see upload-moderation-lexicon.py
+            'POLLY_VOICE_ID': polly_voice_id,
+            'POLLY_SPEECH_RATE': polly_speech_rate,
+            'CONFIDENCE_LIMIT': confidence_limit,
+            'RESULT_CACHE_TTL_DAYS': result_cache_ttl_days,
+            'TEXTRACT_MAX_IN_FLIGHT_JOBS': textract_max_in_flight_jobs,
+            'INGESTION_QUEUE_URL': ingestion_queue.queue_url,  # jobs over the Textract quota wait there
+            'INGESTION_MAX_RECEIVE_COUNT': str(INGESTION_MAX_RECEIVE_COUNT),
+            'TEXTRACT_SERVICE_ROLE': Role(
+                self,
+                id=f'{app_name}-TEXTRACT-SERVICE-ROLE',
+                assumed_by=ServicePrincipal('textract.amazonaws.com'),
+                managed_policies=[
+                    ManagedPolicy.from_aws_managed_policy_name('service-role/AmazonTextractServiceRole'),
+                ],
+            ).role_arn,
+            f'{app_name}_TEXTRACT_SNS_TOPIC_ARN': textract_sns_topic.topic_arn,
+            f'{app_name}_STATE_MACHINE': state_machine_arn,
+        }
+        convert_images_to_text_layers = [
+            self.runtime_layer,
+            LayerVersion(
+                self,
+                id=f'{app_name}-LAMBDA-LAYER-CONVERT-IMAGES-TO-TEXT',
+                code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_convert_images_to_text_layer/img2pdf.zip')),
+            ),
+        ]
+        convert_images_to_text_role = Role(
+            self,
+            id=f'{app_name}-CONVERT-IMAGES-TO-TEXT-FUNC-ROLE',
+            assumed_by=ServicePrincipal('lambda.amazonaws.com'),
+            managed_policies=[
+                ManagedPolicy.from_aws_managed_policy_name('service-role/AWSLambdaBasicExecutionRole'),
+                ManagedPolicy.from_aws_managed_policy_name('AmazonAPIGatewayInvokeFullAccess'),
+                ManagedPolicy.from_aws_managed_policy_name('AmazonDynamoDBFullAccess'),
+                ManagedPolicy.from_aws_managed_policy_name('AmazonTextractFullAccess'),
+                ManagedPolicy.from_aws_managed_policy_name('AmazonS3FullAccess'),
+                ManagedPolicy.from_aws_managed_policy_name('AmazonSNSFullAccess'),
+            ]
+        )
+
         self.convert_images_to_text_func = Function(
             self,
             id=f'{app_name}-LAMBDA-CONVERT-IMAGES-TO-TEXT',
@@ -52,30 +128,72 @@ class LambdaStack(Stack):
             handler='convert_images_to_text.lambda_handler',
             runtime=Runtime.PYTHON_3_7,
             code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_convert_images_to_text')),
+            timeout=Duration.minutes(5),  # hashing and converting large uploads
+            memory_size=PDF_CONVERSION_MEMORY_SIZE,
+            environment=convert_images_to_text_environment,
+            layers=convert_images_to_text_layers,
+            role=convert_images_to_text_role,
+        )
+        self.convert_images_to_text_func.add_to_role_policy(
+            PolicyStatement(
+                actions=['states:StartExecution'],
+                resources=[state_machine_arn],
+            ),
+        )
+        ingestion_queue.grant_send_messages(convert_images_to_text_role)
+
+        # same code, started by objects created under ingest/ in the bucket
+        self.ingest_images_func = Function(
+            self,
+            id=f'{app_name}-LAMBDA-INGEST-IMAGES',
+            function_name=f'{app_name}-ingest-images',
+            handler='convert_images_to_text.lambda_handler',
+            runtime=Runtime.PYTHON_3_7,
+            code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_convert_images_to_text')),
+            timeout=Duration.minutes(5),
+            memory_size=PDF_CONVERSION_MEMORY_SIZE,
+            environment=convert_images_to_text_environment,
+            layers=convert_images_to_text_layers,
+            role=convert_images_to_text_role,
+        )
+        ingestion_queue.grant_consume_messages(self.ingest_images_func)
+        ingestion_event_source = EventSourceMapping(
+            self,
+            id=f'{app_name}-INGEST-IMAGES-EVENT-SOURCE',
+            target=self.ingest_images_func,
+            event_source_arn=ingestion_queue.queue_arn,
+            batch_size=ingestion_batch_size,
+            max_batching_window=Duration.seconds(5),
+            report_batch_item_failures=True,  # only the failed messages of a batch are retried
+        )
+        # caps how many uploads are converted at once: the poller takes no more messages than that many
+        # invocations handle, the rest wait in the queue. Reserved concurrency would have the poller's
+        # invocations throttled instead, each throttle counting as a receive towards the dead-letter queue.
+        # CDK 1.x has no property for it yet
+        ingestion_event_source.node.default_child.add_property_override('ScalingConfig.MaximumConcurrency', ingestion_max_concurrency)
+
+        self.retrieve_text_func = Function(
+            self,
+            id=f'{app_name}-LAMBDA-RETRIEVE-TEXT',
+            function_name=f'{app_name}-retrieve-text',
+            handler='retrieve_text.lambda_handler',
+            runtime=Runtime.PYTHON_3_7,
+            code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_retrieve_text')),
+            # paging through every GetDocumentTextDetection result of documents of hundreds of pages,
+            # ordering, moderating and compressing their lines; CPU is allotted in proportion to memory
+            timeout=Duration.minutes(10),
+            memory_size=1024,
             environment={
                 'APP_NAME': app_name,
                 'CONVERSION_API_ENDPOINT': conversion_api.ref,
                 'CONVERSION_API_REGION': Aws.REGION,
-                'TEXTRACT_SERVICE_ROLE': Role(
-                    self,
-                    id=f'{app_name}-TEXTRACT-SERVICE-ROLE',
-                    assumed_by=ServicePrincipal('textract.amazonaws.com'),
-                    managed_policies=[
-                        ManagedPolicy.from_aws_managed_policy_name('service-role/AmazonTextractServiceRole'),
-                    ],
-                ).role_arn,
-                f'{app_name}_TEXTRACT_SNS_TOPIC_ARN': textract_sns_topic.topic_arn,
+                'S3_BUCKET': s3_bucket.bucket_name,  # also holds the moderation lexicon
+                'CONFIDENCE_LIMIT': confidence_limit,
             },
-            layers=[
-                LayerVersion(
-                    self,
-                    id=f'{app_name}-LAMBDA-LAYER-CONVERT-IMAGES-TO-TEXT',
-                    code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_convert_images_to_text_layer/img2pdf.zip')),
-                ),
-            ],
+            layers=[self.runtime_layer],
             role=Role(
                 self,
-                id=f'{app_name}-CONVERT-IMAGES-TO-TEXT-FUNC-ROLE',
+                id=f'{app_name}-RETRIEVE-TEXT-FUNC-ROLE',
                 assumed_by=ServicePrincipal('lambda.amazonaws.com'),
                 managed_policies=[
                     ManagedPolicy.from_aws_managed_policy_name('service-role/AWSLambdaBasicExecutionRole'),
@@ -83,112 +201,163 @@ class LambdaStack(Stack):
                     ManagedPolicy.from_aws_managed_policy_name('AmazonDynamoDBFullAccess'),
                     ManagedPolicy.from_aws_managed_policy_name('AmazonTextractFullAccess'),
                     ManagedPolicy.from_aws_managed_policy_name('AmazonS3FullAccess'),
-                    ManagedPolicy.from_aws_managed_policy_name('AmazonSNSFullAccess'),
                 ]
             ),
         )
 
-        self.retrieve_text_func = Function(
+        self.convert_text_to_audio_func = Function(
             self,
-            id=f'{app_name}-LAMBDA-RETRIEVE-TEXT',
-            function_name=f'{app_name}-retrieve-text',
-            handler='retrieve_text.lambda_handler',
+            id=f'{app_name}-LAMBDA-CONVERT-TEXT-TO-AUDIO',
+            function_name=f'{app_name}-convert-text-to-audio',
+            handler='convert_text_to_audio.lambda_handler',
             runtime=Runtime.PYTHON_3_7,
-            code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_retrieve_text')),
+            code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_convert_text_to_audio')),
+            timeout=Duration.minutes(1),  # waiting for Polly capacity
             environment={
                 'APP_NAME': app_name,
                 'CONVERSION_API_ENDPOINT': conversion_api.ref,
                 'CONVERSION_API_REGION': Aws.REGION,
+                'S3_BUCKET': s3_bucket.bucket_name,
+                'POLLY_VOICE_ID': polly_voice_id,
+                'POLLY_SPEECH_RATE': polly_speech_rate,
+                'POLLY_MAX_IN_FLIGHT_TASKS': polly_max_in_flight_tasks,
+                f'{app_name}_POLLY_SNS_TOPIC_ARN': polly_sns_topic.topic_arn,
             },
+            layers=[self.runtime_layer],
             role=Role(
                 self,
-                id=f'{app_name}-RETRIEVE-TEXT-FUNC-ROLE',
+                id=f'{app_name}-CONVERT-TEXT-TO-AUDIO-FUNC-ROLE',
                 assumed_by=ServicePrincipal('lambda.amazonaws.com'),
                 managed_policies=[
                     ManagedPolicy.from_aws_managed_policy_name('service-role/AWSLambdaBasicExecutionRole'),
                     ManagedPolicy.from_aws_managed_policy_name('AmazonAPIGatewayInvokeFullAccess'),
-                    ManagedPolicy.from_aws_managed_policy_name('AmazonTextractFullAccess'),
+                    ManagedPolicy.from_aws_managed_policy_name('AmazonDynamoDBFullAccess'),
+                    ManagedPolicy.from_aws_managed_policy_name('AmazonPollyFullAccess'),
+                    ManagedPolicy.from_aws_managed_policy_name('AmazonS3FullAccess'),
+                    ManagedPolicy.from_aws_managed_policy_name('AmazonSNSFullAccess'),
                 ]
             ),
         )
 
-        self.store_text_func = Function(
+        # WebSocket API "batch" route, queues the documents of a batch for the ingestion function (see MainStack)
+        self.submit_batch_func = Function(
             self,
-            id=f'{app_name}-LAMBDA-STORE-TEXT',
-            function_name=f'{app_name}-store-text',
-            handler='store_text.lambda_handler',
+            id=f'{app_name}-LAMBDA-SUBMIT-BATCH',
+            function_name=f'{app_name}-submit-batch',
+            handler='submit_batch.lambda_handler',
             runtime=Runtime.PYTHON_3_7,
-            code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_store_text')),
+            code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_submit_batch')),
+            timeout=Duration.minutes(1),  # a SendMessageBatch call per 10 documents, up to max-batch-documents
             environment={
                 'APP_NAME': app_name,
                 'CONVERSION_API_ENDPOINT': conversion_api.ref,
                 'CONVERSION_API_REGION': Aws.REGION,
                 'S3_BUCKET': s3_bucket.bucket_name,
+                'INGESTION_QUEUE_URL': ingestion_queue.queue_url,
+                'MAX_BATCH_DOCUMENTS': max_batch_documents,
             },
+            layers=[self.runtime_layer],
             role=Role(
                 self,
-                id=f'{app_name}-STORE-TEXT-FUNC-ROLE',
+                id=f'{app_name}-SUBMIT-BATCH-FUNC-ROLE',
                 assumed_by=ServicePrincipal('lambda.amazonaws.com'),
                 managed_policies=[
                     ManagedPolicy.from_aws_managed_policy_name('service-role/AWSLambdaBasicExecutionRole'),
                     ManagedPolicy.from_aws_managed_policy_name('AmazonAPIGatewayInvokeFullAccess'),
-                    ManagedPolicy.from_aws_managed_policy_name('AmazonS3FullAccess'),
+                    ManagedPolicy.from_aws_managed_policy_name('AmazonDynamoDBFullAccess'),
                 ]
             ),
-
         )
+        ingestion_queue.grant_send_messages(self.submit_batch_func)
 
-        self.moderate_text_func = Function(
+        # the state machine's catch, see StepFunctionsStack
+        self.on_job_failed_func = Function(
             self,
-            id=f'{app_name}-LAMBDA-MODERATE-TEXT',
-            function_name=f'{app_name}-moderate-text',
-            handler='moderate_text.lambda_handler',
+            id=f'{app_name}-LAMBDA-ON-JOB-FAILED',
+            function_name=f'{app_name}-on-job-failed',
+            handler='on_job_failed.lambda_handler',
             runtime=Runtime.PYTHON_3_7,
-            code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_moderate_text')),
+            code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_on_job_failed')),
             environment={
+                'APP_NAME': app_name,
                 'CONVERSION_API_ENDPOINT': conversion_api.ref,
                 'CONVERSION_API_REGION': Aws.REGION,
             },
+            layers=[self.runtime_layer],
             role=Role(
                 self,
-                id=f'{app_name}-MODERATE-TEXT-FUNC-ROLE',
+                id=f'{app_name}-ON-JOB-FAILED-FUNC-ROLE',
                 assumed_by=ServicePrincipal('lambda.amazonaws.com'),
                 managed_policies=[
                     ManagedPolicy.from_aws_managed_policy_name('service-role/AWSLambdaBasicExecutionRole'),
                     ManagedPolicy.from_aws_managed_policy_name('AmazonAPIGatewayInvokeFullAccess'),
+                    ManagedPolicy.from_aws_managed_policy_name('AmazonDynamoDBFullAccess'),
+                    ManagedPolicy.from_aws_managed_policy_name('AmazonS3FullAccess'),  # the manifest of the batch
                 ]
             ),
+        )
 
+        # hands out presigned S3 URLs, so uploads and downloads go straight to the bucket (see MainStack)
+        self.file_session_func = Function(
+            self,
+            id=f'{app_name}-LAMBDA-FILE-SESSION',
+            function_name=f'{app_name}-file-session',
+            handler='file_session.lambda_handler',
+            runtime=Runtime.PYTHON_3_7,
+            code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_file_session')),
+            environment={
+                'APP_NAME': app_name,
+                'S3_BUCKET': s3_bucket.bucket_name,
+            },
+            layers=[self.runtime_layer],
+            role=Role(
+                self,
+                id=f'{app_name}-FILE-SESSION-FUNC-ROLE',
+                assumed_by=ServicePrincipal('lambda.amazonaws.com'),
+                managed_policies=[
+                    ManagedPolicy.from_aws_managed_policy_name('service-role/AWSLambdaBasicExecutionRole'),
+                    ManagedPolicy.from_aws_managed_policy_name('AmazonS3FullAccess'),
+                ]
+            ),
         )
 
-        self.convert_text_to_audio_func = Function(
+        # invoked by reprocess-jobs.py, reruns the state machine on the Textract output stored with a job
+        self.reprocess_job_func = Function(
             self,
-            id=f'{app_name}-LAMBDA-CONVERT-TEXT-TO-AUDIO',
-            function_name=f'{app_name}-convert-text-to-audio',
-            handler='convert_text_to_audio.lambda_handler',
+            id=f'{app_name}-LAMBDA-REPROCESS-JOB',
+            function_name=f'{app_name}-reprocess-job',
+            handler='reprocess_job.lambda_handler',
             runtime=Runtime.PYTHON_3_7,
-            code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_convert_text_to_audio')),
+            code=Code.from_asset(str(pathlib.PurePath(__file__).parent / 'lambda_reprocess_job')),
             environment={
                 'APP_NAME': app_name,
                 'CONVERSION_API_ENDPOINT': conversion_api.ref,
                 'CONVERSION_API_REGION': Aws.REGION,
-                'S3_BUCKET': s3_bucket.bucket_name,
-                f'{app_name}_POLLY_SNS_TOPIC_ARN': polly_sns_topic.topic_arn,
+                'POLLY_VOICE_ID': polly_voice_id,
+                'POLLY_SPEECH_RATE': polly_speech_rate,
+                'CONFIDENCE_LIMIT': confidence_limit,
+                'S3_BUCKET': s3_bucket.bucket_name,  # holds the moderation lexicon, whose version is part of the cache key
+                f'{app_name}_STATE_MACHINE': state_machine_arn,
             },
+            layers=[self.runtime_layer],
             role=Role(
                 self,
-                id=f'{app_name}-CONVERT-TEXT-TO-AUDIO-FUNC-ROLE',
+                id=f'{app_name}-REPROCESS-JOB-FUNC-ROLE',
                 assumed_by=ServicePrincipal('lambda.amazonaws.com'),
                 managed_policies=[
                     ManagedPolicy.from_aws_managed_policy_name('service-role/AWSLambdaBasicExecutionRole'),
                     ManagedPolicy.from_aws_managed_policy_name('AmazonAPIGatewayInvokeFullAccess'),
                     ManagedPolicy.from_aws_managed_policy_name('AmazonDynamoDBFullAccess'),
-                    ManagedPolicy.from_aws_managed_policy_name('AmazonPollyFullAccess'),
-                    ManagedPolicy.from_aws_managed_policy_name('AmazonS3FullAccess'),
-                    ManagedPolicy.from_aws_managed_policy_name('AmazonSNSFullAccess'),
                 ]
             ),
         )
+        self.reprocess_job_func.add_to_role_policy(
+            PolicyStatement(
+                actions=['states:StartExecution'],
+                resources=[state_machine_arn],
+            ),
+        )
+        s3_bucket.grant_read(self.reprocess_job_func, 'moderation/*')
 
         # tag all resources with app_name
         self.tags.set_tag(TAG_NAME, app_name, apply_to_launched_instances=True)
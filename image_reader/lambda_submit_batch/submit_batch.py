@@ -0,0 +1,178 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import os
+import pathlib
+import re
+
+from botocore.exceptions import ClientError
+
+from app_runtime import lazy_client, lazy_table, log_cold_start, notify_user, with_notifications
+from batches import QUEUED
+from metrics import Metrics, utc_now, with_metrics
+
+
+APP_NAME = os.environ['APP_NAME']
+S3_BUCKET = os.environ['S3_BUCKET']
+# the documents start from here, as many at once as the ingestion event source's maximum concurrency allows
+INGESTION_QUEUE_URL = os.environ['INGESTION_QUEUE_URL']
+
+# a WebSocket message holds at most 128 KB
+MAX_BATCH_DOCUMENTS = int(os.environ.get('MAX_BATCH_DOCUMENTS', '500'))
+# SendMessageBatch takes at most 10 messages
+SEND_MESSAGE_BATCH_SIZE = 10
+# {user_id}/{app_job_id}/images/<file name>, as file_session hands out the upload keys
+DOCUMENT_KEY_RE = re.compile(r'^([\w.@+=-]+)/([\w.@+=-]+)/images/[^/]+$')
+# what convert_images_to_text converts, the same as file_session.UPLOAD_FILE_SUFFIXES
+DOCUMENT_FILE_SUFFIXES = ('.jpg', '.png', '.tif', '.tiff', '.pdf', '.zip')
+
+batch_table = lazy_table(f'{APP_NAME}Batches')
+sqs_client = lazy_client('sqs')
+
+metrics = Metrics('submit_batch')
+
+
+@log_cold_start
+@with_notifications
+@with_metrics(metrics)
+def lambda_handler(event, context):
+    # WebSocket API "batch" route, see MainStack._configure_api_gateway_web_socket
+    try:
+        submit_batch(event)
+    except Exception:
+        notify_user('ERROR - Failed to submit batch', event['ConnectionId'])
+        raise
+
+def submit_batch(event):
+    batch_id = event['BatchId']
+    user_id = event['UserId']
+    connection_id = event['ConnectionId']
+    start_time_utc = utc_now()
+    if event.get('Bucket', S3_BUCKET) != S3_BUCKET:
+        raise ValueError(f'Documents are not stored in bucket {S3_BUCKET}.')
+    documents = get_documents(event['Keys'], user_id)
+    confidence_limit = event.get('ConfidenceLimit')
+    queued_count = 0
+
+    try:
+        # a batch sent twice does not start its documents twice
+        batch_table.put_item(
+            Item={
+                'BatchId': batch_id,
+                'UserId': user_id,
+                'ConnectionId': connection_id,
+                'Bucket': S3_BUCKET,
+                'StartTime': start_time_utc,
+                'ConfidenceLimit': confidence_limit,
+                'DocumentCount': len(documents),
+                'QueuedCount': 0,
+                'CompletedCount': 0,
+                'FailedCount': 0,
+                'Documents': {
+                    app_job_id: {
+                        'Index': index,
+                        'Key': key,
+                        'Status': QUEUED,
+                    }
+                    for index, (app_job_id, key) in enumerate(documents)
+                },
+            },
+            ConditionExpression='attribute_not_exists(BatchId)',
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        batch = batch_table.get_item(
+            Key={
+                'BatchId': batch_id,
+            },
+            ConsistentRead=True,
+        )['Item']
+        if batch['UserId'] != user_id:
+            raise ValueError(f'Batch {batch_id} belongs to another user.')
+        if batch['QueuedCount'] >= batch['DocumentCount']:
+            print(f'Batch {batch_id} was already submitted.')
+            return
+        # an earlier submission stopped before all documents were queued, this one carries on where it stopped
+        print(f'Batch {batch_id} was submitted with {int(batch["QueuedCount"])} of {int(batch["DocumentCount"])} documents queued.')
+        documents = [
+            (app_job_id, document['Key'])
+            for app_job_id, document in sorted(batch['Documents'].items(), key=lambda item: item[1]['Index'])
+        ]
+        start_time_utc = batch['StartTime']
+        confidence_limit = batch.get('ConfidenceLimit')
+        queued_count = int(batch['QueuedCount'])
+
+    # the documents report to the batch, not to a WebSocket connection of their own
+    queued_jobs = [
+        {
+            'Bucket': S3_BUCKET,
+            'Key': key,
+            f'{APP_NAME}JobId': app_job_id,
+            'UserId': user_id,
+            'ConnectionId': None,
+            'ConfidenceLimit': confidence_limit,
+            'BatchId': batch_id,
+            'QueuedTime': start_time_utc,
+        }
+        for app_job_id, key in documents
+    ]
+    for start in range(queued_count, len(queued_jobs), SEND_MESSAGE_BATCH_SIZE):
+        send_queued_jobs(queued_jobs[start:start + SEND_MESSAGE_BATCH_SIZE])
+        record_queued_count(batch_id, min(start + SEND_MESSAGE_BATCH_SIZE, len(queued_jobs)))
+
+    print(f'Batch {batch_id} queued {len(queued_jobs) - queued_count} documents.')
+    metrics.put('BatchDocuments', len(queued_jobs) - queued_count)
+    metrics.flush(BatchId=batch_id)
+    notify_user(f'Batch {batch_id}: {len(queued_jobs)} documents queued', connection_id)
+
+def get_documents(keys, user_id):
+    # (app job id, key) of every document, the job id is the one the key was uploaded under
+    if not isinstance(keys, list) or not 0 < len(keys) <= MAX_BATCH_DOCUMENTS:
+        raise ValueError(f'A batch needs between 1 and {MAX_BATCH_DOCUMENTS} keys.')
+
+    documents = []
+    app_job_ids = set()
+    for key in keys:
+        match = DOCUMENT_KEY_RE.match(key) if isinstance(key, str) else None
+        if not match or match.group(1) != user_id or '/../' in f'/{key}/':
+            raise ValueError(f'Invalid key {key!r}.')
+        if pathlib.PurePath(key).suffix.lower() not in DOCUMENT_FILE_SUFFIXES:
+            raise ValueError(f'Input file type not supported: {key!r}.')
+        app_job_id = match.group(2)
+        if app_job_id in app_job_ids:
+            raise ValueError(f'More than one key for App Job {app_job_id}.')
+        app_job_ids.add(app_job_id)
+        documents.append((app_job_id, key))
+    return documents
+
+def send_queued_jobs(queued_jobs):
+    entries = {
+        str(index): json.dumps({
+            'QueuedJob': queued_job,
+        })
+        for index, queued_job in enumerate(queued_jobs)
+    }
+    # entries SQS did not take are sent again, those it did are not
+    for _ in range(3):
+        sqs_resp = sqs_client.send_message_batch(
+            QueueUrl=INGESTION_QUEUE_URL,
+            Entries=[{'Id': entry_id, 'MessageBody': body} for entry_id, body in entries.items()],
+        )
+        entries = {failed['Id']: entries[failed['Id']] for failed in sqs_resp.get('Failed', [])}
+        if not entries:
+            return
+    raise RuntimeError(f'Failed to queue {len(entries)} documents: {sorted(entries)}.')
+
+def record_queued_count(batch_id, queued_count):
+    # a message sent again after a failure in between is dropped as a job already started, see convert_images_to_text
+    batch_table.update_item(
+        Key={
+            'BatchId': batch_id,
+        },
+        UpdateExpression='SET QueuedCount = :queued_count',
+        ExpressionAttributeValues={
+            ':queued_count': queued_count,
+        },
+    )
@@ -3,12 +3,10 @@
 
 from aws_cdk.core import Aws, CfnOutput, Construct, RemovalPolicy, Stack
 from aws_cdk.aws_apigateway import (
-    AwsIntegration,
-    IntegrationOptions,
-    IntegrationResponse,
+    Cors,
+    CorsOptions,
+    LambdaIntegration,
     MethodLoggingLevel,
-    MethodResponse,
-    MockIntegration,
     RestApi,
     StageOptions
 )
@@ -30,15 +28,18 @@ TAG_NAME = 'app'
 
 class MainStack(Stack):
 
-    def __init__(self, scope: Construct, construct_id: str, conversion_api: CfnApi, convert_images_to_text_func: Function, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str, conversion_api: CfnApi, convert_images_to_text_func: Function, submit_batch_func: Function, file_session_func: Function, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         app_name = self.node.try_get_context('app-name')
 
         apig_role = self._create_api_gateway_role(app_name)
-        self.file_api = self._create_api_gateway_rest(app_name, apig_role)
-        self._configure_api_gateway_web_socket(app_name, conversion_api, apig_role, convert_images_to_text_func)
+        self.file_api = self._create_api_gateway_rest(app_name, file_session_func)
+        self._configure_api_gateway_web_socket(app_name, conversion_api, apig_role, convert_images_to_text_func, submit_batch_func)
         self._create_ddb_table(app_name)
+        self._create_ddb_result_cache_table(app_name)
+        self._create_ddb_admission_table(app_name)
+        self._create_ddb_batch_table(app_name)
 
         CfnOutput(
             scope=self,
@@ -62,230 +63,131 @@ class MainStack(Stack):
             assumed_by=ServicePrincipal('apigateway.amazonaws.com'),
             managed_policies=[
                 ManagedPolicy.from_aws_managed_policy_name('service-role/AmazonAPIGatewayPushToCloudWatchLogs'),
-                ManagedPolicy.from_aws_managed_policy_name('AmazonS3FullAccess'),
                 ManagedPolicy.from_aws_managed_policy_name('AWSLambda_FullAccess'),
             ],
         )
 
-    def _create_api_gateway_rest(self, app_name, apig_role):
+    def _create_api_gateway_rest(self, app_name, file_session_func):
+        # only small JSON requests go through the API, the files themselves go straight
+        # to and from S3 with the presigned URLs file_session hands out
         file_api = RestApi(
             scope=self,
             id=f'{app_name}-FILE-API',
             deploy_options=StageOptions(
                 logging_level=MethodLoggingLevel.INFO,
-                # in console this is Stages -> Logs/Tracing -> Log full requests/responses data
-                # may want to turn off later
-                data_trace_enabled=True,
+                # responses hold presigned URLs, which are not to end up in the logs
+                data_trace_enabled=False,
             ),
-            binary_media_types=[
-                'application/pdf',
-                'audio/mpeg',
-                'image/jpeg',
-                'image/png',
-            ],
-        )
-
-        bucket_resource = file_api.root.add_resource('{bucket}')
-        key_resource = bucket_resource.add_resource('{key}')
-        key_resource.add_method(
-            http_method='PUT',
-            integration=AwsIntegration(
-                service='s3',
-                path='{bucket}/{key}',
-                integration_http_method='PUT',
-                options=IntegrationOptions(
-                    credentials_role=apig_role,
-                    request_parameters={
-                        'integration.request.path.bucket': 'method.request.path.bucket',
-                        'integration.request.path.key': 'method.request.path.key',
-                    },
-                    integration_responses=[
-                        IntegrationResponse(
-                            status_code='200',
-                            response_parameters={
-                                'method.response.header.Content-Type': 'integration.response.header.Content-Type',
-                                'method.response.header.Access-Control-Allow-Origin': "'*'",
-                            },
-                        ),
-                        IntegrationResponse(
-                            status_code='400',
-                            selection_pattern='4\d{2}',
-                        ),
-                        IntegrationResponse(
-                            status_code='500',
-                            selection_pattern='5\d{2}',
-                        ),
-                    ]
-                )
+            default_cors_preflight_options=CorsOptions(
+                allow_origins=Cors.ALL_ORIGINS,
+                allow_methods=['GET', 'OPTIONS', 'POST'],
             ),
-            request_parameters={
-                'method.request.header.Content-Type': False,
-                'method.request.path.bucket': True,
-                'method.request.path.key': True,
-            },
-            method_responses=[
-                MethodResponse(
-                    status_code='200',
-                    response_parameters={
-                        'method.response.header.Content-Type': True,
-                        'method.response.header.Access-Control-Allow-Origin': True,
-                    },
-                ),
-                MethodResponse(
-                    status_code='400',
-                ),
-                MethodResponse(
-                    status_code='500',
-                ),
-            ],
-        )
-        key_resource.add_method(
-            http_method='GET',
-            integration=AwsIntegration(
-                service='s3',
-                path='{bucket}/{key}',
-                integration_http_method='GET',
-                options=IntegrationOptions(
-                    credentials_role=apig_role,
-                    request_parameters={
-                        'integration.request.path.bucket': 'method.request.path.bucket',
-                        'integration.request.path.key': 'method.request.path.key',
-                    },
-                    integration_responses=[
-                        IntegrationResponse(
-                            status_code='200',
-                            response_parameters={
-                                'method.response.header.Content-Type': 'integration.response.header.Content-Type',
-                                'method.response.header.Access-Control-Allow-Origin': "'*'",
-                            },
-                        ),
-                        IntegrationResponse(
-                            status_code='400',
-                            selection_pattern='4\d{2}',
-                        ),
-                        IntegrationResponse(
-                            status_code='500',
-                            selection_pattern='5\d{2}',
-                        ),
-                    ]
-                )
-            ),
-            request_parameters={
-                'method.request.header.Content-Type': False,
-                'method.request.path.bucket': True,
-                'method.request.path.key': True,
-            },
-            method_responses=[
-                MethodResponse(
-                    status_code='200',
-                    response_parameters={
-                        'method.response.header.Content-Type': True,
-                        'method.response.header.Access-Control-Allow-Origin': True,
-                    },
-                ),
-                MethodResponse(
-                    status_code='400',
-                ),
-                MethodResponse(
-                    status_code='500',
-                ),
-            ],
-        )
-        key_resource.add_method(
-            http_method='OPTIONS',
-            integration=MockIntegration(
-                request_templates={ 'application/json': '{ "statusCode": 200 }' },
-                integration_responses=[
-                    IntegrationResponse(
-                        status_code='200',
-                        response_parameters={
-                            'method.response.header.Access-Control-Allow-Headers': "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'",
-                            'method.response.header.Access-Control-Allow-Methods': "'GET,OPTIONS,PUT'",
-                            'method.response.header.Access-Control-Allow-Origin': "'*'",
-                        },
-                    ),
-                ],
-            ),
-            request_parameters={
-                'method.request.path.bucket': True,
-                'method.request.path.key': True,
-            },
-            method_responses=[
-                MethodResponse(
-                    status_code='200',
-                    response_parameters={
-                        'method.response.header.Access-Control-Allow-Headers': True,
-                        'method.response.header.Access-Control-Allow-Methods': True,
-                        'method.response.header.Access-Control-Allow-Origin': True,
-                    },
-                ),
-            ],
         )
 
+        file_session_integ = LambdaIntegration(file_session_func)
+        uploads_resource = file_api.root.add_resource('uploads')
+        uploads_resource.add_method('POST', file_session_integ)
+        uploads_resource.add_resource('complete').add_method('POST', file_session_integ)
+        uploads_resource.add_resource('abort').add_method('POST', file_session_integ)
+        file_api.root.add_resource('downloads').add_method('GET', file_session_integ)
+
         return file_api
 
     # TODO use aws_cdk.aws_apigatewayv2.WebSocketApi instead, when it becomes usable
-    def _configure_api_gateway_web_socket(self, app_name, conversion_api, apig_role, convert_images_to_text_func):
-        conversion_integ = CfnIntegration(
+    def _configure_api_gateway_web_socket(self, app_name, conversion_api, apig_role, convert_images_to_text_func, submit_batch_func):
+        # one document per message
+        conversion_route, conversion_integ_response = self._add_web_socket_route(
+            f'{app_name}-WS-API',
+            conversion_api,
+            apig_role,
+            '$default',
+            convert_images_to_text_func,
+            f"""
+                {{
+                    "Bucket": "$input.path('$.Bucket')",
+                    "Key": "$input.path('$.Key')",
+                    "{app_name}JobId": "$input.path('$.{app_name}JobId')",
+                    "UserId": "$input.path('$.UserId')",
+                    "ConfidenceLimit": "$input.path('$.ConfidenceLimit')",
+                    "ConnectionId": "$context.connectionId"
+                }}
+            """,
+        )
+        # {"action": "batch", ...}: the uploaded keys of many documents, which report to this one connection
+        batch_route, batch_integ_response = self._add_web_socket_route(
+            f'{app_name}-WS-API-BATCH',
+            conversion_api,
+            apig_role,
+            'batch',
+            submit_batch_func,
+            """
+                {
+                    "BatchId": "$input.path('$.BatchId')",
+                    "Bucket": "$input.path('$.Bucket')",
+                    "Keys": $input.json('$.Keys'),
+                    "UserId": "$input.path('$.UserId')",
+                    "ConfidenceLimit": "$input.path('$.ConfidenceLimit')",
+                    "ConnectionId": "$context.connectionId"
+                }
+            """,
+        )
+        self.conversion_stage = CfnStage(
             scope=self,
-            id=f'{app_name}-WS-API-INTEGRATION',
+            id=f'{app_name}-WS-API-STAGE',
+            api_id=conversion_api.ref,
+            stage_name='prod',
+            auto_deploy=True,
+            default_route_settings=CfnStage.RouteSettingsProperty(
+                data_trace_enabled=True,
+                detailed_metrics_enabled=True,
+                logging_level='INFO',
+            )
+        )
+        self.conversion_stage.add_depends_on(conversion_route)
+        self.conversion_stage.add_depends_on(conversion_integ_response)
+        self.conversion_stage.add_depends_on(batch_route)
+        self.conversion_stage.add_depends_on(batch_integ_response)
+
+    def _add_web_socket_route(self, id_prefix, conversion_api, apig_role, route_key, func, request_template):
+        integ = CfnIntegration(
+            scope=self,
+            id=f'{id_prefix}-INTEGRATION',
             api_id=conversion_api.ref,
             credentials_arn=apig_role.role_arn,
             integration_type='AWS',
-            integration_uri=f'arn:aws:apigateway:{Aws.REGION}:lambda:path/2015-03-31/functions/{convert_images_to_text_func.function_arn}/invocations',
+            integration_uri=f'arn:aws:apigateway:{Aws.REGION}:lambda:path/2015-03-31/functions/{func.function_arn}/invocations',
             template_selection_expression='\$default',
             request_templates={
-                '$default': f"""
-                    {{
-                        "Bucket": "$input.path('$.Bucket')",
-                        "Key": "$input.path('$.Key')",
-                        "{app_name}JobId": "$input.path('$.{app_name}JobId')",
-                        "UserId": "$input.path('$.UserId')",
-                        "ConnectionId": "$context.connectionId"
-                    }}
-                """
+                '$default': request_template,
             },
         )
-        conversion_route = CfnRoute(
+        route = CfnRoute(
             scope=self,
-            id=f'{app_name}-WS-API-ROUTE',
+            id=f'{id_prefix}-ROUTE',
             api_id=conversion_api.ref,
-            route_key='$default',
+            route_key=route_key,
             authorization_type=None,
-            target=f'integrations/{conversion_integ.ref}',
+            target=f'integrations/{integ.ref}',
             route_response_selection_expression='$default',
         )
-        conversion_integ_response = CfnIntegrationResponse(
+        integ_response = CfnIntegrationResponse(
             scope=self,
-            id=f'{app_name}-WS-API-INTEGRATION_RESPONSE',
+            id=f'{id_prefix}-INTEGRATION_RESPONSE',
             api_id=conversion_api.ref,
-            integration_id=conversion_integ.ref,
+            integration_id=integ.ref,
             integration_response_key='$default',
         )
         CfnRouteResponse(
             scope=self,
-            id=f'{app_name}-WS-API-ROUTE_RESPONSE',
+            id=f'{id_prefix}-ROUTE_RESPONSE',
             api_id=conversion_api.ref,
-            route_id=conversion_route.ref,
+            route_id=route.ref,
             route_response_key='$default',
         )
-        self.conversion_stage = CfnStage(
-            scope=self,
-            id=f'{app_name}-WS-API-STAGE',
-            api_id=conversion_api.ref,
-            stage_name='prod',
-            auto_deploy=True,
-            default_route_settings=CfnStage.RouteSettingsProperty(
-                data_trace_enabled=True,
-                detailed_metrics_enabled=True,
-                logging_level='INFO',
-            )
-        )
-        self.conversion_stage.add_depends_on(conversion_route)
-        self.conversion_stage.add_depends_on(conversion_integ_response)
+        return route, integ_response
 
     def _create_ddb_table(self, app_name):
-        table = Table(
+        Table(
             self,
             id=f'{app_name}-DYNAMODB-TABLE',
             table_name=f'{app_name}Jobs',
@@ -293,11 +195,36 @@ class MainStack(Stack):
             billing_mode=BillingMode.PAY_PER_REQUEST,
             removal_policy=RemovalPolicy.DESTROY,
         )
-        table.add_global_secondary_index(
-            partition_key=Attribute(name='TextractJobId', type=AttributeType.STRING),
-            index_name='TextractJobId',
+
+    def _create_ddb_result_cache_table(self, app_name):
+        Table(
+            self,
+            id=f'{app_name}-DYNAMODB-RESULT-CACHE-TABLE',
+            table_name=f'{app_name}ResultCache',
+            partition_key=Attribute(name='CacheKey', type=AttributeType.STRING),
+            billing_mode=BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY,
+            time_to_live_attribute='ExpiresAt',
+        )
+
+    def _create_ddb_admission_table(self, app_name):
+        # one item per service with the leases of its jobs in flight, see admission.py in the runtime layer
+        Table(
+            self,
+            id=f'{app_name}-DYNAMODB-ADMISSION-TABLE',
+            table_name=f'{app_name}Admission',
+            partition_key=Attribute(name='Service', type=AttributeType.STRING),
+            billing_mode=BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY,
         )
-        table.add_global_secondary_index(
-            partition_key=Attribute(name='PollyJobId', type=AttributeType.STRING),
-            index_name='PollyJobId',
+
+    def _create_ddb_batch_table(self, app_name):
+        # one item per batch, counting the documents done, see batches.py in the runtime layer
+        Table(
+            self,
+            id=f'{app_name}-DYNAMODB-BATCH-TABLE',
+            table_name=f'{app_name}Batches',
+            partition_key=Attribute(name='BatchId', type=AttributeType.STRING),
+            billing_mode=BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY,
         )
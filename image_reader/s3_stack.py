@@ -1,11 +1,17 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-from aws_cdk.core import Construct, CfnOutput, PhysicalName, Stack
-from aws_cdk.aws_s3 import Bucket
+from aws_cdk.core import Aws, Construct, CfnOutput, Duration, PhysicalName, Stack
+from aws_cdk.aws_iam import PolicyStatement, ServicePrincipal
+from aws_cdk.aws_s3 import Bucket, CfnBucket, CorsRule, HttpMethods, LifecycleRule
+from aws_cdk.aws_sqs import DeadLetterQueue, Queue, QueuePolicy
 
 
 TAG_NAME = 'app'
+# objects created under it start jobs without the WebSocket API, see convert_images_to_text.ingest_records
+INGEST_PREFIX = 'ingest/'
+# receives before a message is set aside in the dead-letter queue
+INGESTION_MAX_RECEIVE_COUNT = 5
 
 
 class S3Stack(Stack):
@@ -19,6 +25,20 @@ class S3Stack(Stack):
             scope=self,
             id=f'{app_name}-S3-BUCKET',
             bucket_name=PhysicalName.GENERATE_IF_NEEDED,
+            # the web client uploads and downloads with presigned URLs, see file_session
+            cors=[
+                CorsRule(
+                    allowed_methods=[HttpMethods.GET, HttpMethods.HEAD, HttpMethods.POST, HttpMethods.PUT],
+                    allowed_origins=['*'],
+                    allowed_headers=['*'],
+                    exposed_headers=['ETag'],
+                ),
+            ],
+            lifecycle_rules=[
+                LifecycleRule(
+                    abort_incomplete_multipart_upload_after=Duration.days(1),
+                ),
+            ],
         )
 
         CfnOutput(
@@ -27,5 +47,67 @@ class S3Stack(Stack):
             value=self.s3_bucket.bucket_name,
         )
 
+        # S3 events wait here until the ingestion function has room for them, messages that keep
+        # failing (e.g. throttled by Textract) are retried after the visibility timeout and then set aside
+        self.ingestion_dead_letter_queue = Queue(
+            scope=self,
+            id=f'{app_name}-SQS-INGESTION-DLQ',
+            queue_name=f'{app_name}-ingestion-dlq',
+            retention_period=Duration.days(14),
+        )
+        self.ingestion_queue = Queue(
+            scope=self,
+            id=f'{app_name}-SQS-INGESTION-QUEUE',
+            queue_name=f'{app_name}-ingestion',
+            visibility_timeout=Duration.minutes(30),  # 6 times the function timeout, as Lambda recommends
+            dead_letter_queue=DeadLetterQueue(
+                max_receive_count=INGESTION_MAX_RECEIVE_COUNT,
+                queue=self.ingestion_dead_letter_queue,
+            ),
+        )
+        ingestion_queue_policy = QueuePolicy(
+            scope=self,
+            id=f'{app_name}-SQS-INGESTION-QUEUE-POLICY',
+            queues=[self.ingestion_queue],
+        )
+        # conditioned on the account, the bucket ARN would make the policy and the bucket depend on each other
+        ingestion_queue_policy.document.add_statements(
+            PolicyStatement(
+                actions=['sqs:SendMessage'],
+                principals=[ServicePrincipal('s3.amazonaws.com')],
+                resources=[self.ingestion_queue.queue_arn],
+                conditions={
+                    'StringEquals': {
+                        'aws:SourceAccount': Aws.ACCOUNT_ID,
+                    },
+                },
+            ),
+        )
+
+        # set on the CloudFormation resource, S3 checks that it may send to the queue when the bucket is updated
+        cfn_bucket = self.s3_bucket.node.default_child
+        cfn_bucket.notification_configuration = CfnBucket.NotificationConfigurationProperty(
+            queue_configurations=[
+                CfnBucket.QueueConfigurationProperty(
+                    event='s3:ObjectCreated:*',
+                    queue=self.ingestion_queue.queue_arn,
+                    filter=CfnBucket.NotificationFilterProperty(
+                        s3_key=CfnBucket.S3KeyFilterProperty(
+                            rules=[
+                                CfnBucket.FilterRuleProperty(name='prefix', value=INGEST_PREFIX),
+                            ],
+                        ),
+                    ),
+                ),
+            ],
+        )
+        cfn_bucket.add_depends_on(ingestion_queue_policy.node.default_child)
+
+        CfnOutput(
+            scope=self,
+            id=f'{app_name}-SQS-INGESTION-DLQ-URL',
+            value=self.ingestion_dead_letter_queue.queue_url,
+        )
+
         # tag all resources with app_name
         self.tags.set_tag(TAG_NAME, app_name, apply_to_launched_instances=True)
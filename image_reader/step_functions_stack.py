@@ -6,67 +6,84 @@ import pathlib
 from aws_cdk.aws_apigatewayv2 import CfnApi
 from aws_cdk.aws_iam import ManagedPolicy, PolicyStatement, Role, ServicePrincipal
 from aws_cdk.aws_lambda import Code, Function, Runtime
-from aws_cdk.aws_stepfunctions import JsonPath, StateMachine, Parallel
+from aws_cdk.aws_stepfunctions import Choice, Condition, Fail, StateMachine
 from aws_cdk.aws_stepfunctions_tasks import LambdaInvoke
-from aws_cdk.core import Aws, Construct, Stack
+from aws_cdk.core import Aws, Construct, Duration, Stack
 
 
 TAG_NAME = 'app'
 
 
+def get_state_machine_name(app_name):
+    # a fixed name lets functions created before the state machine build its ARN
+    return f'{app_name}-STATE-MACHINE'
+
+
 class StepFunctionsStack(Stack):
 
     def __init__(self, scope: Construct, construct_id: str, conversion_api: CfnApi, lambda_stack: Stack, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         app_name = self.node.try_get_context('app-name')
-        self.state_machine = self._create_state_machine(app_name, conversion_api, lambda_stack.retrieve_text_func, lambda_stack.store_text_func, lambda_stack.moderate_text_func, lambda_stack.convert_text_to_audio_func)
+        self.state_machine = self._create_state_machine(app_name, conversion_api, lambda_stack.runtime_layer, lambda_stack.retrieve_text_func, lambda_stack.convert_text_to_audio_func, lambda_stack.on_job_failed_func)
 
         # tag all resources with app_name
         self.tags.set_tag(TAG_NAME, app_name, apply_to_launched_instances=True)
 
-    def _create_state_machine(self, app_name, conversion_api, retrieve_text_func, store_text_func, moderate_text_func, convert_text_to_audio_func):
+    def _create_state_machine(self, app_name, conversion_api, runtime_layer, retrieve_text_func, convert_text_to_audio_func, on_job_failed_func):
         retrieve_text_lambda_invoke = LambdaInvoke(
             self,
             id=f'{app_name}-LambdaInvoke-RETRIEVE-TEXT',
             lambda_function=retrieve_text_func,
         )
 
-        store_text_lambda_invoke = LambdaInvoke(
+        convert_text_to_audio_lambda_invoke = LambdaInvoke(
             self,
-            id=f'{app_name}-LambdaInvoke-STORE-TEXT',
-            lambda_function=store_text_func,
+            id=f'{app_name}-LambdaInvoke-CONVERT-TEXT-TO-AUDIO',
+            lambda_function=convert_text_to_audio_func,
         )
-
-        # TODO no need to retry for this one
-        moderate_text_lambda_invoke = LambdaInvoke(
-            self,
-            id=f'{app_name}-LambdaInvoke-MODERATE-TEXT',
-            lambda_function=moderate_text_func,
+        # Polly had no capacity for some of the tasks, the retry starts the rest (over about an hour and a half);
+        # the function waits a random while itself before giving up, which keeps the retries apart
+        convert_text_to_audio_lambda_invoke.add_retry(
+            errors=['AdmissionDenied'],
+            interval=Duration.seconds(20),
+            backoff_rate=1.5,
+            max_attempts=12,
         )
 
-        parallel_step = Parallel(
+        # tells the user, or the batch the job belongs to, and fails the execution
+        on_job_failed_lambda_invoke = LambdaInvoke(
             self,
-            id=f'{app_name}-PARALLEL',
-            result_path=JsonPath.DISCARD,  # this sets ResultPath to null, making parallel_step use input as output
+            id=f'{app_name}-LambdaInvoke-ON-JOB-FAILED',
+            lambda_function=on_job_failed_func,
         )
-
-        parallel_step.branch(
-            store_text_lambda_invoke,
-            moderate_text_lambda_invoke,
+        on_job_failed_lambda_invoke.next(
+            Fail(
+                self,
+                id=f'{app_name}-FAIL-JOB',
+            ),
         )
+        for lambda_invoke in (retrieve_text_lambda_invoke, convert_text_to_audio_lambda_invoke):
+            lambda_invoke.add_catch(on_job_failed_lambda_invoke, result_path='$.Error')
 
-        convert_text_to_audio_lambda_invoke = LambdaInvoke(
+        # text is moderated and stored where it is retrieved (retrieve_text and convert_images_to_text)
+        retrieve_text_lambda_invoke.next(convert_text_to_audio_lambda_invoke)
+
+        # convert_images_to_text already retrieved the text of single-page inputs synchronously
+        state_machine_definition = Choice(
             self,
-            id=f'{app_name}-LambdaInvoke-CONVERT-TEXT-TO-AUDIO',
-            lambda_function=convert_text_to_audio_func,
+            id=f'{app_name}-CHOICE-TEXT-RETRIEVED',
+        ).when(
+            Condition.is_present('$.Payload.TextS3Key'),
+            convert_text_to_audio_lambda_invoke,
+        ).otherwise(
+            retrieve_text_lambda_invoke,
         )
 
-        state_machine_definition = retrieve_text_lambda_invoke.next(parallel_step).next(convert_text_to_audio_lambda_invoke)
-
         state_machine = StateMachine(
             self,
             id=f'{app_name}-STEP-FUNCTION',
+            state_machine_name=get_state_machine_name(app_name),
             definition=state_machine_definition,
         )
 
@@ -87,6 +104,13 @@ class StepFunctionsStack(Stack):
                 resources=[state_machine.state_machine_arn],
             ),
         )
+        # gives back the Textract lease of every finished job, see admission.py in the runtime layer
+        on_textract_ready_func_role.add_to_policy(
+            PolicyStatement(
+                actions=['dynamodb:UpdateItem'],
+                resources=[f'arn:{Aws.PARTITION}:dynamodb:{Aws.REGION}:{Aws.ACCOUNT_ID}:table/{app_name}Admission'],
+            ),
+        )
 
         # moving this to the lambda stack would trigger a cyclic depenency error
         self.on_textract_ready_func = Function(
@@ -102,5 +126,6 @@ class StepFunctionsStack(Stack):
                 'CONVERSION_API_REGION': Aws.REGION,
                 f'{app_name}_STATE_MACHINE': state_machine.state_machine_arn,
             },
+            layers=[runtime_layer],
             role=on_textract_ready_func_role,
         )
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import argparse
+import boto3
+import json
+import pathlib
+
+from boto3.dynamodb.conditions import Attr
+
+
+parser = argparse.ArgumentParser(description='Rebuild the text and audio of finished jobs from their stored Textract output.')
+parser.add_argument('app_job_ids', nargs='*', help='jobs to reprocess (default: every job with stored Textract output)')
+parser.add_argument('--confidence-limit', help='a number or auto (default: the one each job was converted with)')
+args = parser.parse_args()
+
+with open(pathlib.Path(__file__).parent / 'cdk.json') as fp:
+    app_name = json.load(fp)['context']['app-name']
+
+app_job_ids = args.app_job_ids
+if not app_job_ids:
+    ddb_table = boto3.resource('dynamodb').Table(f'{app_name}Jobs')
+    scan_kwargs = {
+        'FilterExpression': Attr('TextractOutputS3Key').exists(),
+        'ProjectionExpression': '#app_job_id',
+        'ExpressionAttributeNames': {
+            '#app_job_id': f'{app_name}JobId',
+        },
+    }
+    while True:
+        ddb_resp = ddb_table.scan(**scan_kwargs)
+        app_job_ids.extend(item[f'{app_name}JobId'] for item in ddb_resp['Items'])
+        if 'LastEvaluatedKey' not in ddb_resp:
+            break
+        scan_kwargs['ExclusiveStartKey'] = ddb_resp['LastEvaluatedKey']
+
+# asynchronous invocations, each one only starts a state machine execution
+lambda_client = boto3.client('lambda')
+for app_job_id in app_job_ids:
+    event = {
+        f'{app_name}JobId': app_job_id,
+    }
+    if args.confidence_limit:
+        event['ConfidenceLimit'] = args.confidence_limit
+    lambda_client.invoke(
+        FunctionName=f'{app_name}-reprocess-job',
+        InvocationType='Event',
+        Payload=json.dumps(event).encode('utf-8'),
+    )
+print(f'Started reprocessing {len(app_job_ids)} job(s)')
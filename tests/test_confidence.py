@@ -0,0 +1,60 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pathlib
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'image_reader' / 'lambda_runtime_layer' / 'python'))
+
+from confidence import (  # noqa: E402
+    ADAPTIVE_CONFIDENCE_LIMIT,
+    MIN_ADAPTIVE_CONFIDENCE_LIMIT,
+    apply_confidence_limit,
+    choose_confidence_limit,
+    format_confidence_limit,
+    parse_confidence_limit,
+)
+
+
+class LineBlocks(list):
+
+    # the confidences of a chunk of lines, as reading_order.LineBlocks has them
+
+    @property
+    def confidence(self):
+        return self
+
+
+def chunks(*confidences):
+    return [LineBlocks(confidences[:len(confidences) // 2]), LineBlocks(confidences[len(confidences) // 2:])]
+
+
+def test_limit_separates_smudged_from_clean_lines():
+    confidences = [60, 62, 63, 65] * 5 + [95, 97, 98, 99] * 20
+    assert choose_confidence_limit(chunks(*confidences)) == 66.0
+
+def test_clean_document_keeps_the_lowest_limit():
+    assert choose_confidence_limit(chunks(*[91, 94, 96, 99] * 10)) == MIN_ADAPTIVE_CONFIDENCE_LIMIT
+    assert choose_confidence_limit(chunks()) == MIN_ADAPTIVE_CONFIDENCE_LIMIT
+
+def test_limit_stays_within_bounds():
+    assert choose_confidence_limit(chunks(*[10, 12] * 5 + [40, 45] * 20)) == MIN_ADAPTIVE_CONFIDENCE_LIMIT
+
+def test_confidence_limit_is_parsed_and_formatted():
+    assert parse_confidence_limit('', '80') == 80.0
+    assert parse_confidence_limit(None, 'auto') == ADAPTIVE_CONFIDENCE_LIMIT
+    assert parse_confidence_limit(' AUTO ', '80') == ADAPTIVE_CONFIDENCE_LIMIT
+    assert format_confidence_limit(parse_confidence_limit('72.5', '80')) == '72.5'
+    assert format_confidence_limit(80.0) == '80'
+    with pytest.raises(ValueError):
+        parse_confidence_limit('101', '80')
+
+def test_report_counts_the_dropped_lines_as_they_are_read():
+    line_blocks_chunks, report = apply_confidence_limit(chunks(*[30, 85, 99, 79.9]), 80.0)
+    assert report.line_count == 0
+    assert [list(line_blocks) for line_blocks in line_blocks_chunks] == [[30, 85], [99, 79.9]]
+    assert (report.line_count, report.dropped_line_count) == (4, 2)
+    assert report.histogram == [0, 0, 0, 1, 0, 0, 0, 1, 1, 1]
+    assert report.summary() == 'Dropped 2 of 4 lines below confidence 80'
@@ -0,0 +1,59 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'image_reader' / 'lambda_runtime_layer' / 'python'))
+
+from moderation import Automaton, Match, read_moderated_lines  # noqa: E402
+
+
+def scan(phrases, lines):
+    return list(Automaton(phrases).scan(lines))
+
+
+def test_phrase_ending_inside_another_is_found_through_fail_links():
+    assert scan(['big bad wolf', 'bad wolf'], ['the big bad wolf']) == [
+        Match('big bad wolf', 1, 5),
+        Match('bad wolf', 1, 9),
+    ]
+
+def test_scan_falls_back_to_the_longest_suffix_on_a_mismatch():
+    # "big big" fails the first "big" over to the second, "bad bad" does the same for "bad wolf"
+    assert scan(['big bad', 'bad wolf'], ['big big bad bad wolf']) == [
+        Match('big bad', 1, 5),
+        Match('bad wolf', 1, 13),
+    ]
+
+def test_phrase_across_a_line_break_points_at_its_first_token():
+    assert scan(['bad word'], ['this is a bad', 'word here']) == [Match('bad word', 1, 11)]
+
+def test_curly_apostrophes_and_case_are_normalized():
+    assert scan(["don't"], ['YOU DON’T SAY']) == [Match("don't", 1, 5)]
+    assert scan(['dont'], ["you don't say"]) == []
+
+def test_lexicon_round_trips_through_bytes():
+    automaton = Automaton(['big bad wolf', 'bad wolf', 'wolf', 'red riding hood'])
+    loaded = Automaton.from_bytes(automaton.to_bytes())
+
+    lines = ['the big bad', 'wolf met little red riding hood']
+    assert loaded.phrase_count == automaton.phrase_count == 4
+    assert list(loaded.scan(lines)) == list(automaton.scan(lines))
+    assert loaded.fail == automaton.fail
+
+def test_reading_stops_at_the_first_undesirable_phrase():
+    read = []
+
+    def lines():
+        for line in ['fine', 'a bad word', 'never read']:
+            read.append(line)
+            yield line
+
+    read_lines, match = read_moderated_lines(lines(), Automaton(['bad word']))
+    assert match == Match('bad word', 2, 3)
+    assert read == read_lines == ['fine', 'a bad word']
+
+def test_empty_lexicon_reads_everything():
+    assert not Automaton(['', '  '])
+    assert read_moderated_lines(iter(['one', 'two']), Automaton([])) == (['one', 'two'], None)
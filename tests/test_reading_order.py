@@ -0,0 +1,65 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'image_reader' / 'lambda_runtime_layer' / 'python'))
+
+from reading_order import Line, ReadingOrder, order_body_lines  # noqa: E402
+
+
+LINE_HEIGHT = 0.02
+
+
+def line(text, left, top, width):
+    return Line(text, left, top, width, LINE_HEIGHT)
+
+def body(lines):
+    return order_body_lines(sorted(lines, key=lambda line: (line.top, line.left)))
+
+
+def test_two_columns_are_read_one_after_the_other():
+    lines = [line(f'left {row}', 0.08, 0.1 + row * 0.03, 0.4) for row in range(10)]
+    lines += [line(f'right {row}', 0.52, 0.1 + row * 0.03, 0.4) for row in range(10)]
+
+    assert body(lines) == [f'left {row}' for row in range(10)] + [f'right {row}' for row in range(10)]
+
+def test_title_across_columns_comes_first():
+    lines = [line('Title', 0.1, 0.1, 0.8)]
+    lines += [line(f'left {row}', 0.08, 0.15 + row * 0.03, 0.4) for row in range(5)]
+    lines += [line(f'right {row}', 0.52, 0.15 + row * 0.03, 0.4) for row in range(5)]
+
+    assert body(lines) == ['Title'] + [f'left {row}' for row in range(5)] + [f'right {row}' for row in range(5)]
+
+def test_form_is_read_label_by_value():
+    lines = []
+    for row, (label, value) in enumerate([('Name:', 'Jane Doe'), ('Address:', '1 Main Street'), ('City:', 'Springfield'), ('Phone:', '555 0100')]):
+        top = 0.1 + row * 0.05
+        lines.append(line(label, 0.1, top, 0.1))
+        # Textract boxes of the same row do not start at exactly the same height
+        lines.append(line(value, 0.25, top - 0.002, 0.3))
+
+    assert body(lines) == ['Name:', 'Jane Doe', 'Address:', '1 Main Street', 'City:', 'Springfield', 'Phone:', '555 0100']
+
+def test_centered_heading_does_not_split_a_single_column():
+    lines = [line(f'text {row}', 0.1, 0.1 + row * 0.03, 0.8) for row in range(5)]
+    lines.append(line('last words.', 0.1, 0.25, 0.15))
+    lines.append(line('Chapter Two', 0.42, 0.3, 0.16))
+    lines.append(line('It began.', 0.1, 0.35, 0.1))
+    lines += [line(f'more {row}', 0.1, 0.38 + row * 0.03, 0.8) for row in range(5)]
+
+    assert body(lines) == [f'text {row}' for row in range(5)] + ['last words.', 'Chapter Two', 'It began.'] + [f'more {row}' for row in range(5)]
+
+def test_blocks_above_one_another_are_not_columns():
+    lines = [line(f'upper {row}', 0.1, 0.1 + row * 0.03, 0.3) for row in range(4)]
+    lines += [line(f'lower {row}', 0.6, 0.4 + row * 0.03, 0.3) for row in range(4)]
+
+    assert body(lines) == [f'upper {row}' for row in range(4)] + [f'lower {row}' for row in range(4)]
+
+def test_page_numbers_are_dropped_and_words_kept():
+    footer_texts = ['12', 'Page 3 of 10', 'xiv', 'iv', 'Vivid', 'Mild', 'Civic', 'Did']
+    lines = [line('Body text', 0.1, 0.5, 0.8)]
+    lines += [line(text, 0.1 + index * 0.1, 0.95, 0.05) for index, text in enumerate(footer_texts)]
+
+    assert ReadingOrder().order_page(lines) == ['Body text', 'Vivid', 'Mild', 'Civic', 'Did']
@@ -0,0 +1,65 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'image_reader' / 'lambda_runtime_layer' / 'python'))
+
+from ssml import cut_text, iter_paragraphs, split_sentences, to_ssml_chunks  # noqa: E402
+
+
+FULL_LINE = 'the quick brown fox jumps over the lazy dog and runs on'
+
+
+def test_hyphenated_word_is_rejoined_across_lines():
+    lines = [
+        f'It starts with {FULL_LINE} to a hyphen-',
+        f'ated word and {FULL_LINE} all the way down.',
+    ]
+    assert list(iter_paragraphs(lines)) == [
+        f'It starts with {FULL_LINE} to a hyphenated word and {FULL_LINE} all the way down.',
+    ]
+
+def test_hyphen_before_a_capital_is_kept():
+    lines = [f'It names {FULL_LINE} the Austro-', f'Hungarian empire and {FULL_LINE} on and on.']
+    assert list(iter_paragraphs(lines)) == [f'It names {FULL_LINE} the Austro- Hungarian empire and {FULL_LINE} on and on.']
+
+def test_short_line_ending_a_sentence_ends_its_paragraph():
+    lines = [
+        f'One {FULL_LINE} and',
+        'stops here.',
+        f'Two {FULL_LINE} and',
+        f'goes on {FULL_LINE}.',
+    ]
+    assert list(iter_paragraphs(lines)) == [
+        f'One {FULL_LINE} and stops here.',
+        f'Two {FULL_LINE} and goes on {FULL_LINE}.',
+    ]
+
+def test_short_line_without_a_sentence_end_is_a_heading():
+    lines = ['Chapter Two', f'It was {FULL_LINE} and', f'so {FULL_LINE}.']
+    assert list(iter_paragraphs(lines)) == ['Chapter Two', f'It was {FULL_LINE} and so {FULL_LINE}.']
+
+def test_abbreviations_and_initials_do_not_end_sentences():
+    assert split_sentences('Dr. Smith met J. R. Jones at 5 p.m. on Monday. They talked (e.g. about 3 dogs). "Fine," he said.') == [
+        'Dr. Smith met J. R. Jones at 5 p.m. on Monday.',
+        'They talked (e.g. about 3 dogs).',
+        '"Fine," he said.',
+    ]
+
+def test_long_sentence_is_cut_at_whitespace():
+    assert list(cut_text('aaaa bbbb cccc dddd', 10)) == ['aaaa bbbb', 'cccc dddd']
+    assert list(cut_text('aaaaaaaaaaaa', 5)) == ['aaaaa', 'aaaaa', 'aa']
+
+def test_chunks_hold_whole_sentences_within_the_limit():
+    # lines of the same length run on as one paragraph, which goes on from chunk to chunk
+    lines = [f'Sentence {index} & more.' for index in range(10)]
+    chunks = to_ssml_chunks(lines, 50, speech_rate='90%')
+
+    assert len(chunks) == 5
+    assert chunks[0] == '<speak><prosody rate="90%"><p><s>Sentence 0 &amp; more.</s><s>Sentence 1 &amp; more.</s></p></prosody></speak>'
+    assert all(chunk.count('<s>') == 2 and chunk.count('<p>') == 1 for chunk in chunks)
+
+def test_default_speech_rate_has_no_prosody():
+    assert to_ssml_chunks(['Short.', '', 'Two paragraphs.'], 100) == ['<speak><p><s>Short.</s></p><p><s>Two paragraphs.</s></p></speak>']
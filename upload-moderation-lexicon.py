@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import boto3
+import json
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent / 'image_reader' / 'lambda_runtime_layer' / 'python'))
+
+from moderation import LEXICON_S3_KEY, Automaton, load_phrases
+
+
+outputs_file = sys.argv[1]
+phrases_file = sys.argv[2]
+with open(outputs_file) as fp:
+    outputs_json = json.load(fp)
+    s3_bucket_name = outputs_json["image-reader-s3-stack"]["ImageReaderS3BUCKETNAME"]
+
+with open(phrases_file, encoding='utf-8') as fp:
+    automaton = Automaton(load_phrases(fp))
+
+# the moderation functions pick it up within MODERATION_LEXICON_REFRESH_SECONDS
+boto3.client('s3').put_object(
+    Body=automaton.to_bytes(),
+    Bucket=s3_bucket_name,
+    Key=LEXICON_S3_KEY,
+    ContentType='application/gzip',
+)
+print(f'Uploaded {automaton.phrase_count} phrase(s) to s3://{s3_bucket_name}/{LEXICON_S3_KEY}')